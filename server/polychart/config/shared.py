@@ -7,6 +7,7 @@ polychart.config.{local,deploy}.
 """
 
 from datetime import datetime
+import multiprocessing
 import os
 
 ADMINS = (
@@ -186,6 +187,11 @@ LOGGING = {
       'level': 'DEBUG',
       'class': 'logging.StreamHandler',
     },
+    'slow_query_file': {
+      'level': 'DEBUG',
+      'class': 'logging.FileHandler',
+      'filename': 'log/app/slow_queries',
+    },
   },
   'loggers': {
     'django': {
@@ -203,6 +209,11 @@ LOGGING = {
       'level': 'DEBUG',
       'propagate': True,
     },
+    'polychartQuery.slowQuery.entries': {
+      'handlers': ['slow_query_file'],
+      'level': 'DEBUG',
+      'propagate': False,
+    },
   }
 }
 
@@ -217,6 +228,78 @@ ENABLED_DATA_SOURCE_TYPES = [
 # 'googleAnalytics',
 ]
 
+# Data source connections are pooled per user and data source.
+# See polychartQuery.pool for details.
+DATA_SOURCE_POOL_SIZE             = 4   # connections per data source
+DATA_SOURCE_POOL_IDLE_TIMEOUT     = 300 # seconds before idle connections close
+DATA_SOURCE_POOL_CHECKOUT_TIMEOUT = 30  # seconds to wait for a free connection
+DATA_SOURCE_POOL_MAX_POOLS        = 200 # data sources with open connections
+
+# Data source query results are cached for QUERY_CACHE_TTL seconds, or as set
+# per data source key or type in QUERY_CACHE_TTLS, e.g. {'googleAnalytics': 3600}.
+# Expired results are served for up to QUERY_CACHE_STALE_TTL more seconds while
+# they are refreshed in the background. See polychart.main.utils.resultCache.
+QUERY_CACHE_TTL       = 300
+QUERY_CACHE_TTLS      = {}
+QUERY_CACHE_STALE_TTL = 3600
+# Compressed results above QUERY_CACHE_ITEM_LIMIT bytes are split into chunks to
+# fit the cache backend (memcached's default item limit is 1MB); results above
+# QUERY_CACHE_MAX_BYTES are not cached.
+QUERY_CACHE_ITEM_LIMIT = 1000 * 1000
+QUERY_CACHE_MAX_BYTES  = 16 * 1000 * 1000
+
+# Data source views report per-phase timings in a Server-Timing header, and all
+# phases are recorded in histograms served at /api/data-source/metrics to staff
+# and to METRICS_ALLOWED_IPS. See polychart.main.utils.profiling.
+METRICS_ALLOWED_IPS = ('127.0.0.1',)
+# Set QUERY_PROFILE_SLOW_SECONDS to profile slow requests: the given fraction of
+# requests runs under cProfile, and profiles of those slower than the threshold
+# are dumped to QUERY_PROFILE_DIR, for use with pstats or snakeviz.
+QUERY_PROFILE_SLOW_SECONDS = None
+QUERY_PROFILE_SAMPLE_RATE  = 0.1
+QUERY_PROFILE_DIR          = os.path.join(os.path.abspath(os.getcwd()), 'tmp', 'profiles')
+
+# SQL queries taking SLOW_QUERY_THRESHOLD seconds or more, or as set per data
+# source key or type in SLOW_QUERY_THRESHOLDS (None turns logging off), are
+# written to SLOW_QUERY_LOG, along with their EXPLAIN plan if SLOW_QUERY_EXPLAIN
+# is set. Summarize them with `python manage.py slowqueries`.
+SLOW_QUERY_THRESHOLD  = 1.0
+SLOW_QUERY_THRESHOLDS = {}
+SLOW_QUERY_EXPLAIN    = False
+SLOW_QUERY_LOG        = LOGGING['handlers']['slow_query_file']['filename']
+
+# Cleaned CSV uploads are stored column-wise under LOCAL_DATA_ROOT, one
+# directory per data set. See polychartQuery.csv.storage.
+LOCAL_DATA_ROOT = 'uploadedData/tables'
+
+# Largest raw CSV upload accepted, in bytes; uploads arrive in chunks of
+# UPLOAD_CHUNK_BYTES, see polychart.main.utils.rawUpload.
+UPLOAD_MAX_BYTES   = 200 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Worker processes ingesting uploaded CSV files, and the seconds a file may take;
+# see polychart.main.utils.csvJobs. The processes are forked, best before any
+# thread starts, which `python manage.py runjobs` does but web processes can not.
+CSV_INGEST_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+CSV_INGEST_TIMEOUT = 30 * 60
+
+# Long running operations (cleaning uploads, exports, creating data sources) are
+# queued in the database, and run by JOB_WORKERS threads in each process running
+# workers, independently of the number of web workers. Web processes run them
+# unless JOB_RUN_IN_WEB is False; then run `python manage.py runjobs` instead.
+# Failed jobs are retried after JOB_RETRY_SECONDS, doubling each time; jobs whose
+# worker has not beaten for JOB_STALE_SECONDS are queued again. Finished jobs,
+# and their files under JOB_FILES_ROOT, are kept for JOB_KEEP_SECONDS.
+# See polychart.main.utils.jobs.
+JOB_WORKERS           = 4
+JOB_RUN_IN_WEB        = True
+JOB_POLL_SECONDS      = 1.0
+JOB_HEARTBEAT_SECONDS = 10
+JOB_STALE_SECONDS     = 60
+JOB_RETRY_SECONDS     = 5
+JOB_KEEP_SECONDS      = 24 * 60 * 60
+JOB_FILES_ROOT        = 'uploadedData/jobs'
+
 INTERCOM_ENABLED = False
 OLARK_ENABLED = False
 SEGMENT_IO_ENABLED = False
@@ -233,6 +316,15 @@ PASSWORD_RESET_ENABLED = False
 # To run the exporting service: `coffee exportService/server.coffee <PORT>`
 EXPORT_SERVICE_PORT = None
 
+# Items of a dashboard are rendered concurrently, by up to EXPORT_RENDER_WORKERS
+# threads per export, on sockets to the export service kept open in a pool of
+# EXPORT_RENDER_POOL_SIZE per process, and closed after EXPORT_RENDER_IDLE_TIMEOUT
+# seconds unused. See polychart.main.utils.renderService.
+EXPORT_RENDER_WORKERS      = 8
+EXPORT_RENDER_POOL_SIZE    = 16
+EXPORT_RENDER_IDLE_TIMEOUT = 300
+EXPORT_RENDER_TIMEOUT      = 60 # seconds to wait for the service, or a socket
+
 try:
   from polychart.config.overrides import *
 except ImportError:
@@ -0,0 +1,401 @@
+"""
+Benchmarks for the query translation and result formatting pipeline.
+
+Times the hot path of table queries against an in-process fake `queryFunc`,
+so no data source is needed:
+  buildQuery: DbbQuery.__init__, i.e. validation and _buildQuery.
+  combinePieces: SqlQuery._combinePieces.
+  getData: A whole SqlQuery.getData against the fake queryFunc.
+  formatResult: SqlQuery._formatResult.
+  saneEncode: utils.saneEncode of a formatted result.
+  resultEncoder: encoder.ResultEncoder, in compat and typed mode.
+  gaFormatTimeData: GAQuery._formatTimeData, for several bin widths.
+  csvIngest: csvParser.ingestCsv, into a temporary directory.
+
+Query specifications are synthetic, with the requested numbers of columns, plus
+one built from the charts in packageData/dashstate.json. Results are printed as
+a table and can be saved as JSON, in the format of pytest-benchmark, to compare
+against a later run:
+
+  python manage.py benchmark --output before.json
+  python manage.py benchmark --compare before.json
+"""
+import gc
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+
+from cStringIO                   import StringIO
+from datetime                    import datetime
+from django.core.management.base import BaseCommand, CommandError
+from optparse                    import make_option
+from time                        import time
+
+from polychart.main.utils.csvParser       import ingestCsv
+from polychartQuery.encoder               import ResultEncoder
+from polychartQuery.googleAnalytics.query import GAQuery
+from polychartQuery.sql.query             import SqlQuery
+from polychartQuery.utils                 import saneEncode
+
+DEFAULT_ROWS    = '1000,10000,100000'
+DEFAULT_COLUMNS = '1,10,50'
+DASHSTATE_PATH  = os.path.join('packageData', 'dashstate.json')
+TABLE_NAME      = 'bench'
+QUERY_LIMIT     = 1000000
+COLUMN_KINDS    = ['num', 'cat', 'date'] # cycled through by synthetic columns
+SQL_TYPES       = {'num': 'int', 'cat': 'varchar', 'date': 'datetime'}
+GA_BIN_WIDTHS   = ['day', 'week', 'month']
+
+class Command(BaseCommand):
+  help = 'Benchmarks query translation and result formatting.'
+  option_list = BaseCommand.option_list + (
+    make_option('--rows', default=DEFAULT_ROWS,
+      help='Comma separated numbers of rows [default: %default]'),
+    make_option('--columns', default=DEFAULT_COLUMNS,
+      help='Comma separated numbers of columns [default: %default]'),
+    make_option('--filter', default=None,
+      help='Only run benchmarks whose name matches this regular expression'),
+    make_option('--min-rounds', type='int', default=3,
+      help='Minimum rounds per benchmark [default: %default]'),
+    make_option('--max-time', type='float', default=1.0,
+      help='Seconds after which no more rounds are started [default: %default]'),
+    make_option('--output', default=None,
+      help='File to save the results to, as JSON'),
+    make_option('--compare', default=None,
+      help='JSON file of an earlier run to compare against'),
+  )
+
+  def handle(self, *args, **options):
+    try:
+      rowCounts    = _parseInts(options['rows'])
+      columnCounts = _parseInts(options['columns'])
+      pattern      = re.compile(options['filter'] or '')
+    except (ValueError, re.error) as err:
+      raise CommandError(str(err))
+
+    results = []
+    for group, params, setup, fn in _cases(rowCounts, columnCounts):
+      fullName = _benchName(group, params)
+      if not pattern.search(fullName):
+        continue
+      arg   = setup()
+      stats = _measure(fn, arg, options['min_rounds'], options['max_time'])
+      results.append({ 'name':     fullName
+                     , 'fullname': fullName
+                     , 'group':    group
+                     , 'params':   params
+                     , 'stats':    stats })
+      self.stdout.write('.', ending='')
+      self.stdout.flush()
+    self.stdout.write('')
+
+    baseline = None
+    if options['compare']:
+      with open(options['compare']) as f:
+        baseline = {b['name']: b['stats'] for b in json.load(f)['benchmarks']}
+    self.stdout.write(_formatTable(results, baseline))
+
+    if options['output']:
+      with open(options['output'], 'w') as f:
+        json.dump(_report(results), f, indent=2, sort_keys=True)
+      self.stdout.write('Saved results to {0}'.format(options['output']))
+
+#### Benchmark cases
+
+def _cases(rowCounts, columnCounts):
+  """
+  Generates the benchmark cases.
+
+  Returns:
+    A generator of (group, params, setup, fn) tuples; `fn` is timed on
+    the result of `setup`, which is not timed.
+  """
+  specs = [({'columns': n}, lambda n=n: _syntheticSpec(n)) for n in columnCounts]
+  if os.path.exists(DASHSTATE_PATH):
+    specs.append(({'columns': 'dashstate'}, _dashstateSpec))
+
+  for params, makeSpec in specs:
+    # Queries modify their spec idempotently, so one copy serves all rounds.
+    yield ('buildQuery', params,
+           lambda makeSpec=makeSpec: _copySpec(*makeSpec()),
+           lambda (spec, columns): SqlQuery(TABLE_NAME, spec, QUERY_LIMIT, None, columns))
+    yield ('combinePieces', params,
+           lambda makeSpec=makeSpec: _newQuery(*makeSpec()),
+           lambda q: q._combinePieces(q.select, [], q.groups, q.filters))
+
+  for numRows in rowCounts:
+    for params, makeSpec in specs:
+      params = dict(params, rows=numRows)
+      def setup(makeSpec=makeSpec, numRows=numRows):
+        query = _newQuery(*makeSpec())
+        return query, _rows(query, numRows)
+      yield ('getData', params, setup, _getData)
+      yield ('formatResult', params,
+             setup, lambda (query, rows): query._formatResult(rows))
+      yield ('saneEncode', params,
+             lambda setup=setup: _formatted(*setup()), saneEncode)
+      for compat in (True, False):
+        yield ('resultEncoder', dict(params, compat=compat), setup,
+               lambda (query, rows), compat=compat: ResultEncoder(
+                 query.selectOrder, query.jsSpec['meta'], compat).encode(rows))
+    for numColumns in columnCounts:
+      yield ('csvIngest', {'rows': numRows, 'columns': numColumns},
+             lambda numRows=numRows, numColumns=numColumns: _csv(numRows, numColumns),
+             _ingestCsv)
+    for bw in GA_BIN_WIDTHS:
+      yield ('gaFormatTimeData', {'rows': numRows, 'bw': bw},
+             lambda numRows=numRows, bw=bw: _gaTimeData(numRows, bw),
+             _formatTimeData)
+
+def _getData((query, rows)):
+  query.queryFunc = lambda querySql, params: rows
+  return query.getData()
+
+def _formatTimeData((query, (gaNames, headerNames, realNameDict, rows))):
+  # Rows are modified in place, so each round needs fresh copies.
+  rows = [list(row) for row in rows]
+  return query._formatTimeData(gaNames, headerNames, realNameDict, rows)
+
+def _ingestCsv((text, format)):
+  path = tempfile.mkdtemp()
+  try:
+    return ingestCsv(StringIO(text), format, os.path.join(path, '0'))
+  finally:
+    shutil.rmtree(path)
+
+def _formatted(query, rows):
+  return query._formatResult(rows)
+
+#### Fixtures
+
+def _syntheticSpec(numColumns):
+  """
+  Builds a query specification over `numColumns` columns, cycling through
+  COLUMN_KINDS: numeric columns are summed, categorical ones grouped on and date
+  columns binned by month. The first numeric and date columns are filtered on.
+
+  Returns:
+    A pair of the specification and the (column, data type) list of the table.
+  """
+  spec    = _emptySpec()
+  columns = []
+  for i in xrange(numColumns):
+    kind = COLUMN_KINDS[i % len(COLUMN_KINDS)]
+    name = '{0}.c{1}'.format(TABLE_NAME, i)
+    columns.append((name, SQL_TYPES[kind]))
+    ident = ['ident', {'name': name}]
+    if kind == 'num':
+      _addSelect(spec, 'sum([{0}])'.format(name), 'num',
+                 _call('sum', [ident]), isGroup=False)
+      if i == 0:
+        _addFilter(spec, name, ident, ge=0, le=1000)
+    elif kind == 'cat':
+      _addSelect(spec, name, 'cat', ident, isGroup=True)
+    else:
+      _addSelect(spec, 'bin([{0}],month)'.format(name), 'date',
+                 _call('bin', [ident, ['const', {'type': 'cat', 'value': 'month'}]]),
+                 isGroup=True)
+      if i == 2:
+        spec['meta'][name] = {'type': 'date'}
+        _addFilter(spec, name, ident, ge=1356998400)
+  return spec, columns
+
+def _dashstateSpec():
+  """
+  Builds a query specification selecting every column expression used by the
+  charts in packageData/dashstate.json, e.g. `[TEST.Category]` or
+  `sum([TEST.Number\\[%\\]])`.
+  """
+  with open(DASHSTATE_PATH) as f:
+    dashstate = json.load(f)
+
+  metas = {}
+  def collect(obj):
+    if isinstance(obj, dict):
+      for key, val in obj.iteritems():
+        if key == 'meta' and isinstance(val, dict):
+          metas.update(val)
+        else:
+          collect(val)
+    elif isinstance(obj, list):
+      for item in obj:
+        collect(item)
+  collect(dashstate['items'])
+
+  spec, columns = _emptySpec(), {}
+  for key, meta in sorted(metas.iteritems()):
+    match = re.match(r'^(?:(\w+)\()?(?:\[(.*)\]|(\d+))\)?$', key)
+    if match is None:
+      continue
+    fname, column, const = match.groups()
+    if column is not None:
+      column = re.sub(r'\\(.)', r'\1', column)
+      columns[column] = SQL_TYPES.get(meta['type'], 'varchar')
+      expr = ['ident', {'name': column}]
+    else:
+      expr = ['const', {'type': 'num', 'value': const}]
+    if fname is None:
+      _addSelect(spec, column, meta['type'], expr, isGroup=True)
+    else:
+      _addSelect(spec, key, meta['type'], _call(fname, [expr]), isGroup=False)
+  return spec, columns.items()
+
+def _emptySpec():
+  return { 'select': []
+         , 'stats':  {'stats': [], 'groups': []}
+         , 'filter': []
+         , 'meta':   {}
+         , 'trans':  [] }
+
+def _call(fname, args):
+  return ['call', {'fname': fname, 'args': args}]
+
+def _addSelect(spec, name, kind, expr, isGroup):
+  spec['select'].append({'name': name, 'expr': expr})
+  spec['meta'][name] = {'type': kind}
+  if isGroup:
+    spec['stats']['groups'].append({'name': name, 'expr': expr})
+
+def _addFilter(spec, name, expr, **ops):
+  spec['meta'].setdefault(name, {'type': 'num'})
+  spec['filter'].append(dict(ops, expr={'name': '[{0}]'.format(name), 'expr': expr}))
+
+def _copySpec(spec, columns):
+  return json.loads(json.dumps(spec)), columns
+
+def _newQuery(spec, columns):
+  spec, columns = _copySpec(spec, columns)
+  return SqlQuery(TABLE_NAME, spec, QUERY_LIMIT, None, columns)
+
+def _rows(query, numRows):
+  """Random DB-API rows matching the types of the query's select."""
+  rand  = random.Random(numRows)
+  kinds = [query.jsSpec['meta'][name]['type'] for name in query.selectOrder]
+  makers = { 'num':  lambda: rand.choice([rand.randint(0, 10**6), rand.random() * 1000, None])
+           , 'cat':  lambda: 'category{0}'.format(rand.randint(0, 50))
+           , 'date': lambda: 1356998400 + rand.randint(0, 10**8) }
+  return tuple(tuple(makers[kind]() for kind in kinds) for _ in xrange(numRows))
+
+def _csv(numRows, numColumns):
+  rand = random.Random(numRows * numColumns)
+  out  = StringIO()
+  out.write(','.join('Column {0}'.format(i) for i in xrange(numColumns)) + '\n')
+  for _ in xrange(numRows):
+    out.write(','.join(str(rand.randint(0, 10**6)) for _ in xrange(numColumns)) + '\n')
+  format = {'tableName': 'bench', 'types': ['num'] * numColumns}
+  return out.getvalue(), format
+
+def _gaTimeData(numRows, bw):
+  """
+  A GAQuery and the arguments of _formatTimeData for daily visits data, as
+  returned by Google Analytics for the dimensions of bin width `bw`.
+  """
+  timeName = 'ga-web.time'
+  gaDims   = { 'day':   ['date']
+             , 'week':  ['date', 'week']
+             , 'month': ['month', 'year'] }[bw]
+  gaNames     = gaDims + ['visits']
+  headerNames = [timeName] + gaDims[1:] + ['ga-web.visits']
+
+  query = GAQuery.__new__(GAQuery)
+  query.jsSpec = {'meta': {timeName: {'type': 'date', 'bw': bw}}}
+  query.groups = []
+
+  rand, rows = random.Random(numRows), []
+  start = datetime(2005, 1, 1).toordinal()
+  for i in xrange(numRows):
+    day = datetime.fromordinal(start + i)
+    values = { 'date':  day.strftime('%Y%m%d')
+             , 'week':  day.strftime('%U')
+             , 'month': day.strftime('%m')
+             , 'year':  day.strftime('%Y') }
+    rows.append([values[dim] for dim in gaDims] + [str(rand.randint(0, 1000))])
+  realNameDict = {'visits': 'ga-web.visits'}
+  return query, (gaNames, headerNames, realNameDict, rows)
+
+#### Measurement and reporting
+
+def _measure(fn, arg, minRounds, maxTime):
+  """
+  Times `fn(arg)` for at least `minRounds` rounds, starting no new round after
+  `maxTime` seconds. Garbage collection is disabled while timing.
+
+  Returns:
+    A dictionary of statistics, in seconds.
+  """
+  timings = []
+  startTime = time()
+  gcEnabled = gc.isenabled()
+  gc.disable()
+  try:
+    while len(timings) < minRounds or time() - startTime < maxTime:
+      before = time()
+      fn(arg)
+      timings.append(time() - before)
+  finally:
+    if gcEnabled:
+      gc.enable()
+
+  timings.sort()
+  rounds = len(timings)
+  mean   = sum(timings) / rounds
+  stddev = math.sqrt(sum((t - mean) ** 2 for t in timings) / (rounds - 1)) if rounds > 1 else 0.0
+  middle = rounds // 2
+  median = timings[middle] if rounds % 2 else (timings[middle - 1] + timings[middle]) / 2
+  return { 'min':    timings[0]
+         , 'max':    timings[-1]
+         , 'mean':   mean
+         , 'stddev': stddev
+         , 'median': median
+         , 'rounds': rounds
+         , 'total':  sum(timings)
+         , 'ops':    1 / mean if mean else 0.0 }
+
+def _benchName(group, params):
+  return '{0}[{1}]'.format(
+    group, '-'.join('{0}={1}'.format(k, params[k]) for k in sorted(params)))
+
+def _formatTable(results, baseline=None):
+  """Formats results as a table like pytest-benchmark's, in milliseconds."""
+  columns = ['min', 'max', 'mean', 'stddev', 'median']
+  width   = max([len(r['name']) for r in results] + [len('Name (time in ms)')])
+  header  = 'Name (time in ms)'.ljust(width) + ''.join(c.capitalize().rjust(12) for c in columns)
+  header += 'Rounds'.rjust(8)
+  if baseline is not None:
+    header += 'vs. baseline'.rjust(14)
+  title  = ' benchmark: {0} tests '.format(len(results))
+  lines  = [title.center(len(header), '-'), header, '-' * len(header)]
+  for result in results:
+    stats = result['stats']
+    line  = result['name'].ljust(width)
+    line += ''.join('{0:12.4f}'.format(stats[c] * 1000) for c in columns)
+    line += '{0:8d}'.format(stats['rounds'])
+    if baseline is not None:
+      old = baseline.get(result['name'])
+      line += ('{0:13.2f}x'.format(stats['mean'] / old['mean']) if old else 'n/a'.rjust(14))
+    lines.append(line)
+  lines.append('-' * len(header))
+  return '\n'.join(lines)
+
+def _report(results):
+  """The results in the JSON format of pytest-benchmark."""
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return { 'machine_info': { 'node':           platform.node()
+                           , 'machine':        platform.machine()
+                           , 'python_version': platform.python_version()
+                           , 'system':         platform.system() }
+         , 'commit_info':  {'id': commit}
+         , 'datetime':     datetime.utcnow().isoformat()
+         , 'benchmarks':   results }
+
+def _parseInts(value):
+  return [int(part) for part in value.split(',') if part.strip()]
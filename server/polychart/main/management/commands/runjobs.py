@@ -0,0 +1,35 @@
+"""
+Runs queued jobs (see polychart.main.utils.jobs) in a process of its own, e.g.
+when web processes do not run them (JOB_RUN_IN_WEB = False). The worker processes
+cleaning CSV uploads are forked first, before any thread starts (see csvJobs):
+
+  python manage.py runjobs
+  python manage.py runjobs --workers 8
+"""
+import time
+
+from django.conf                 import settings
+from django.core.management.base import BaseCommand
+from optparse                    import make_option
+
+from polychart.main.utils.csvJobs import startPool
+from polychart.main.utils.jobs    import startWorkers
+
+class Command(BaseCommand):
+  help = 'Runs queued background jobs until interrupted.'
+  option_list = BaseCommand.option_list + (
+    make_option('--workers', type='int', default=None,
+      help='Number of worker threads [default: JOB_WORKERS]'),
+  )
+
+  def handle(self, *args, **options):
+    if options['workers']:
+      settings.JOB_WORKERS = options['workers']
+    startPool()
+    startWorkers()
+    self.stdout.write('Running jobs with {0} workers\n'.format(settings.JOB_WORKERS))
+    try:
+      while True:
+        time.sleep(60)
+    except KeyboardInterrupt:
+      pass
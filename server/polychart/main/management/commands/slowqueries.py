@@ -0,0 +1,160 @@
+"""
+Summarizes the slow query log, grouping queries by their fingerprint (see
+polychartQuery.slowQuery) and listing the top offenders by total time:
+
+  python manage.py slowqueries
+  python manage.py slowqueries --since 24 --data-source abc123 --plans
+"""
+import json
+
+from django.conf                 import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse                    import make_option
+from time                        import time
+
+SORT_KEYS = ['total', 'count', 'mean', 'max', 'rows']
+SQL_WIDTH = 100 # characters of SQL shown per query, unless --full-sql
+
+class Command(BaseCommand):
+  help = 'Lists the queries in the slow query log taking the most time.'
+  option_list = BaseCommand.option_list + (
+    make_option('--log', default=None,
+      help='Slow query log file(s), comma separated [default: SLOW_QUERY_LOG]'),
+    make_option('--top', type='int', default=20,
+      help='Number of queries to list [default: %default]'),
+    make_option('--sort', default='total', choices=SORT_KEYS,
+      help='One of {0} [default: %default]'.format(', '.join(SORT_KEYS))),
+    make_option('--since', type='float', default=None,
+      help='Only consider queries logged in the last this many hours'),
+    make_option('--data-source', default=None,
+      help='Only consider queries to the data source with this key'),
+    make_option('--plans', action='store_true', default=False,
+      help='Show the latest recorded EXPLAIN plan of each query'),
+    make_option('--full-sql', action='store_true', default=False,
+      help='Do not truncate SQL'),
+    make_option('--json', action='store_true', default=False,
+      help='Output the summary as JSON'),
+  )
+
+  def handle(self, *args, **options):
+    paths  = (options['log'] or settings.SLOW_QUERY_LOG).split(',')
+    since  = time() - options['since'] * 3600 if options['since'] is not None else None
+    groups = {}
+    for entry in _readEntries(paths):
+      if since is not None and entry['time'] < since:
+        continue
+      if options['data_source'] and entry.get('dsKey') != options['data_source']:
+        continue
+      _addEntry(groups, entry)
+
+    top = sorted(groups.values(), key=lambda g: _sortValue(g, options['sort']),
+                 reverse=True)[:options['top']]
+    if options['json']:
+      self.stdout.write(json.dumps([_summary(g) for g in top], indent=2))
+      return
+    if not top:
+      self.stdout.write('No slow queries logged.')
+      return
+    for rank, group in enumerate(top, 1):
+      self.stdout.write(_formatGroup(rank, group, options['plans'], options['full_sql']))
+
+#### Helper functions
+
+def _readEntries(paths):
+  """Generator of the entries in slow query log files; bad lines are skipped."""
+  for path in paths:
+    try:
+      logFile = open(path)
+    except IOError as err:
+      raise CommandError('Cannot read slow query log: {0}'.format(err))
+    with logFile:
+      for line in logFile:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        if isinstance(entry, dict) and 'fingerprint' in entry:
+          yield entry
+
+def _addEntry(groups, entry):
+  """Adds a log entry to the statistics of its fingerprint."""
+  group = groups.get(entry['fingerprint'])
+  if group is None:
+    group = groups[entry['fingerprint']] = {
+      'fingerprint': entry['fingerprint']
+    , 'sql':         entry['sql']
+    , 'count':       0
+    , 'total':       0.0
+    , 'max':         0.0
+    , 'rows':        0
+    , 'dataSources': set()
+    , 'origins':     {}
+    , 'lastSeen':    0
+    , 'plan':        None
+    }
+  seconds = entry['seconds']
+  group['count'] += 1
+  group['total'] += seconds
+  group['max']    = max(group['max'], seconds)
+  group['rows']  += entry.get('rows') or 0
+  if entry.get('dsKey'):
+    group['dataSources'].add(entry['dsKey'])
+  origin = _formatOrigin(entry.get('origin'))
+  if origin:
+    group['origins'][origin] = group['origins'].get(origin, 0) + 1
+  if entry['time'] >= group['lastSeen']:
+    group['lastSeen'] = entry['time']
+    group['plan']     = entry.get('plan') or group['plan']
+
+def _sortValue(group, key):
+  if key == 'mean':
+    return group['total'] / group['count']
+  if key == 'rows':
+    return float(group['rows']) / group['count']
+  return group[key]
+
+def _formatOrigin(origin):
+  """Formats an origin as e.g. 'dashboard=abc chart=2 table=orders'."""
+  if not origin:
+    return None
+  parts = ['{0}={1}'.format(key, origin[key])
+             for key in ('dashboard', 'chart', 'table') if origin.get(key) is not None]
+  return ' '.join(parts) or None
+
+def _summary(group):
+  """Returns a JSON serializable summary of a group."""
+  return { 'fingerprint': group['fingerprint']
+         , 'sql':         group['sql']
+         , 'count':       group['count']
+         , 'total':       group['total']
+         , 'mean':        group['total'] / group['count']
+         , 'max':         group['max']
+         , 'meanRows':    float(group['rows']) / group['count']
+         , 'dataSources': sorted(group['dataSources'])
+         , 'origins':     group['origins']
+         , 'lastSeen':    group['lastSeen']
+         , 'plan':        group['plan']
+         }
+
+def _formatGroup(rank, group, showPlan, fullSql):
+  """Formats a group for the terminal."""
+  summary = _summary(group)
+  sql     = summary['sql']
+  if not fullSql and len(sql) > SQL_WIDTH:
+    sql = sql[:SQL_WIDTH - 3] + '...'
+  lines = [
+    '#{0} [{1}] total {2:.2f}s, {3} queries, mean {4:.3f}s, max {5:.3f}s, mean rows {6:.0f}'
+      .format(rank, summary['fingerprint'], summary['total'], summary['count'],
+              summary['mean'], summary['max'], summary['meanRows'])
+  , '  ' + sql
+  ]
+  if summary['dataSources']:
+    lines.append('  data sources: ' + ', '.join(summary['dataSources']))
+  origins = sorted(summary['origins'].iteritems(), key=lambda (_, n): -n)
+  for origin, count in origins[:5]:
+    lines.append('  from {0} ({1}x)'.format(origin, count))
+  if showPlan and summary['plan']:
+    lines.append('  plan:')
+    for row in summary['plan']:
+      lines.append('    ' + ' | '.join(unicode(v) for v in row))
+  return '\n'.join(lines) + '\n'
@@ -7,6 +7,7 @@ import django.utils.timezone
 import hashlib
 import hmac
 import os
+import shutil
 import urllib
 
 from base64                     import urlsafe_b64encode
@@ -15,6 +16,8 @@ from django.contrib.auth.models import User
 from django.core.exceptions     import ValidationError
 from django.db                  import models as m
 from django.db.models           import Q
+from django.db.models.signals   import post_delete
+from django.dispatch            import receiver
 from jsonfield                  import JSONField
 
 from polychartQuery.csv               import Connection as CsvDsConn
@@ -249,7 +252,8 @@ class DataSource(m.Model):
     elif self.type == 'googleAnalytics':
       return GoogleAnalyticsDsConn(**dsArgs)
     elif self.type == 'csv':
-      return CsvDsConn(**dsArgs)
+      lds = LocalDataSource.objects.get(datasource=self)
+      return CsvDsConn(path=lds.storagePath())
     else:
       raise Exception('Unknown data source type: %s' % self.type)
 
@@ -265,12 +269,44 @@ class PendingDataSource(m.Model):
 
 class LocalDataSource(m.Model):
   """
-  A data source from a file that a user has uploaded
+  A data source from a file that a user has uploaded. The data is stored on
+  disk, column-wise (see polychartQuery.csv.storage), and `json` holds
+    {'path': <directory of the data set>, 'tables': [table names...],
+     'version': <changed whenever rows are appended>}
+  The directory is removed along with the LocalDataSource, including when its
+  DataSource or PendingDataSource is deleted.
+
+  Data sources uploaded earlier kept their data inline in `json`; migration
+  0007_move_local_data_to_disk moved them to disk.
   """
   datasource = m.ForeignKey(DataSource, unique=True, null=True)
   pendingdatasource = m.ForeignKey(PendingDataSource, unique=True, null=True)
   json = JSONField(null=True)
 
+  def storagePath(self):
+    """Returns the directory of the data set."""
+    return self.json['path']
+
+  def version(self):
+    """Returns a string which changes whenever rows are appended to the data."""
+    return self.json.get('version', '') if isinstance(self.json, dict) else ''
+
+  def bumpVersion(self):
+    self.json['version'] = randomCode()
+    self.save()
+
+  def tableNames(self):
+    return list(self.json['tables'])
+
+@receiver(post_delete, sender=LocalDataSource)
+def _deleteLocalData(sender, instance, **kwargs):
+  """Removes the data set of a deleted LocalDataSource from disk."""
+  # pylint: disable = W0613
+  # W0613: Signal receivers are passed arguments they do not need
+  path = instance.json.get('path') if isinstance(instance.json, dict) else None
+  if path:
+    shutil.rmtree(path, ignore_errors=True)
+
 class Dashboard(m.Model):
   """
   A dashboard that a user has created using the Dashboard Builder (dbb).
@@ -304,6 +340,40 @@ class TutorialCompletion(m.Model):
     ]
   )
 
+class Job(m.Model):
+  """
+  A long running operation, e.g. cleaning an upload or exporting a dashboard,
+  queued by a request and run in the background by polychart.main.utils.jobs.
+  The client polls it by key. The job runs with the session which queued it,
+  so no secrets are stored here.
+  """
+  key = m.CharField(unique=True, max_length=128, default=randomCode) # used on client-side
+  user = m.ForeignKey(User, null=True)
+  session_key = m.CharField(max_length=40, null=True)
+  type = m.CharField(max_length=32)
+  params_json = JSONField()
+  state = m.CharField(
+    max_length=16,
+    default='queued',
+    db_index=True,
+    choices=[
+      ('queued', 'Queued'),
+      ('running', 'Running'),
+      ('success', 'Succeeded'),
+      ('error', 'Failed')
+    ]
+  )
+  progress = m.FloatField(default=0)
+  result_json = JSONField(null=True)
+  error = m.TextField(null=True)
+  attempts = m.IntegerField(default=0)
+  max_attempts = m.IntegerField(default=1)
+  run_after = m.DateTimeField(default=django.utils.timezone.now) # for retries
+  worker = m.CharField(max_length=64, null=True)
+  heartbeat = m.DateTimeField(null=True)
+  created = m.DateTimeField(auto_now_add=True, default=django.utils.timezone.now)
+  finished = m.DateTimeField(null=True)
+
 """
 Querying methods
 """
@@ -0,0 +1,9 @@
+"""
+Tests of polychart.main, run by Django's test runner from `/server/`:
+
+  python ../manage.py test main
+"""
+from polychart.main.tests.testCsvAppend import *
+from polychart.main.tests.testLocalDataSource import *
+from polychart.main.tests.testRawUpload import *
+from polychart.main.tests.testResultCache import *
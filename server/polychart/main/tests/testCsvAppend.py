@@ -0,0 +1,94 @@
+"""
+Tests of appending uploaded CSV files to a stored table (see utils.csvParser
+and polychartQuery.csv.storage): the table is reopened after each append, as
+queries see it.
+"""
+import os
+import shutil
+import tempfile
+
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from polychart.main.utils.csvParser import appendCsv, ingestCsv
+from polychartQuery.csv.storage     import Table
+
+FORMAT = {'tableName': 'sales'}
+
+INGESTED = ( "name,amount,day\n"
+             "a,1,2014-01-05\n"
+             "b,,2014-01-06\n" )
+
+APPENDED = ( "name,amount,day\n"
+             "c,5,2014-02-01\n"
+             "a,-2,\n" )
+
+JAN_5, JAN_6, FEB_1 = 1388880000, 1388966400, 1391212800
+
+class CsvAppendTest(TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    ingestCsv(StringIO(INGESTED), FORMAT, self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def assertUnchanged(self):
+    table = Table(self.path)
+    self.assertEqual(table.numRows, 2)
+    self.assertEqual(table.values('name'), ['a', 'b'])
+    self.assertEqual(table.values('amount'), [1, None])
+    self.assertEqual(table.pool('name'), ['a', 'b'])
+
+  def testAppend(self):
+    self.assertEqual(appendCsv(StringIO(APPENDED), FORMAT, self.path), 2)
+    table = Table(self.path)
+    self.assertEqual(table.columns, [('name', 'cat'), ('amount', 'num'), ('day', 'date')])
+    self.assertEqual(table.numRows, 4)
+    self.assertEqual(table.values('name'), ['a', 'b', 'c', 'a'])
+    self.assertEqual(table.values('amount'), [1, None, 5, -2])
+    self.assertEqual(table.values('day'), [JAN_5, JAN_6, FEB_1, None])
+
+  def testStats(self):
+    appendCsv(StringIO(APPENDED), FORMAT, self.path)
+    table = Table(self.path)
+    self.assertEqual(table.stats('name'), {'nulls': 0, 'distinct': 3, 'values': ['a', 'b', 'c']})
+    self.assertEqual(table.stats('amount'), {'nulls': 1, 'distinct': 3, 'min': -2, 'max': 5})
+    self.assertEqual(table.stats('day'), {'nulls': 1, 'distinct': 3, 'min': JAN_5, 'max': FEB_1})
+
+  def testPoolExtension(self):
+    codes, _ = Table(self.path).codes('name')
+    appendCsv(StringIO(APPENDED), FORMAT, self.path)
+    appendCsv(StringIO("name,amount,day\nd,0,2014-03-01\nb,0,2014-03-01\n"), FORMAT, self.path)
+    table = Table(self.path)
+    self.assertEqual(table.pool('name'), ['a', 'b', 'c', 'd']) # existing values keep their codes
+    self.assertEqual(list(table.codes('name')[0]), list(codes) + [2, 0, 3, 1])
+
+  def testTypeMismatch(self):
+    mismatched = StringIO("name,amount,day\nc,many,2014-02-01\n")
+    self.assertRaisesRegexp(ValueError, 'amount has cat values', appendCsv, mismatched, FORMAT, self.path)
+    self.assertUnchanged()
+
+  def testColumnMismatch(self):
+    renamed = StringIO("name,total,day\nc,5,2014-02-01\n")
+    self.assertRaisesRegexp(ValueError, 'named total', appendCsv, renamed, FORMAT, self.path)
+    wide = StringIO("name,amount,day,extra\nc,5,2014-02-01,x\n")
+    self.assertRaisesRegexp(ValueError, 'has 4 columns', appendCsv, wide, FORMAT, self.path)
+    self.assertUnchanged()
+
+  def testHalfFinishedAppend(self):
+    # An append which wrote past the end of the column files, but never its manifest
+    for name in os.listdir(self.path):
+      if name.endswith('.values'):
+        with open(os.path.join(self.path, name), 'ab') as f:
+          f.write('\xff' * 64)
+    self.assertUnchanged()
+
+    appendCsv(StringIO(APPENDED), FORMAT, self.path)
+    table = Table(self.path)
+    self.assertEqual(table.numRows, 4)
+    self.assertEqual(table.values('name'), ['a', 'b', 'c', 'a'])
+    self.assertEqual(table.values('amount'), [1, None, 5, -2])
+    self.assertEqual(os.path.getsize(os.path.join(self.path, '1.values')), 4 * 8) # truncated
@@ -0,0 +1,61 @@
+"""
+Tests that the data sets of uploaded data sources are removed from disk with
+them; see models.LocalDataSource.
+"""
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test                import TestCase
+
+from polychart.main.models      import DataSource, LocalDataSource, PendingDataSource
+from polychartQuery.csv.storage import writeTable
+
+class LocalDataSourceDeleteTest(TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.user = User.objects.create_user('uploader', 'uploader@example.com', 'secret')
+
+  def tearDown(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+  def _dataSet(self, **kwargs):
+    """Helper creating a LocalDataSource with a data set of one table on disk."""
+    path = os.path.join(self.root, 'data')
+    writeTable(os.path.join(path, '0'), 'table', {'a': {'type': 'num'}}, {'a': [1, 2, 3]})
+    lds = LocalDataSource.objects.create(json={'path': path, 'tables': ['table']}, **kwargs)
+    self.assertTrue(os.path.isdir(path))
+    return lds, path
+
+  def testDeleteLocalDataSource(self):
+    lds, path = self._dataSet()
+    lds.delete()
+    self.assertFalse(os.path.exists(path))
+
+  def testDeleteDataSource(self):
+    ds = DataSource.objects.create(user=self.user, name='upload', type='csv')
+    _, path = self._dataSet(datasource=ds)
+    ds.delete()
+    self.assertFalse(os.path.exists(path))
+    self.assertFalse(LocalDataSource.objects.exists())
+
+  def testDeletePendingDataSource(self):
+    pds = PendingDataSource.objects.create(user=self.user, params_json={})
+    _, path = self._dataSet(pendingdatasource=pds)
+    pds.delete()
+    self.assertFalse(os.path.exists(path))
+
+  def testDeletePendingVersionKeepsDataSet(self):
+    ds  = DataSource.objects.create(user=self.user, name='upload', type='csv')
+    pds = PendingDataSource.objects.create(user=self.user, params_json={})
+    _, path = self._dataSet(datasource=ds, pendingdatasource=pds)
+    self.client.login(username='uploader', password='secret')
+    self.client.post('/api/pending-data-source/{0}/delete'.format(pds.key))
+    self.assertFalse(PendingDataSource.objects.exists())
+    self.assertTrue(os.path.isdir(path))
+    self.assertEqual(LocalDataSource.objects.get().datasource, ds)
+
+  def testEmptyLocalDataSource(self):
+    LocalDataSource.objects.create().delete() # not cleaned yet: no data set
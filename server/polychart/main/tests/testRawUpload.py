@@ -0,0 +1,88 @@
+"""
+Tests of storing raw uploaded files a chunk at a time (see utils.rawUpload), in
+a temporary directory.
+"""
+import shutil
+import tempfile
+import zlib
+
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from polychart.main.utils import rawUpload
+from polychart.main.utils.rawUpload import ChunkError, RawUpload
+
+CONTENT = 'name,amount\n' + ''.join('row{0},{0}\n'.format(i) for i in range(100))
+
+class RawUploadTest(TestCase):
+
+  def setUp(self):
+    self.rawRoot = rawUpload.RAW_ROOT
+    rawUpload.RAW_ROOT = tempfile.mkdtemp()
+    self.upload = RawUpload('key', '0', maxSize=4096)
+
+  def tearDown(self):
+    shutil.rmtree(rawUpload.RAW_ROOT)
+    rawUpload.RAW_ROOT = self.rawRoot
+
+  def send(self, start, end, crc32=None, data=None):
+    """Helper sending CONTENT[start:end], or `data` in its place."""
+    data = CONTENT[start:end] if data is None else data
+    return self.upload.append(StringIO(data), start, end - start, crc32)
+
+  def stored(self):
+    with open(self.upload.path, 'rb') as f:
+      return f.read()
+
+  def assertRejected(self, offset, *args, **kwargs):
+    """Helper checking that a chunk is rejected, resuming from `offset`."""
+    with self.assertRaises(ChunkError) as context:
+      self.send(*args, **kwargs)
+    self.assertEqual(context.exception.offset, offset)
+    self.assertEqual(self.upload.size(), offset)
+
+  def testChunks(self):
+    self.assertEqual(self.upload.size(), 0)
+    self.assertEqual(self.send(0, 100), 100)
+    self.assertEqual(self.send(100, 250, zlib.crc32(CONTENT[100:250]) & 0xffffffff), 250)
+    self.assertEqual(self.send(250, len(CONTENT)), len(CONTENT))
+    self.assertEqual(self.stored(), CONTENT)
+
+  def testResume(self):
+    self.send(0, 100)
+    self.send(100, 200)
+    # the client lost the response of the last chunk, and sends it again
+    self.assertEqual(self.send(100, 200), 200)
+    # or resumes from an earlier offset, discarding what is stored past it
+    self.assertEqual(self.send(50, 120), 120)
+    self.assertEqual(self.send(self.upload.size(), len(CONTENT)), len(CONTENT))
+    self.assertEqual(self.stored(), CONTENT)
+
+  def testPastTheEnd(self):
+    self.send(0, 100)
+    self.assertRejected(100, 150, 200)
+
+  def testChecksum(self):
+    self.send(0, 100)
+    self.assertRejected(100, 100, 200, crc32=zlib.crc32(CONTENT[100:201]) & 0xffffffff)
+    self.assertEqual(self.stored(), CONTENT[:100])
+    self.assertEqual(self.send(100, 200, zlib.crc32(CONTENT[100:200]) & 0xffffffff), 200)
+
+  def testShortChunk(self):
+    self.send(0, 100)
+    self.send(100, 200)
+    # a chunk resent from 50, whose request ends early, truncates what it overlapped
+    self.assertRejected(50, 50, 200, data=CONTENT[50:120])
+    self.assertEqual(self.stored(), CONTENT[:50])
+
+  def testTooLarge(self):
+    self.send(0, 100)
+    self.assertRejected(100, 100, 5000, data='')
+
+  def testNegativeOffset(self):
+    self.send(0, 100)
+    with self.assertRaises(ChunkError) as context:
+      self.upload.append(StringIO(CONTENT[:10]), -10, 10)
+    self.assertEqual(context.exception.offset, 100)
+    self.assertEqual(self.stored(), CONTENT[:100])
@@ -0,0 +1,138 @@
+"""
+Tests of the result cache (see utils.resultCache), with a fake connection, on
+the configured cache backend.
+"""
+import os
+import threading
+import time
+import zlib
+
+from django.core.cache import cache
+from django.test       import TestCase
+from django.test.utils import override_settings
+
+from polychart.main.utils import resultCache
+from polychart.main.utils.resultCache import cacheStats, cachedCall
+
+WAIT_SECONDS = 5
+
+class FakeConn(object):
+  """A connection counting its queries, which may be held until released."""
+  dsKey  = 'fake-ds'
+  dsType = 'fake'
+
+  def __init__(self, hold=False):
+    self.calls    = 0
+    self.started  = threading.Event()
+    self.released = threading.Event()
+    if not hold:
+      self.released.set()
+
+  def generateCacheKey(self, methodName, args):
+    return 'testResultCache::{0}::{1!r}'.format(methodName, args)
+
+  def queryTable(self, numRows, payload=''):
+    self.calls += 1
+    self.started.set()
+    self.released.wait(WAIT_SECONDS)
+    return { 'data': [{'a': i, 'b': unicode(i), 'c': payload} for i in range(numRows)]
+           , 'meta': {'a': {'type': 'num'}, 'b': {'type': 'cat'}, 'c': {'type': 'cat'}} }
+
+def waitFor(condition):
+  """Helper polling `condition` until it holds, for up to WAIT_SECONDS."""
+  deadline = time.time() + WAIT_SECONDS
+  while not condition():
+    if time.time() > deadline:
+      return False
+    time.sleep(0.01)
+  return True
+
+class ResultCacheTest(TestCase):
+
+  def setUp(self):
+    cache.clear()
+
+  def _counted(self, name, call):
+    """Helper returning the result of `call`, and by how much it moved a counter."""
+    before = cacheStats()[name]
+    result = call()
+    return result, cacheStats()[name] - before
+
+  def testHit(self):
+    conn = FakeConn()
+    first, misses = self._counted('miss', lambda: cachedCall(conn, 'queryTable', 3))
+    second, hits  = self._counted('hit', lambda: cachedCall(conn, 'queryTable', 3))
+    self.assertEqual((misses, hits, conn.calls), (1, 1, 1))
+    self.assertEqual(first, second)
+    self.assertEqual(second['data'][2], {'a': 2, 'b': u'2', 'c': ''})
+
+  def testArgumentsAreKeys(self):
+    conn = FakeConn()
+    cachedCall(conn, 'queryTable', 3)
+    self.assertEqual(len(cachedCall(conn, 'queryTable', 4)['data']), 4)
+    self.assertEqual(conn.calls, 2)
+
+  @override_settings(QUERY_CACHE_TTL=0)
+  def testStaleRefresh(self):
+    conn  = FakeConn()
+    first = cachedCall(conn, 'queryTable', 3)
+    stale, count = self._counted('stale', lambda: cachedCall(conn, 'queryTable', 3))
+    self.assertEqual(count, 1)
+    self.assertEqual(stale, first) # served at once, while refreshed in the background
+    self.assertTrue(waitFor(lambda: conn.calls == 2))
+    self.assertTrue(waitFor(lambda: cache.get(conn.generateCacheKey('queryTable', (3,)) + '::refresh') is None))
+
+  def testCoalescing(self):
+    conn    = FakeConn(hold=True)
+    results = []
+    def call():
+      results.append(cachedCall(conn, 'queryTable', 3))
+    before  = cacheStats()['coalesced']
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    self.assertTrue(conn.started.wait(WAIT_SECONDS))
+    self.assertTrue(waitFor(lambda: cacheStats()['coalesced'] - before == 2))
+    conn.released.set()
+    for thread in threads:
+      thread.join(WAIT_SECONDS)
+    self.assertEqual(conn.calls, 1)
+    self.assertEqual(len(results), 3)
+    self.assertTrue(all(result == results[0] for result in results))
+
+  @override_settings(QUERY_CACHE_ITEM_LIMIT=256)
+  def testChunkedRoundTrip(self):
+    conn    = FakeConn()
+    payload = os.urandom(64).encode('hex') # does not compress away
+    first   = cachedCall(conn, 'queryTable', 20, payload)
+    entry   = cache.get(conn.generateCacheKey('queryTable', (20, payload)))
+    self.assertNotIn('blob', entry)
+    self.assertGreater(entry['chunks'], 1)
+
+    second, hits = self._counted('hit', lambda: cachedCall(conn, 'queryTable', 20, payload))
+    self.assertEqual((hits, conn.calls), (1, 1))
+    self.assertEqual(second, first)
+
+  @override_settings(QUERY_CACHE_ITEM_LIMIT=256)
+  def testEvictedChunk(self):
+    conn    = FakeConn()
+    payload = os.urandom(64).encode('hex')
+    cachedCall(conn, 'queryTable', 20, payload)
+    cacheKey = conn.generateCacheKey('queryTable', (20, payload))
+    cache.delete(resultCache._chunkKey(cacheKey, cache.get(cacheKey)['token'], 0))
+    cachedCall(conn, 'queryTable', 20, payload)
+    self.assertEqual(conn.calls, 2)
+
+  def testCorruptEntries(self):
+    conn     = FakeConn()
+    cacheKey = conn.generateCacheKey('queryTable', (3,))
+    entries  = [ {'expires': time.time() + 60, 'blob': 'not compressed'}
+               , {'expires': time.time() + 60, 'blob': zlib.compress('not pickled')}
+               , {'expires': time.time() + 60, 'blob': zlib.compress('garbage')[:-4]}
+               , {'expires': time.time() + 60, 'chunks': 2} # no token
+               , 'not an entry' ]
+    for calls, entry in enumerate(entries, 1):
+      cache.set(cacheKey, entry)
+      result = cachedCall(conn, 'queryTable', 3)
+      self.assertEqual((conn.calls, len(result['data'])), (calls, 3))
+      self.assertIn('blob', cache.get(cacheKey)) # replaced by a readable entry
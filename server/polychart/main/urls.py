@@ -31,9 +31,13 @@ urlpatterns = patterns('polychart.main.views',
   url(r'^api/data-source/([^/]+)/tables/list$'    , 'dataSource.tableList'         ),
   url(r'^api/data-source/([^/]+)/tables/meta$'    , 'dataSource.tableMeta'         ),
   url(r'^api/data-source/([^/]+)/tables/query$'   , 'dataSource.tableQuery'        ),
+  url(r'^api/data-source/([^/]+)/tables/batch$'   , 'dataSource.tableBatchQuery'   ),
+  url(r'^api/data-source/cache-stats$'            , 'dataSource.dsCacheStats'      ),
   url(r'^api/data-source/callback$'               , 'dataSource.dsCallback'        ),
   url(r'^api/data-source/create$'                 , 'dataSource.dsCreate'          ),
   url(r'^api/data-source/list$'                   , 'dataSource.dsList'            ),
+  url(r'^api/data-source/metrics$'                , 'dataSource.dsMetrics'         ),
+  url(r'^api/jobs/([^/]+)$'                       , 'jobs.jobPoll'                 ),
   url(r'^api/ssh/file-exists$'                    , 'ssh.sshFileExists'            ),
   url(r'^api/ssh/keygen$'                         , 'ssh.sshKeygen'                ),
   url(r'^api/tutorial/mark-complete$'             , 'tutorial.tutorialComplete'    ),
@@ -41,6 +45,7 @@ urlpatterns = patterns('polychart.main.views',
   # DBB CSV uploads
   url(r'^api/upload/get-key$'                     , 'upload.getKey'                ),
   url(r'^api/upload/upload-file/([^/]+)/([0-9]+)$', 'upload.postFile'              ),
+  url(r'^api/upload/upload-file/([^/]+)/([0-9]+)/status$', 'upload.uploadStatus'  ),
   url(r'^api/upload/preview/csv/([^/]+)/([0-9]+)$', 'upload.previewCsv'            ),
   url(r'^api/upload/clean/csv/([^/]+)$'           , 'upload.cleanCsv'              ),
 
@@ -0,0 +1,192 @@
+"""
+Cleaning of uploaded CSV files, run as a background job (see utils.jobs).
+
+Decoding and typing CSV values is CPU bound, so each file of an upload is
+ingested (see csvParser.ingestCsv) by its own worker process, up to
+CSV_INGEST_WORKERS at a time; the job records the tables in the
+LocalDataSource once all files are done. Rows appended to an existing data set
+(see csvParser.appendCsv) are instead written in order, by the job itself, as
+the tables they are appended to are locked anyway.
+
+Worker processes are forked, and a process forked while other threads run only
+gets the forking thread: any lock held by another thread at the time (e.g. of
+logging, or of a database driver) stays locked in the child, and a worker which
+takes it hangs. The pool is thus best started before any thread, with startPool;
+`python manage.py runjobs` does so, and is the safer way to run 'cleanCsv' jobs.
+Web processes (JOB_RUN_IN_WEB) start it on first use, when their threads are
+already running. Either way, a file taking over CSV_INGEST_TIMEOUT seconds fails
+its job, and the pool, whose workers may be stuck, is torn down; jobs waiting
+for other files on it fail at once, and may be retried on a new pool. Workers are
+not recycled after a number of tasks (maxtasksperchild), as replacing them
+would fork from the threaded process again.
+
+Exported:
+  cleanUpload: The handler of 'cleanCsv' jobs.
+  startPool: Starts the worker processes.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+
+from django.conf     import settings
+from multiprocessing import Pool
+
+from polychart.main.models          import LocalDataSource
+from polychart.main.utils.csvParser import appendCsv, ingestCsv
+from polychart.main.utils.jobs      import JobError
+from polychart.main.utils.rawUpload import rawPath
+from polychartQuery.csv.storage     import openTables
+
+logger = logging.getLogger(__name__)
+
+#
+# Public Functions
+#
+
+def cleanUpload(context, params):
+  """
+  Ingests the raw files of an upload into the data set of its
+  LocalDataSource, replacing any previous version of it, or appends them to it.
+
+  Args:
+    context: The jobs.JobContext.
+    params: A dictionary with keys
+      key: The key of the PendingDataSource the files were uploaded to.
+      tables: A list of parsing configurations, one per file; see csvParser.
+      mode: 'append' to append to the data set, or else 'replace'.
+
+  Returns:
+    For 'replace', a dictionary {tables: [table names...]}; for 'append',
+    {appended: [numbers of rows appended...]}.
+
+  Raises:
+    JobError: Thrown when a file can not be ingested or appended, takes over
+      CSV_INGEST_TIMEOUT seconds to ingest, or its pool is torn down as another
+      file timed out.
+  """
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  key     = str(params['key'])
+  formats = params['tables']
+  lds     = LocalDataSource.objects.get(pendingdatasource__key=key)
+  sizes   = [_fileSize(rawPath(key, index)) for index in range(len(formats))]
+
+  if params.get('mode') == 'append':
+    return _appendUpload(context, key, lds, formats, sizes)
+
+  path = os.path.join(settings.LOCAL_DATA_ROOT, key)
+  if os.path.isdir(path): # cleaning again, e.g. with other types
+    shutil.rmtree(path)
+
+  pool    = startPool()
+  pending = [ pool.apply_async(_ingest, (rawPath(key, index), format, os.path.join(path, str(index))))
+                for index, format in enumerate(formats) ]
+  names, done = [], 0
+  for index, result in enumerate(pending):
+    ok, name = _wait(pool, result, index)
+    if not ok:
+      raise JobError(name)
+    names.append(name)
+    done += sizes[index]
+    context.progress(done / float(sum(sizes) or 1))
+
+  previous = lds.json.get('path') if isinstance(lds.json, dict) else None
+  lds.json = {'path': path, 'tables': names}
+  lds.save()
+  if previous and previous != path: # the version replaced, uploaded to another key
+    shutil.rmtree(previous, ignore_errors=True)
+  return {'tables': names}
+
+def startPool():
+  """
+  Starts the CSV_INGEST_WORKERS worker processes of this process, unless they
+  are running; see the module docstring as to when to call it.
+
+  Returns:
+    The multiprocessing.Pool.
+  """
+  with _POOL_LOCK:
+    if not _POOL:
+      _POOL.append(Pool(settings.CSV_INGEST_WORKERS))
+    return _POOL[0]
+
+#
+# Private Functions
+#
+
+_POOL      = []
+_POOL_LOCK = threading.Lock()
+WAIT_STEP  = 1.0 # seconds between checks that the pool waited on is still up
+
+def _wait(pool, result, index):
+  """
+  Helper waiting for the result of ingesting the `index`-th file of an upload
+  on `pool`. Results of a pool which was stopped are never set, so this waits a
+  step at a time, and fails as soon as the pool is no longer the current one.
+  """
+  deadline = time.time() + settings.CSV_INGEST_TIMEOUT
+  while not result.ready():
+    if pool not in _POOL:
+      raise JobError('Cleaning file {0} was interrupted, please try again'.format(index + 1))
+    if time.time() > deadline:
+      _stopPool(pool)
+      raise JobError('Timed out cleaning file {0}'.format(index + 1))
+    result.wait(min(WAIT_STEP, max(deadline - time.time(), 0)))
+  return result.get()
+
+def _stopPool(pool):
+  """
+  Helper killing the workers of a pool which timed out, so that the next job
+  starts a new one; jobs waiting on it fail, see _wait.
+  """
+  with _POOL_LOCK:
+    if pool in _POOL:
+      _POOL.remove(pool)
+  pool.terminate()
+
+def _ingest(rawFile, format, tablePath):
+  """
+  Runs in a worker process: ingests a file, returning a pair of whether it
+  succeeded, and the table name or error message.
+  """
+  try:
+    with open(rawFile, 'rU') as f:
+      return True, ingestCsv(f, format, tablePath)
+  except Exception as e:
+    logger.exception('Ingesting %s failed', rawFile)
+    return False, unicode(e) or e.__class__.__name__
+
+def _appendUpload(context, key, lds, formats, sizes):
+  """
+  Helper for cleanUpload, appending uploaded files to the tables of a data set:
+  that with the same name as the file's, or else the same index.
+  """
+  if lds.datasource is None:
+    raise JobError('There is no data set to append to')
+
+  tables = openTables(lds.storagePath()).values()
+  byName = {table.name: table for table in tables}
+  counts = []
+  try:
+    for index, format in enumerate(formats):
+      table = byName.get(format.get('tableName')) or (tables[index] if index < len(tables) else None)
+      if table is None:
+        raise JobError('No table to append file %s to' % (index + 1))
+      try:
+        with open(rawPath(key, index), 'rU') as f:
+          counts.append(appendCsv(f, format, table.path))
+      except ValueError as e:
+        raise JobError(unicode(e))
+      context.progress(sum(sizes[:index + 1]) / float(sum(sizes) or 1))
+  finally:
+    if counts: # some files were appended
+      lds.bumpVersion()
+  return {'appended': counts}
+
+def _fileSize(path):
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
@@ -3,57 +3,132 @@ Authors: Jeeyoung Kim, Luc Ritchie
 Code to parse CSV files from the user.
 """
 import csv
+import random
 import re
 
-from itertools import chain, ifilter, islice, izip, izip_longest
+from itertools import ifilter, islice
+
+from polychartQuery.csv.storage import Table, TableAppender, TableWriter, tableLock
+from polychartQuery.csv.values  import inferType
+
+SAMPLE_SIZE       = 1000            # rows sampled to infer the types of columns
+PREVIEW_ROWS      = 100             # rows shown by parseForPreview
+PREVIEW_MAX_BYTES = 4 * 1024 * 1024 # bytes of the file read by parseForPreview
 
 def parseForPreview(stream, format):
   """
-  Parses the CSV file and formats it for previewing via Slickgrid
+  Parses the start of the CSV file and formats it for previewing via
+  Slickgrid. At most PREVIEW_MAX_BYTES, and SAMPLE_SIZE rows, are read, so a
+  preview takes as long whatever the size of the file: the first PREVIEW_ROWS
+  rows are shown, and the width and types of the columns are found from all the
+  rows read. ingestCsv infers types from a sample of the whole file instead, so
+  a column whose values change type further down may be typed differently.
   """
-  rows, header = parse(stream, format)
+  prefix = _Prefix(stream, PREVIEW_MAX_BYTES)
+  rows, headerRow = readRows(prefix, format)
+  rows = list(islice(rows, SAMPLE_SIZE))
+  if prefix.truncated and len(rows) < SAMPLE_SIZE: # the last row may be cut
+    rows = rows[:-1]
+
+  width  = max([len(headerRow)] + [len(row) for row in rows])
+  names  = Header(headerRow, format.get('columnNames'))
+  header = [names[i] for i in xrange(width)]
+  types  = [colType for colType, _ in inferTypes(rows, width)]
 
   # Translate from [['foo', 'bar', 'baz'], ['ping', 'pong', 'pang']] into
   # [
   #   {'col1': 'foo',  'col2': 'bar',  'col3': 'baz'},
   #   {'col1': 'ping', 'col2': 'pong', 'col3': 'pang'}
   # ]
-  rows = [{x: y for (x, y) in zip(header, row)} for row in rows[0:100]]
+  rows = [ {name: row[i] if i < len(row) else u'' for i, name in enumerate(header)}
+             for row in rows[:PREVIEW_ROWS] ]
 
   return {
     'status': 'success',
     'rows'  : rows,
-    'header': header
+    'header': header,
+    'types' : types
   }
 
-def parseForPolychart(stream, format):
+def ingestCsv(stream, format, path):
   """
-  Parses the CSV file and formats it for PolychartJS
+  Parses the CSV file and stores it column-wise in the directory `path`, typed
+  according to format['types']; see polychartQuery.csv.storage. Columns
+  without a type there are typed by inferTypes, from a sample of the rows.
+
+  The file is read twice, to sample it and to store it; the second time, each
+  row goes straight into the column builders, so memory use is that of the
+  stored columns. Columns found past the width of the header are added as they
+  appear.
+
+  Returns:
+    The name of the table.
+  """
+  start = stream.tell()
+  rows, headerRow = readRows(stream, format)
+  inferred = inferTypes(sampleRows(rows))
+  stream.seek(start)
+
+  rows, headerRow = readRows(stream, format)
+  types   = format.get('types') or []
+  names   = Header(headerRow, format.get('columnNames'))
+  writer  = TableWriter(path, format['tableName'], [], fill=u'')
+  def widen(width):
+    for i in xrange(len(writer.columns), width):
+      colType, dateFormat = inferred[i] if i < len(inferred) else ('cat', None)
+      if i < len(types) and types[i]:
+        colType = types[i]
+      writer.addColumn(names[i], colType, dateFormat)
+
+  widen(len(headerRow))
+  for row in rows:
+    if len(row) > len(writer.columns):
+      widen(len(row))
+    writer.append(row)
+  writer.close()
+  return format['tableName']
+
+def appendCsv(stream, format, path):
   """
-  rows, header = parse(stream, format)
+  Parses the CSV file and appends its rows to the table stored in the
+  directory `path`. The file must have the columns of the table, in order; a
+  header row, if any, must name them the same, and columns typed 'num' or
+  'date' in the table must have values of that type, judging from a sample.
 
-  # Translate from [['foo', 'bar', 'baz'], ['ping', 'pong', 'pang']] into
-  # {
-  #   'col1': ['foo', 'ping'],
-  #   'col2': ['bar', 'pong'],
-  #   'col3': ['baz', 'pang']
-  # }
-  cols = zip(*rows) #transpose
-  data = {y: cols[x] for x, y in enumerate(header)}
-
-  # Translate header from ['col1', 'col2', 'col3'] into
-  # {
-  #   'col1': {type: 'cat'},
-  #   'col2': {type: 'cat'},
-  #   'col3': {type: 'cat'}
-  # }
-  header = {x: {'type': y} for (x, y) in izip(header, format['types'])}
+  Returns:
+    The number of rows appended.
 
-  return {
-    'name': format['tableName'],
-    'data': data,
-    'meta': header
-  }
+  Raises:
+    ValueError: Thrown when the file does not match the table.
+  """
+  with tableLock(path):
+    return _appendRows(stream, format, Table(path))
+
+def sampleRows(rows, size=SAMPLE_SIZE):
+  """
+  Returns a uniform random sample of `size` rows from an iterable, read once;
+  the same rows each time for the same input.
+  """
+  rand   = random.Random(0)
+  sample = []
+  for i, row in enumerate(rows):
+    if i < size:
+      sample.append(row)
+    else:
+      j = rand.randint(0, i)
+      if j < size:
+        sample[j] = row
+  return sample
+
+def inferTypes(rows, width=None):
+  """
+  Infers the types of the columns of some rows; see values.inferType.
+  Returns a list of (type, date format) pairs, one per column, for `width`
+  columns or as many as the widest row has.
+  """
+  if width is None:
+    width = max([0] + [len(row) for row in rows])
+  return [inferType([row[i] for row in rows if i < len(row)]) for i in xrange(width)]
 
 def unicodeCsvReader(csvReader):
   """
@@ -62,50 +137,98 @@ def unicodeCsvReader(csvReader):
   for row in csvReader:
     yield [unicode(cell, 'utf-8', 'ignore') for cell in row]
 
-def parse(stream, format):
+def readRows(stream, format):
   """
-  Parses the CSV file coming from the given stream.
-  Returns a tuple of 2 lists: rows, header
+  Reads the CSV file coming from the given stream, lazily.
+  Returns a tuple: an iterator of the non-blank data rows, as lists of unicode
+  strings of varying lengths, and the header row ([] if there is none).
   stream - input stream.
   """
-
   def getFormatArg(argName, defVal):
     return format[argName] if argName in format else defVal
   delimiter   = getFormatArg('delimiter',   ',')
   hasHeader   = getFormatArg('hasHeader',   True)
   rowsToKeep  = getFormatArg('rowsToKeep',  None)
-  columnNames = getFormatArg('columnNames', None) or []
 
   raw_reader = csv.reader(stream, delimiter=str(delimiter))
-  reader = unicodeCsvReader(raw_reader)
+  rows = unicodeCsvReader(raw_reader)
 
-  # If no header is present, prepend an empty header which we'll fill in later
-  if not hasHeader:
-    reader = chain([[]], reader)
+  header = (next(rows, None) or []) if hasHeader else []
 
   # Slice off only as many rows as needed
   if rowsToKeep:
-    # Add one to keep the first row as a header
-    rows = islice(reader, int(rowsToKeep) + 1)
-  else:
-    rows = reader
-
-  # Widen all rows to be as long as the longest one
-  # This uses izip(*) magic to transpose
-  # It also ensures that rows is a generator, which simplifies taking the header
-  cols = izip_longest(*rows, fillvalue='')
-  rows = izip(*cols)
-
-  header = []
-  for i, name in enumerate(rows.next()):
-    if i < len(columnNames):
-      name = columnNames[i] or name
-    if name:
-      header.append(name)
-    else:
-      header.append('Column_%s' % (i + 1))
+    rows = islice(rows, int(rowsToKeep))
 
   # Remove blank rows
-  rows = ifilter(any, rows)
+  return ifilter(any, rows), header
 
-  return list(rows), header
+class Header(object):
+  """
+  The names of the columns of a CSV file, by index: those given by the user,
+  else those of the header row, else 'Column_<i+1>'.
+  """
+  def __init__(self, headerRow, columnNames=None):
+    self.headerRow   = headerRow
+    self.columnNames = columnNames or []
+
+  def __getitem__(self, i):
+    name = self.columnNames[i] if i < len(self.columnNames) else None
+    if not name and i < len(self.headerRow):
+      name = self.headerRow[i]
+    return name or 'Column_%s' % (i + 1)
+
+class _Prefix(object):
+  """
+  An iterator of the lines of the first `maxBytes` of a stream, for csv.reader;
+  `truncated` tells whether the stream was cut short, maybe within a line.
+  """
+  def __init__(self, stream, maxBytes):
+    self.stream    = stream
+    self.remaining = maxBytes
+    self.truncated = False
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self.remaining <= 0:
+      self.truncated = bool(self.stream.read(1))
+      raise StopIteration
+    line = self.stream.readline(self.remaining)
+    if not line:
+      raise StopIteration
+    self.remaining -= len(line)
+    return line
+
+def _appendRows(stream, format, table):
+  """Helper for appendCsv, once the table is locked."""
+  start = stream.tell()
+  rows, headerRow = readRows(stream, format)
+  sample = sampleRows(rows)
+  stream.seek(start)
+
+  names = Header(headerRow, format.get('columnNames'))
+  width = max([len(headerRow)] + [len(row) for row in sample])
+  if width > len(table.columns):
+    raise ValueError("The file has {0} columns, but table {1} has {2}"
+                     .format(width, table.name, len(table.columns)))
+  for i, (colType, _) in enumerate(inferTypes(sample, width)):
+    name, storedType = table.columns[i]
+    if headerRow and names[i] != name:
+      raise ValueError(u"Column {0} is named {1}, but {2} in table {3}"
+                       .format(i + 1, names[i], name, table.name))
+    hasValues = any(i < len(row) and row[i].strip() for row in sample)
+    if storedType != 'cat' and hasValues and colType != storedType:
+      raise ValueError(u"Column {0} has {1} values, but is {2} in table {3}"
+                       .format(name, colType, storedType, table.name))
+
+  # Nothing is written before close, so a bad row leaves the table as it was
+  rows, _ = readRows(stream, format)
+  writer  = TableAppender(table, fill=u'')
+  for row in rows:
+    if len(row) > len(table.columns):
+      raise ValueError("A row has {0} values, but table {1} has {2} columns"
+                       .format(len(row), table.name, len(table.columns)))
+    writer.append(row)
+  writer.close()
+  return writer.numRows
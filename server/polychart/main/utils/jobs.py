@@ -0,0 +1,314 @@
+"""
+A queue of long running operations, stored in the database and run by worker
+threads in the background.
+
+A request queues a Job, returns its status at once, and the client polls it
+(see views.jobs) until it succeeds or fails. Jobs are run by JOB_WORKERS threads
+in each process which runs workers: web processes, unless JOB_RUN_IN_WEB is
+False, and `python manage.py runjobs`. Processes claim queued jobs with an
+atomic update, so any number of them may share the queue.
+
+A job runs as the user, and with the session, of the request which queued it;
+secrets such as the secure storage key are thus read from the session store, as
+requests do, and never copied into the queue. Handlers are listed in JOB_TYPES,
+and are called with a JobContext and the parameters of the job. A handler
+returns the JSON-serializable result of the job, or raises: JobError for
+failures which retrying will not fix, and anything else to be retried, up to the
+job's maximum number of attempts, after a delay doubling each time.
+
+Running jobs are marked with a heartbeat; jobs of a worker which stopped beating
+(e.g. a process which was killed) are queued again. Finished jobs, and their
+files, are deleted after JOB_KEEP_SECONDS.
+
+Exported:
+  JOB_TYPES: Job types, mapped to their handler and maximum number of attempts.
+  JobError: Raised by handlers for failures which are not worth retrying.
+  JobContext: What a handler is called with.
+  enqueue: Queues a job.
+  getJob: Looks up a job queued by the user of a request.
+  jobStatus: Returns the status of a job, as reported to the client.
+  startWorkers: Starts the worker threads of this process.
+"""
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+from datetime                   import timedelta
+from django.conf                import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db                  import close_connection, transaction
+from django.db.models           import F, Q
+from django.utils               import timezone
+from django.utils.importlib     import import_module
+
+from polychart.main.models import Job
+
+logger = logging.getLogger(__name__)
+
+# Job type: (dotted path of the handler, maximum number of attempts)
+JOB_TYPES = { 'cleanCsv':         ('polychart.main.utils.csvJobs.cleanUpload', 1)
+            , 'createDataSource': ('polychartQuery.connections.createDataSourceJob', 1)
+            , 'exportDashboard':  ('polychart.main.views.export.exportJob', 2)
+            }
+
+class JobError(Exception):
+  """Raised by a handler when the job failed, and retrying would not help."""
+  pass
+
+class JobContext(object):
+  """
+  What a job handler is called with. It has the `user` and `session` of the
+  request which queued the job, so it may stand in for that request where only
+  those are used, e.g. polychartQuery.connections.getConnection.
+
+  Attribs:
+    job: The Job being run.
+    user: The user who queued the job, or an AnonymousUser.
+    session: The session of the request which queued the job.
+
+  Public Methods:
+    progress: Records the share of the job done so far.
+    filePath: Returns the path of a file kept along with the job.
+  """
+  def __init__(self, job):
+    self.job     = job
+    self.user    = job.user or AnonymousUser()
+    self.session = import_module(settings.SESSION_ENGINE).SessionStore(job.session_key)
+
+  def progress(self, fraction):
+    self.job.progress = fraction
+    Job.objects.filter(pk=self.job.pk).update(progress=fraction, heartbeat=timezone.now())
+
+  def filePath(self, name):
+    """
+    Returns:
+      The path of a file named `name`, deleted along with the job. The
+      directory is created if need be.
+    """
+    path = _filesPath(self.job)
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    return os.path.join(path, name)
+
+#
+# Public Functions
+#
+
+def enqueue(request, jobType, params):
+  """
+  Queues a job, and makes sure this process runs workers if it should.
+
+  Args:
+    request: The Django request the job is run on behalf of.
+    jobType: One of JOB_TYPES.
+    params: The JSON-serializable parameters of the job.
+
+  Returns:
+    The new Job.
+  """
+  if jobType not in JOB_TYPES:
+    raise ValueError("jobs.enqueue", "Unknown job type: {0}".format(jobType))
+  if request.session.session_key is None:
+    request.session.save()
+  user = request.user if request.user.is_authenticated() else None
+  job  = Job.objects.create( user         = user
+                           , session_key  = request.session.session_key
+                           , type         = jobType
+                           , params_json  = params
+                           , max_attempts = JOB_TYPES[jobType][1] )
+  if settings.JOB_RUN_IN_WEB:
+    startWorkers()
+    with _WAKE:
+      _WAKE.notify()
+  return job
+
+def getJob(request, key):
+  """
+  Returns:
+    The Job with key `key`, if it was queued by the user, or else the session,
+    of `request`.
+
+  Raises:
+    Job.DoesNotExist: Thrown when there is no such job.
+  """
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  if request.user.is_authenticated():
+    owner = Q(user=request.user)
+  else:
+    owner = Q(user=None, session_key=request.session.session_key)
+  return Job.objects.get(owner, key=str(key))
+
+def jobStatus(job):
+  """
+  Returns:
+    A dictionary with keys
+      job: The key of the job, to poll its status with.
+      status: 'queued', 'running', 'success' or 'error'.
+      progress: The share of the job done so far, if reported by the handler.
+      result: The result of the job, once it succeeded.
+      error: The error message, once it failed.
+  """
+  return { 'job':      job.key
+         , 'status':   job.state
+         , 'progress': job.progress
+         , 'result':   job.result_json
+         , 'error':    job.error
+         }
+
+def startWorkers():
+  """Starts JOB_WORKERS worker threads, and one housekeeping thread, once."""
+  with _STARTED_LOCK:
+    if _STARTED:
+      return
+    _STARTED.append(True)
+    for i in range(settings.JOB_WORKERS):
+      _daemon(_work, 'job-worker-{0}'.format(i))
+    _daemon(_keepHouse, 'job-housekeeping')
+
+#
+# Private Functions
+#
+
+WORKER_ID = '{0}:{1}'.format(socket.gethostname(), os.getpid())[:64]
+
+_STARTED      = []
+_STARTED_LOCK = threading.Lock()
+_WAKE         = threading.Condition() # notified when a job is queued
+_RUNNING      = set()                 # pks of the jobs running in this process
+_RUNNING_LOCK = threading.Lock()
+
+def _daemon(target, name):
+  thread = threading.Thread(target=target, name=name)
+  thread.daemon = True
+  thread.start()
+
+def _work():
+  """Runs in a worker thread: claims and runs jobs, forever."""
+  while True:
+    try:
+      job = _claim()
+    except Exception:
+      logger.exception('Claiming a job failed')
+      close_connection()
+      job = None
+    if job is None:
+      with _WAKE:
+        _WAKE.wait(settings.JOB_POLL_SECONDS)
+      continue
+    try:
+      _run(job)
+    except Exception:
+      # e.g. the database went away while recording the outcome; the job is
+      # no longer beaten for, so it is queued again once stale
+      logger.exception('Running job %s failed', job.key)
+    finally:
+      close_connection()
+
+def _claim():
+  """
+  Marks the oldest job which is due as running in this process.
+
+  Returns:
+    The claimed Job, or None if there is none.
+  """
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  now  = timezone.now()
+  due  = Job.objects.filter(state='queued', run_after__lte=now).order_by('created')
+  pks  = list(due.values_list('pk', flat=True)[:settings.JOB_WORKERS])
+  # End the read transaction, so that the next poll sees newly queued jobs
+  transaction.commit_unless_managed()
+  for pk in pks:
+    claimed = Job.objects.filter(pk=pk, state='queued').update( state     = 'running'
+                                                              , worker    = WORKER_ID
+                                                              , heartbeat = now
+                                                              , attempts  = F('attempts') + 1 )
+    if claimed:
+      return Job.objects.get(pk=pk)
+  return None
+
+def _run(job):
+  """
+  Runs a claimed job, and records its outcome. The job is beaten for while it
+  is in _RUNNING.
+  """
+  with _RUNNING_LOCK:
+    _RUNNING.add(job.pk)
+  try:
+    _runHandler(job)
+  finally:
+    with _RUNNING_LOCK:
+      _RUNNING.discard(job.pk)
+
+def _runHandler(job):
+  try:
+    context = JobContext(job)
+    path, _ = JOB_TYPES[job.type]
+    module, name = path.rsplit('.', 1)
+    result = getattr(import_module(module), name)(context, job.params_json)
+  except JobError as e:
+    _finish(job, 'error', error=unicode(e))
+  except Exception as e:
+    logger.exception('Job %s (%s) failed on attempt %s', job.key, job.type, job.attempts)
+    if job.attempts < job.max_attempts:
+      delay = settings.JOB_RETRY_SECONDS * 2 ** (job.attempts - 1)
+      Job.objects.filter(pk=job.pk).update( state     = 'queued'
+                                          , worker    = None
+                                          , run_after = timezone.now() + timedelta(seconds=delay) )
+    else:
+      _finish(job, 'error', error=unicode(e) or e.__class__.__name__)
+  else:
+    _finish(job, 'success', result=result)
+
+def _finish(job, state, result=None, error=None):
+  job.state       = state
+  job.result_json = result
+  job.error       = error
+  job.progress    = 1.0 if state == 'success' else job.progress
+  job.worker      = None
+  job.finished    = timezone.now()
+  job.save()
+
+def _keepHouse():
+  """
+  Runs in the housekeeping thread: beats for the jobs being run by the worker
+  threads of this process, queues again the jobs of workers which stopped beating, and deletes old jobs.
+  """
+  while True:
+    try:
+      _beat()
+    except Exception:
+      logger.exception('Job housekeeping failed')
+    finally:
+      close_connection()
+    time.sleep(settings.JOB_HEARTBEAT_SECONDS)
+
+def _beat():
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  now = timezone.now()
+  with _RUNNING_LOCK:
+    running = list(_RUNNING)
+  if running:
+    Job.objects.filter(pk__in=running, state='running').update(heartbeat=now)
+
+  stale = Job.objects.filter( state='running'
+                            , heartbeat__lt=now - timedelta(seconds=settings.JOB_STALE_SECONDS) )
+  stale.filter(attempts__gte=F('max_attempts')).update( state    = 'error'
+                                                      , worker   = None
+                                                      , error    = 'The job was interrupted'
+                                                      , finished = now )
+  stale.update(state='queued', worker=None, run_after=now)
+
+  old = Job.objects.filter( state__in=['success', 'error']
+                          , finished__lt=now - timedelta(seconds=settings.JOB_KEEP_SECONDS) )
+  for job in old:
+    shutil.rmtree(_filesPath(job), ignore_errors=True)
+    job.delete()
+
+def _filesPath(job):
+  return os.path.join(settings.JOB_FILES_ROOT, job.key)
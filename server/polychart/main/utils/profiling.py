@@ -0,0 +1,103 @@
+"""
+Timing and profiling of data source views.
+
+Views decorated with `timedView` collect the phases recorded with
+polychartQuery.timing.phase while they run, and report them to the client in a
+Server-Timing header, e.g.
+
+  Server-Timing: checkout;dur=0.2, validate;dur=0.4, execute;dur=81.3, total;dur=90.1
+
+Phases of streamed responses which run after the view returns are only
+recorded in the histograms, not in the header.
+
+When QUERY_PROFILE_SLOW_SECONDS is set, a sample of requests (a fraction of
+QUERY_PROFILE_SAMPLE_RATE) runs under cProfile, and the profiles of those
+taking longer than the threshold are dumped to QUERY_PROFILE_DIR.
+
+Exported:
+  timedView: Decorator timing and optionally profiling a view.
+  metricsText: Returns the phase histograms and cache counters for scraping.
+"""
+import cProfile
+import logging
+import os
+import random
+
+from datetime    import datetime
+from django.conf import settings
+from functools   import wraps
+
+from polychart.main.utils.resultCache import cacheStats
+from polychartQuery.timing            import HistogramRegistry, REGISTRY, requestTimer
+
+logger = logging.getLogger(__name__)
+
+VIEW_REGISTRY = HistogramRegistry() # total durations of timed views
+
+#
+# Public Functions
+#
+
+def timedView(view):
+  """
+  Decorator for views, adding a Server-Timing header to their responses.
+  """
+  @wraps(view)
+  def wrapped(request, *args, **kwargs):
+    with requestTimer() as timer:
+      if _shouldProfile():
+        response = _profiledCall(view.__name__, timer, view, request, *args, **kwargs)
+      else:
+        response = view(request, *args, **kwargs)
+      response['Server-Timing'] = timer.serverTiming()
+    VIEW_REGISTRY.observe(view.__name__, timer.elapsed())
+    return response
+  return wrapped
+
+def metricsText():
+  """
+  Returns:
+    The histograms of all phases (polychart_phase_seconds) and views
+    (polychart_view_seconds), and the result cache counters
+    (polychart_query_cache_total), in the Prometheus text format.
+  """
+  lines = ['# TYPE polychart_query_cache_total counter']
+  for name, count in sorted(cacheStats().iteritems()):
+    lines.append('polychart_query_cache_total{{event="{0}"}} {1}'.format(name, count))
+  return REGISTRY.prometheus('polychart_phase_seconds', 'phase') \
+       + VIEW_REGISTRY.prometheus('polychart_view_seconds', 'view') \
+       + '\n'.join(lines) + '\n'
+
+#
+# Private Functions
+#
+
+def _shouldProfile():
+  return settings.QUERY_PROFILE_SLOW_SECONDS is not None \
+     and random.random() < settings.QUERY_PROFILE_SAMPLE_RATE
+
+def _profiledCall(name, timer, view, *args, **kwargs):
+  """
+  Helper to run a view under cProfile, dumping the profile if it took longer
+  than QUERY_PROFILE_SLOW_SECONDS.
+  """
+  profile = cProfile.Profile()
+  try:
+    return profile.runcall(view, *args, **kwargs)
+  finally:
+    elapsed = timer.elapsed()
+    if elapsed > settings.QUERY_PROFILE_SLOW_SECONDS:
+      _dumpProfile(profile, name, elapsed)
+
+def _dumpProfile(profile, name, elapsed):
+  """Helper to write a profile to QUERY_PROFILE_DIR; failures are only logged."""
+  fileName = '{0}-{1}-{2}ms.prof'.format(
+    name, datetime.now().strftime('%Y%m%d-%H%M%S-%f'), int(elapsed * 1000))
+  path = os.path.join(settings.QUERY_PROFILE_DIR, fileName)
+  try:
+    if not os.path.isdir(settings.QUERY_PROFILE_DIR):
+      os.makedirs(settings.QUERY_PROFILE_DIR)
+    profile.dump_stats(path)
+    logger.info('Slow request took {0}s; profile written to {1}'.format(elapsed, path))
+  except (IOError, OSError):
+    logger.exception('Could not write profile of slow request')
@@ -0,0 +1,117 @@
+"""
+Storage of raw uploaded files, which may arrive in chunks.
+
+A file is uploaded as a sequence of chunks, each sent with the offset it starts
+at and, optionally, its CRC-32. Chunks are appended to the file as they are read
+from the request, so nothing is buffered in memory. The size of the file on
+disk is the offset acknowledged so far: an interrupted upload resumes from
+there, and a chunk which fails its checksum, or arrives short, is discarded.
+
+Exported:
+  RAW_ROOT: The directory raw uploads are stored in.
+  rawPath: The path of a raw uploaded file.
+  RawUpload: A raw uploaded file, appended to a chunk at a time.
+  ChunkError: Raised when a chunk can not be appended.
+"""
+import os
+import zlib
+
+RAW_ROOT   = os.path.join('uploadedData', 'raw')
+READ_SIZE  = 64 * 1024 # bytes read from the request at a time
+
+def rawPath(key, index):
+  """
+  Args:
+    key: The key of a PendingDataSource.
+    index: The index of the table in the upload.
+
+  Returns:
+    The path of the raw uploaded file.
+  """
+  return os.path.join(RAW_ROOT, '{0}-{1}'.format(key, index))
+
+class ChunkError(Exception):
+  """
+  Raised when a chunk can not be appended.
+
+  Attribs:
+    offset: The offset the upload should resume from.
+  """
+  def __init__(self, message, offset):
+    super(ChunkError, self).__init__(message)
+    self.offset = offset
+
+class RawUpload(object):
+  """
+  A raw uploaded file.
+
+  Attribs:
+    path: The path of the file.
+    maxSize: The maximum size of the file in bytes, or None.
+
+  Public Methods:
+    size: Returns the number of bytes stored, i.e. the offset to resume from.
+    append: Appends a chunk read from a stream.
+  """
+  def __init__(self, key, index, maxSize=None):
+    self.path    = rawPath(key, index)
+    self.maxSize = maxSize
+
+  def size(self):
+    try:
+      return os.path.getsize(self.path)
+    except OSError:
+      return 0
+
+  def append(self, stream, offset, length, crc32=None):
+    """
+    Writes a chunk at `offset`, discarding anything stored past it, e.g. a
+    chunk which is being sent again.
+
+    Args:
+      stream: A file-like object to read the chunk from.
+      offset: The offset of the chunk in the file.
+      length: The length of the chunk in bytes.
+      crc32: Optional CRC-32 of the chunk, as an unsigned integer.
+
+    Returns:
+      The number of bytes stored.
+
+    Raises:
+      ChunkError: Thrown when the chunk does not start within or at the end of
+        the file, would make it too large, arrives short, or fails its checksum.
+    """
+    stored = self.size()
+    if offset < 0 or length < 0:
+      raise ChunkError('Chunk has a negative offset or length', stored)
+    if offset > stored:
+      raise ChunkError('Chunk starts past the end of the upload', stored)
+    if self.maxSize is not None and offset + length > self.maxSize:
+      raise ChunkError('Upload is too large', offset)
+
+    directory = os.path.dirname(self.path)
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+    crc = 0
+    received = 0
+    with open(self.path, 'r+b' if stored else 'wb') as f:
+      f.seek(offset)
+      f.truncate()
+      while received < length:
+        data = stream.read(min(READ_SIZE, length - received))
+        if not data:
+          break
+        crc = zlib.crc32(data, crc)
+        received += len(data)
+        f.write(data)
+
+      if received < length:
+        error = 'Chunk is incomplete'
+      elif crc32 is not None and crc & 0xffffffff != crc32:
+        error = 'Chunk failed its checksum'
+      else:
+        return offset + received
+      f.seek(offset)
+      f.truncate()
+    raise ChunkError(error, offset)
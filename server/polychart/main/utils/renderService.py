@@ -0,0 +1,117 @@
+"""
+Client of the export service, which renders the charts, numerals and pivot
+tables of dashboards for views.export. See the README located in
+`/exportService/` for more information on the service.
+
+Rendering an item is a conversation on a websocket: the item's spec is sent,
+then, for each of its layers, the service sends the spec of the data it needs,
+and answers that data with the rendered scene. Messages carry no request ids,
+so a socket holds one conversation at a time; sockets are kept open between
+conversations, in a pool (see polychartQuery.pool.DataSourcePool), and
+concurrent conversations each check out a socket of their own.
+
+Exported:
+  converse: Holds a conversation with the service on a pooled socket.
+"""
+import socket
+import websocket
+
+from django.conf      import settings
+from logging          import getLogger
+from threading        import Lock
+from urllib           import urlencode
+
+from polychartQuery.pool import DataSourcePool
+
+logger = getLogger(__name__)
+
+RENDER_RETRIES   = 1 # times a conversation is retried on a new socket
+SOCKET_ERRORS    = (socket.error, websocket.WebSocketException)
+
+def converse(conversation):
+  """
+  Holds a conversation with the export service on a pooled socket. A socket
+  which failed, or whose conversation did not finish, is closed rather than
+  returned to the pool. If the socket fails, e.g. as the service closed it
+  while it sat in the pool, the conversation is started over on a new socket,
+  used for this conversation only.
+
+  Args:
+    conversation: A function of a RenderSocket, returning the result of the
+      conversation; it may be called again should the socket fail.
+
+  Returns:
+    The result of the conversation.
+  """
+  pool = _getPool()
+  pool.reap()
+  conn = pool.checkout(RenderSocket)
+  try:
+    return conversation(conn)
+  except SOCKET_ERRORS:
+    conn.close()
+    logger.info('Export service socket failed; starting the conversation over.')
+  except Exception:
+    conn.close()
+    raise
+  finally:
+    pool.checkin(conn)
+
+  # Other pooled sockets may have failed likewise, so retry on new ones
+  for attempt in range(RENDER_RETRIES):
+    conn = RenderSocket()
+    try:
+      return conversation(conn)
+    except SOCKET_ERRORS:
+      if attempt == RENDER_RETRIES - 1:
+        raise
+    finally:
+      conn.close()
+
+class RenderSocket(object):
+  """
+  A websocket to the export service.
+
+  Attribs:
+    opened: Whether the socket is still open.
+
+  Public Methods:
+    send: Sends a message, given as a dictionary of its fields.
+    recv: Receives a message, as a string.
+    ping: Health checks the socket; see DataSourcePool.
+    close: Closes the socket.
+  """
+  def __init__(self):
+    self._ws = websocket.create_connection( "ws://localhost:%s/" % settings.EXPORT_SERVICE_PORT
+                                          , timeout=settings.EXPORT_RENDER_TIMEOUT )
+
+  @property
+  def opened(self):
+    return self._ws.connected
+
+  def send(self, fields):
+    self._ws.send(urlencode(fields))
+
+  def recv(self):
+    return self._ws.recv()
+
+  def ping(self):
+    self._ws.ping()
+    return True
+
+  def close(self):
+    self._ws.close()
+
+#### Helper functions
+
+_POOL      = []
+_POOL_LOCK = Lock()
+
+def _getPool():
+  """Helper returning the pool of sockets, created on first use."""
+  with _POOL_LOCK:
+    if not _POOL:
+      _POOL.append(DataSourcePool( maxSize         = settings.EXPORT_RENDER_POOL_SIZE
+                                 , idleTimeout     = settings.EXPORT_RENDER_IDLE_TIMEOUT
+                                 , checkoutTimeout = settings.EXPORT_RENDER_TIMEOUT ))
+    return _POOL[0]
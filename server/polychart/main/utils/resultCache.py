@@ -0,0 +1,286 @@
+"""
+Caching layer for data source query results.
+
+Results are stored in the Django cache under the connection's cache key (see
+polychartQuery.abstract.DataSourceConnection.generateCacheKey), for a time to
+live configurable per data source. After expiring, an entry is still served for
+up to QUERY_CACHE_STALE_TTL seconds while a single background thread refreshes
+it (stale-while-revalidate). Concurrent misses on the same key within a process
+are coalesced, so only one of them actually queries the data source.
+
+Entries are stored compactly: row-wise query data is packed column-wise, pickled
+and zlib compressed. Entries larger than QUERY_CACHE_ITEM_LIMIT bytes (e.g. the
+1MB item limit of memcached) are split into chunks, and entries larger than
+QUERY_CACHE_MAX_BYTES are not cached at all.
+
+Exported:
+  cachedCall: Calls a connection method, going through the cache.
+  cacheStats: Returns the hit, miss, stale and coalesced counters.
+"""
+import cPickle
+import logging
+import threading
+import zlib
+
+from django.conf       import settings
+from django.core.cache import cache
+from time              import time
+
+from polychart.main.utils.tools import randomCode
+from polychartQuery.timing      import phase
+
+logger = logging.getLogger(__name__)
+
+COALESCE_TIMEOUT     = 120 # seconds to wait on another thread's execution
+REFRESH_LOCK_TIMEOUT = 120 # seconds before a stuck background refresh is retried
+COMPRESSION_LEVEL    = 6
+
+# Raised decoding an entry which is corrupt (e.g. truncated, or with chunks of
+# another write), or pickled from classes a deploy has since changed.
+CORRUPT_ENTRY_ERRORS = ( zlib.error, cPickle.UnpicklingError, EOFError, KeyError
+                       , TypeError, ValueError, AttributeError, ImportError )
+
+#
+# Public Functions
+#
+
+def cachedCall(conn, methodName, *args):
+  """
+  Calls a method of a data source connection, serving the result from the cache
+  when possible.
+
+  Args:
+    conn: A data source connection object.
+    methodName: The name of the method to call, e.g. 'queryTable'.
+    args: Arguments to pass to the method.
+
+  Returns:
+    The result of the method call, possibly cached and possibly stale.
+  """
+  cacheKey = conn.generateCacheKey(methodName, args)
+  ttl      = _getTtl(conn)
+
+  with phase('cacheGet'):
+    entry  = cache.get(cacheKey)
+    result = _load(cacheKey, entry)
+  if result is not None:
+    if entry['expires'] > time():
+      _count('hit')
+    else:
+      _count('stale')
+      _refreshInBackground(cacheKey, ttl, conn, methodName, args)
+    return result
+
+  _count('miss')
+  return _execute(cacheKey, ttl, conn, methodName, args)
+
+def cacheStats():
+  """
+  Returns:
+    A dictionary of counters since process start:
+      hit: Fresh results served from the cache.
+      miss: Results not found in the cache.
+      stale: Expired results served while being refreshed.
+      coalesced: Misses which waited on an identical in-flight execution.
+      refresh: Background refreshes started.
+      error: Executions which raised an exception.
+  """
+  with _STATS_LOCK:
+    return dict(_STATS)
+
+#
+# Private Functions
+#
+
+_STATS = { 'hit':       0
+         , 'miss':      0
+         , 'stale':     0
+         , 'coalesced': 0
+         , 'refresh':   0
+         , 'error':     0
+         }
+_STATS_LOCK = threading.Lock()
+
+_IN_FLIGHT      = {} # cache key -> _Flight
+_IN_FLIGHT_LOCK = threading.Lock()
+
+class _Flight(object):
+  """An in-progress execution for a cache key that other threads may wait on."""
+  def __init__(self):
+    self.done   = threading.Event()
+    self.result = None
+    self.error  = None
+
+def _count(name):
+  with _STATS_LOCK:
+    _STATS[name] += 1
+
+def _getTtl(conn):
+  """
+  Helper to find the time to live for a connection's results. QUERY_CACHE_TTLS
+  may be keyed by data source key or type, the former taking precedence.
+  """
+  ttls = settings.QUERY_CACHE_TTLS
+  for key in (getattr(conn, 'dsKey', None), getattr(conn, 'dsType', None)):
+    if key is not None and key in ttls:
+      return ttls[key]
+  return settings.QUERY_CACHE_TTL
+
+def _execute(cacheKey, ttl, conn, methodName, args):
+  """
+  Helper to run a connection method and cache its result. If the same key is
+  already being executed in this process, waits for and returns that result.
+  """
+  with _IN_FLIGHT_LOCK:
+    flight = _IN_FLIGHT.get(cacheKey)
+    isLeader = flight is None
+    if isLeader:
+      flight = _IN_FLIGHT[cacheKey] = _Flight()
+
+  if not isLeader:
+    _count('coalesced')
+    if flight.done.wait(COALESCE_TIMEOUT):
+      if flight.error is not None:
+        raise flight.error
+      return flight.result
+    logger.warn('Gave up waiting on in-flight query; running it again.')
+    return getattr(conn, methodName)(*args)
+
+  try:
+    flight.result = getattr(conn, methodName)(*args)
+    with phase('cacheSet'):
+      _store(cacheKey, ttl, flight.result)
+    return flight.result
+  except Exception as err:
+    _count('error')
+    flight.error = err
+    raise
+  finally:
+    with _IN_FLIGHT_LOCK:
+      del _IN_FLIGHT[cacheKey]
+    flight.done.set()
+
+def _store(cacheKey, ttl, result):
+  """
+  Helper to cache a result, keeping it around past expiry to serve stale. The
+  entry stored under `cacheKey` either holds the compressed result in 'blob', or
+  the number of chunks and the token under which the chunks are stored.
+  """
+  if result is None: # e.g. `retry` gave up
+    return
+  startTime = time()
+  raw       = cPickle.dumps(_pack(result), cPickle.HIGHEST_PROTOCOL)
+  blob      = zlib.compress(raw, COMPRESSION_LEVEL)
+  if len(blob) > settings.QUERY_CACHE_MAX_BYTES:
+    logger.info('Not caching result of {0} bytes compressed; over QUERY_CACHE_MAX_BYTES'
+                .format(len(blob)))
+    return
+
+  timeout   = ttl + settings.QUERY_CACHE_STALE_TTL
+  entry     = { 'expires': time() + ttl }
+  chunkSize = settings.QUERY_CACHE_ITEM_LIMIT
+  if len(blob) <= chunkSize:
+    entry['blob'] = blob
+    numChunks     = 1
+  else:
+    # Chunks go under a fresh token, and the entry pointing to them is written
+    # last, so readers never mix chunks of different versions.
+    token     = randomCode()
+    numChunks = (len(blob) + chunkSize - 1) // chunkSize
+    cache.set_many(
+      { _chunkKey(cacheKey, token, i): blob[i*chunkSize:(i+1)*chunkSize]
+          for i in xrange(numChunks) }
+    , timeout)
+    entry.update({ 'token': token, 'chunks': numChunks })
+  cache.set(cacheKey, entry, timeout)
+
+  logger.info(('Cache save took {sec}s: {raw} bytes pickled, {stored} bytes stored '
+               '({ratio:.1f}x) in {chunks} chunk(s)').format(
+                 sec    = time() - startTime
+               , raw    = len(raw)
+               , stored = len(blob)
+               , ratio  = float(len(raw)) / max(len(blob), 1)
+               , chunks = numChunks ))
+
+def _load(cacheKey, entry):
+  """
+  Helper to decode an entry written by _store.
+
+  Returns:
+    The cached result, or None if there is no entry, some chunk has been
+    evicted, or the entry can not be decoded; such an entry is deleted, so
+    that it is replaced rather than failing every request for the key.
+  """
+  if entry is None:
+    return None
+  try:
+    if 'blob' in entry:
+      blob = entry['blob']
+    else:
+      keys   = [_chunkKey(cacheKey, entry['token'], i) for i in xrange(entry['chunks'])]
+      chunks = cache.get_many(keys)
+      if len(chunks) != len(keys):
+        return None
+      blob = ''.join(chunks[key] for key in keys)
+    return _unpack(cPickle.loads(zlib.decompress(blob)))
+  except CORRUPT_ENTRY_ERRORS:
+    logger.warn('Discarding unreadable cache entry {0}'.format(cacheKey), exc_info=True)
+    cache.delete(cacheKey)
+    return None
+
+def _chunkKey(cacheKey, token, index):
+  return '{0}::{1}::{2}'.format(cacheKey, token, index)
+
+def _pack(result):
+  """
+  Helper to store the row dictionaries of a query result column-wise, which
+  avoids repeating column names in every row. Results without uniform rows are
+  returned as is.
+  """
+  if not isinstance(result, dict) or not isinstance(result.get('data'), list):
+    return result
+  rows = result['data']
+  if not rows or not all(isinstance(row, dict) for row in rows):
+    return result
+  names = rows[0].keys()
+  if any(len(row) != len(names) for row in rows):
+    return result
+  try:
+    columns = [[row[name] for row in rows] for name in names]
+  except KeyError:
+    return result
+
+  packed = dict(result)
+  packed['data'] = None
+  return {'packedRows': (names, columns), 'result': packed}
+
+def _unpack(packed):
+  """Helper inverting _pack."""
+  if not isinstance(packed, dict) or 'packedRows' not in packed:
+    return packed
+  names, columns = packed['packedRows']
+  result = packed['result']
+  result['data'] = [dict(zip(names, values)) for values in zip(*columns)]
+  return result
+
+def _refreshInBackground(cacheKey, ttl, conn, methodName, args):
+  """
+  Helper to refresh an expired entry on a background thread. `cache.add` is
+  atomic, so only one process refreshes a given key at a time.
+  """
+  lockKey = cacheKey + '::refresh'
+  if not cache.add(lockKey, True, REFRESH_LOCK_TIMEOUT):
+    return
+  _count('refresh')
+
+  def refresh():
+    try:
+      _execute(cacheKey, ttl, conn, methodName, args)
+    except Exception:
+      logger.exception('Background refresh of cached result failed')
+    finally:
+      cache.delete(lockKey)
+
+  thread = threading.Thread(target=refresh, name='cache-refresh')
+  thread.daemon = True
+  thread.start()
@@ -10,8 +10,7 @@ from django.views.decorators.http   import require_GET, require_POST
 
 from polychart.main.models        import ( Dashboard
                                          , DashboardDataTable
-                                         , DataSource
-                                         , LocalDataSource )
+                                         , DataSource )
 from polychartQuery.utils         import saneEncode
 from polychart.utils              import jsonResponse
 
@@ -30,8 +29,6 @@ def createTableRefs(dash, dataCollection):
 def deleteTableRefs(dash):
   DashboardDataTable.objects.filter(dashboard=dash).delete()
 
-localDataSourceTypes = ['csv']
-
 ### Dashboard Handlers
 
 @require_GET
@@ -48,26 +45,16 @@ def dashShow(request, dashKey, action):
     else:
       tableNameMap[dsKey] = [tableRef.table_name]
 
-  data = DataSource.objects.get(key=dsKey)
-
-  if data.type in localDataSourceTypes:
-    tables = LocalDataSource.objects.get(datasource__key=dsKey).json
-    dataCollection = [
-      { 'type':          'local'
-      , 'dataSourceKey': dsKey
-      , 'dataSourceType':data.type
-      , 'tableNames':    [table['name'] for table in tables]
-      , 'tables':        tables
-      }
-    ]
-  else:
-    dataCollection = [
-      { 'type':          'remote'
-      , 'dataSourceKey': dsKey
-      , 'tableNames':    tableNames
-      , 'dataSourceType':data.type
-      } for dsKey, tableNames in tableNameMap.items()
-    ]
+  # Uploaded data is queried on the server too, rather than shipped inline
+  dsTypes = { ds.key: ds.type
+                for ds in DataSource.objects.filter(key__in=tableNameMap.keys()) }
+  dataCollection = [
+    { 'type':          'remote'
+    , 'dataSourceKey': dsKey
+    , 'tableNames':    tableNames
+    , 'dataSourceType':dsTypes[dsKey]
+    } for dsKey, tableNames in tableNameMap.items()
+  ]
 
   if action in ['edit', 'view']:
     return render( request
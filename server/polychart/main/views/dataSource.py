@@ -3,45 +3,56 @@ Module containing view handlers related to data sources
 """
 import json
 import logging
+import re
 import urllib
 
 from django.contrib.auth.decorators import login_required
-from django.core.cache              import cache
+from django.conf                    import settings
+from django.http                    import HttpResponse, Http404, StreamingHttpResponse
 from django.shortcuts               import render, redirect
 from django.views.decorators.http   import require_GET, require_POST
+from itertools                      import chain
+from multiprocessing.pool           import ThreadPool
 from time import time
 
+from polychartQuery.abstract          import   STREAM_BATCH_SIZE
 from polychartQuery.connections       import ( getConnection
-                                             , createDataSource
-                                             , RedirectRequired )
+                                             , closeConnections
+                                             , createDataSource )
 from polychartQuery.oauth             import   oauthCallback
+from polychartQuery.slowQuery         import   queryOrigin
 from polychartQuery.utils             import   saneEncode
 from polychart.main.models                        import ( DashboardDataTable
                                                          , DataSource
                                                          , PendingDataSource )
+from polychart.main.utils                         import   secureStorage
+from polychart.main.utils.jobs                    import   enqueue, jobStatus
+from polychart.main.utils.profiling               import   metricsText, timedView
+from polychart.main.utils.resultCache             import   cachedCall, cacheStats
 from polychart.main.utils.spec                    import   getDsInfo
-from polychart.utils                              import   jsonResponse
+from polychart.utils                              import ( jsonResponse
+                                                         , jsonTextResponse )
 
 #
 # View Handlers for Data Sources
 #
 
-CACHE_TIMEOUT = 300 # seconds
+BATCH_QUERY_WORKERS = 8 # concurrent queries per batch; see also DATA_SOURCE_POOL_SIZE
+DASHBOARD_URL       = re.compile(r'/dashboard/([^/]+)/') # referring dashboard pages
 logger = logging.getLogger(__name__)
 
 @require_POST
 @login_required
 def dsCreate(request):
-  """View Handler for creating data sources."""
-  clientDsObj = json.loads(request.body)
-  try:
-    result = createDataSource(request, clientDsObj)
-    if   result['status'] == 'success':
-      return jsonResponse({'key': result['key']})
-    elif result['status'] == 'error':
-      return jsonResponse(result['error'], status = 400)
-  except RedirectRequired as red:
-    return jsonResponse({'redirect': red.url})
+  """
+  View Handler for creating data sources. Connecting to a data source may take a
+  while, so it is done by a 'createDataSource' job (see
+  connections.createDataSourceJob); this returns the status of the job.
+  """
+  json.loads(request.body) # fail early on malformed requests
+  cipher = secureStorage.encrypt(request.session['secureStorageKey'], request.body)
+  job    = enqueue(request, 'createDataSource', {'cipher': cipher})
+  return jsonResponse(jobStatus(job))
 
 @require_GET
 @login_required
@@ -102,6 +113,7 @@ def dsDelete(request, dsKey):
   for dash in dashs:
     dash.delete()
 
+  closeConnections(request.user, ds.key)
   ds.delete()
 
   return jsonResponse({})
@@ -111,22 +123,33 @@ def dsDelete(request, dsKey):
 #
 
 def runConnectionMethod(conn, methodName, *args):
+  """Runs a connection method through the result cache; see utils.resultCache."""
   startTime = time()
-  cacheKey = conn.generateCacheKey(methodName, args)
-  cachedResult = cache.get(cacheKey)
-  if cachedResult:
-    logger.info('Cache hit took {sec}s'.format(sec=time()-startTime))
-    return cachedResult
-
-  result = getattr(conn, methodName)(*args)
+  result    = cachedCall(conn, methodName, *args)
+  logger.info('{method} took {sec}s'.format(method=methodName, sec=time()-startTime))
+  return result
 
-  startTime = time()
-  cache.set(cacheKey, result, CACHE_TIMEOUT)
-  logger.info('Cache save took {sec}s'.format(sec=time()-startTime))
+@require_GET
+@login_required
+def dsCacheStats(request):
+  """View Handler exposing result cache counters for monitoring; staff only."""
+  if not request.user.is_staff:
+    raise Http404
+  return jsonResponse(cacheStats())
 
-  return result
+@require_GET
+def dsMetrics(request):
+  """
+  View Handler exposing query phase histograms in the Prometheus text format;
+  for staff, and for scrapers at METRICS_ALLOWED_IPS.
+  """
+  if not request.user.is_staff and \
+     request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+    raise Http404
+  return HttpResponse(metricsText(), content_type='text/plain; version=0.0.4')
 
 @require_POST
+@timedView
 def tableList(request, dsKey):
   """View Handler for listing tables in a dashboard."""
   connection = getConnection(request, dsKey)
@@ -134,6 +157,7 @@ def tableList(request, dsKey):
   return jsonResponse(saneEncode(tables))
 
 @require_POST
+@timedView
 def tableMeta(request, dsKey):
   """View Handler for returning table meta data."""
   tableName  = request.POST.get('tableName', None)
@@ -144,13 +168,14 @@ def tableMeta(request, dsKey):
                      "Invalid request; missing data.")
   try:
     connection = getConnection(request, dsKey)
-    result     = runConnectionMethod(
-      connection,
-      'getColumnMetadata',
-      tableName,
-      columnExpr,
-      dataType
-    )
+    with queryOrigin(**_queryOrigin(request, tableName)):
+      result = runConnectionMethod(
+        connection,
+        'getColumnMetadata',
+        tableName,
+        columnExpr,
+        dataType
+      )
   except ValueError as err:
     if len(err.args) > 0:
       return jsonResponse({'message': str(err.args[0])}, status=500)
@@ -158,27 +183,152 @@ def tableMeta(request, dsKey):
   return jsonResponse(saneEncode(result))
 
 @require_POST
+@timedView
 def tableQuery(request, _):
-  """View Handler for performing a query on a table."""
+  """
+  View Handler for performing a query on a table. Passing `format=columnar`
+  returns data as {columnName: [values...]} rather than a list of rows.
+
+  Row-wise results are encoded by the connection (see
+  DataSourceConnection.queryTableJson). Passing `encoding=typed` encodes values
+  according to the column types of the query meta rather than exactly as they
+  always have been, which is faster.
+
+  Passing `stream=true` streams row-wise results back as they are read from the
+  data source, bypassing the result cache; use it for queries with large limits.
+
+  The optional `dashboard` and `chart` parameters identify what the query is
+  run for in the slow query log; see _queryOrigin.
+  """
   spec = json.loads(urllib.unquote(request.POST.get('spec', None)))
   assert spec, "Invalid query specification!"
 
   tableName, dsKey = getDsInfo(spec)[0]
   limit            = int(request.POST.get('limit', 1000))
+  columnar         = request.POST.get('format', 'rows') == 'columnar'
+  stream           = request.POST.get('stream', 'false') == 'true'
+  compat           = request.POST.get('encoding', 'compat') != 'typed'
   try:
     connection = getConnection(request, dsKey)
-    result     = runConnectionMethod(
-      connection,
-      'queryTable',
-      tableName,
-      spec,
-      limit
-    )
+    with queryOrigin(**_queryOrigin(request, tableName)):
+      if columnar:
+        result = runConnectionMethod(connection, 'queryTable', tableName, spec, limit, True)
+        result = None if result is None else json.dumps(result)
+      elif stream:
+        return _streamTableQuery(connection, tableName, spec, limit, compat)
+      else:
+        result = runConnectionMethod(
+          connection,
+          'queryTableJson',
+          tableName,
+          spec,
+          limit,
+          compat
+        )
   except ValueError as err:
     if len(err.args) > 0:
       return jsonResponse({'message': str(err.args[0])}, status=500)
     return jsonResponse({'message': None}, status=500)
-  return jsonResponse(result) #saneEncoded already in queryTable
+  if result is None: # the query failed, and retrying did not help; see abstract.retry
+    return jsonResponse({'message': None}, status=500)
+  return jsonTextResponse(result)
+
+def _streamTableQuery(connection, tableName, spec, limit, compat):
+  """
+  Helper returning a streaming response for a table query. The first chunk is
+  read before responding, so that query errors still get an error status.
+  """
+  chunks = iter(connection.streamTable(tableName, spec, limit, STREAM_BATCH_SIZE, compat))
+  first  = next(chunks)
+  return StreamingHttpResponse( chain([first], chunks)
+                              , content_type = 'application/json' )
+
+@require_POST
+def tableBatchQuery(request, _):
+  """
+  View Handler for performing several table queries at once, e.g. for all the
+  charts of a dashboard. Expects a JSON list of query specifications in `specs`,
+  and accepts `limit`, `format` and `encoding` like tableQuery.
+
+  The queries run concurrently on up to BATCH_QUERY_WORKERS threads; queries to
+  the same data source are further bounded by the size of its connection pool.
+  Results are streamed back as they complete, one JSON object per line, in the
+  form
+    {"index": 2, "result": {...}}    or    {"index": 2, "message": "..."}
+  where `index` is the position of the query specification in `specs`.
+  """
+  specs = json.loads(urllib.unquote(request.POST.get('specs', None)))
+  assert specs and isinstance(specs, list), "Invalid query specifications!"
+
+  limit    = int(request.POST.get('limit', 1000))
+  columnar = request.POST.get('format', 'rows') == 'columnar'
+  compat   = request.POST.get('encoding', 'compat') != 'typed'
+
+  # Resolve connections up front, on the request thread, so that worker threads
+  # never touch the Django database.
+  connections, jobs = {}, []
+  for index, spec in enumerate(specs):
+    tableName, dsKey = getDsInfo(spec)[0]
+    if dsKey not in connections:
+      connections[dsKey] = getConnection(request, dsKey)
+    origin = _queryOrigin(request, tableName, chart=index)
+    jobs.append((index, connections[dsKey], tableName, spec, limit, columnar, compat, origin))
+
+  return StreamingHttpResponse( _streamBatchQuery(jobs)
+                              , content_type = 'application/x-json-stream' )
+
+def _streamBatchQuery(jobs):
+  """
+  Generator running batch query jobs on a thread pool and yielding each result,
+  as a line of JSON, as soon as it is available.
+  """
+  workers = ThreadPool(min(len(jobs), BATCH_QUERY_WORKERS))
+  try:
+    for line in workers.imap_unordered(_runBatchQueryJob, jobs):
+      yield line + '\n'
+  finally:
+    workers.close()
+    workers.join()
+
+def _runBatchQueryJob(job):
+  """
+  Helper running a single query of a batch; see tableBatchQuery.
+
+  Returns:
+    The line of JSON for the query, without the newline.
+  """
+  index, connection, tableName, spec, limit, columnar, compat, origin = job
+  try:
+    with queryOrigin(**origin):
+      if columnar:
+        result = runConnectionMethod(connection, 'queryTable', tableName, spec, limit, True)
+        result = None if result is None else json.dumps(result)
+      else:
+        result = runConnectionMethod(
+          connection, 'queryTableJson', tableName, spec, limit, compat)
+    if result is None: # the query failed, and retrying did not help; see abstract.retry
+      return json.dumps({'index': index, 'message': None})
+    return '{{"index": {0}, "result": {1}}}'.format(index, result)
+  except ValueError as err:
+    return json.dumps({'index': index, 'message': str(err.args[0]) if err.args else None})
+  except Exception:
+    logger.exception('Unexpected error in batch query')
+    return json.dumps({'index': index, 'message': None})
+
+def _queryOrigin(request, tableName, chart=None):
+  """
+  Helper describing what a query is run for, for the slow query log: the
+  dashboard, from the `dashboard` parameter or else the referring page; the
+  chart, from the `chart` parameter or else its position in a batch; and the
+  table.
+  """
+  dashboard = request.POST.get('dashboard')
+  if dashboard is None:
+    match     = DASHBOARD_URL.search(request.META.get('HTTP_REFERER', ''))
+    dashboard = match.group(1) if match else None
+  return { 'dashboard': dashboard
+         , 'chart':     request.POST.get('chart', chart)
+         , 'table':     tableName }
 
 #
 # View Handlers related to pending datasources.
@@ -215,6 +365,10 @@ def dsPendingDelete(request, pendingDsKey):
   # user may be null, this is acceptable
   pds = PendingDataSource.objects.get(key=str(pendingDsKey), user=request.user)
 
+  # Keep the data set of an existing data source a new version was uploaded for;
+  # deleting the pending data source deletes its LocalDataSource, and data set.
+  LocalDataSource.objects.filter(pendingdatasource=pds, datasource__isnull=False) \
+                         .update(pendingdatasource=None)
   pds.delete()
 
   return jsonResponse({'status': 'success'})
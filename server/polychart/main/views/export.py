@@ -3,92 +3,119 @@ View Handlers and functions for exporting dashboards. See the README located in
 `/exportService/` for more information on how this works.
 """
 import json
-import websocket
 
 from django.conf                  import settings
+from django.db                    import close_connection
 from django.views.decorators.http import require_GET, require_POST
-from django.http                  import HttpResponse
-from urllib                       import urlencode, unquote
+from django.http                  import HttpResponse, Http404
+from multiprocessing.pool         import ThreadPool
+from threading                    import Lock
+from urllib                       import unquote
 
-from polychartQuery.connections   import getConnection
-from polychart.main.utils.spec    import getDsInfo
-from polychart.main.utils.svg     import constructSvg, GRID_SIZE
-from polychart.main.utils.tools   import randomCode
-from polychart.utils              import jsonResponse
+from polychartQuery.connections         import getConnection
+from polychart.main.models              import Job
+from polychart.main.utils.jobs          import enqueue, getJob, jobStatus
+from polychart.main.utils.renderService import converse
+from polychart.main.utils.spec          import getDsInfo
+from polychart.main.utils.svg           import constructSvg, GRID_SIZE
+from polychart.utils                    import jsonResponse
+
+EXPORT_CONTENT_TYPES = { 'svg': 'image/svg+xml'
+                       , 'pdf': 'application/pdf'
+                       , 'png': 'image/png'
+                       }
 
 @require_POST
 def dashExportCode(request):
   """
-  Handler function to produce session code so that the user may be redirected to
-  a unique URL for the export task to take place.
+  Handler function to start exporting a dashboard. Rendering takes a while, so
+  it is done in the background by an 'exportDashboard' job; once the job
+  succeeds, the user may be redirected to dashExport to download the file.
 
   Args:
     request: Django request object; should contain the serialized dashboard
       specification in request.POST.
 
   Returns:
-    A unique code corresponding to the key used to store the POST data in the
-    request session object.
+    The status of the job; see jobs.jobStatus. Its key is the code to pass to
+    dashExport.
+
+  Raises:
+    ValueError: Thrown when an invalid export type is passed in.
   """
   if not settings.EXPORT_SERVICE_PORT:
     raise ValueError('Received an export request, but exporting is not enabled')
 
   exportRequest = json.loads(request.body)
-  serial     = exportRequest['serial']
-  exportType = exportRequest['exportType']
-  code       = randomCode()
+  exportType    = exportRequest['exportType']
+  if exportType not in EXPORT_CONTENT_TYPES:
+    raise ValueError("views.export.dashExportCode: Invalid export format, %s" % exportType)
 
-  request.session[code] = { 'serial':     serial
-                          , 'exportType': exportType}
-  return jsonResponse({'code': code})
+  job = enqueue(request, 'exportDashboard', { 'serial':     exportRequest['serial']
+                                            , 'exportType': exportType })
+  return jsonResponse(jobStatus(job))
 
 @require_GET
 def dashExport(request, code):
   """
-  Handler function to export dashboard to SVG, PDF, or PNG.
+  Handler function to download an exported dashboard.
 
   Args:
     request: Django request object.
-    exportType: A string corresponding to the format for export.
-    code: A code to identify the serialized data stored in the session field of
-      the Django request.
+    code: The key of the 'exportDashboard' job which exported the dashboard.
 
   Returns:
-    A file that corresponds to the dashboard encoded by `serial`, in the format
-    requested.
+    A file that corresponds to the exported dashboard, in the format requested.
 
   Raises:
-    ValueError: Thrown when an invalid export type is passed in.
+    Http404: Thrown when there is no such export, or it has not succeeded.
   """
-  if not settings.EXPORT_SERVICE_PORT:
-    raise ValueError('Received an export request, but exporting is not enabled')
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  try:
+    job = getJob(request, code)
+  except Job.DoesNotExist:
+    raise Http404
+  if job.type != 'exportDashboard' or job.state != 'success':
+    raise Http404
 
-  data       = request.session[code]
-  serial     = data['serial']
-  exportType = data['exportType']
+  exportType = job.params_json['exportType']
+  with open(job.result_json['path'], 'rb') as f:
+    response = HttpResponse(f.read(), content_type=EXPORT_CONTENT_TYPES[exportType])
+  response['Content-Disposition'] = "attachment;filename=dashboard." + exportType
+  return response
+
+def exportJob(context, params):
+  """
+  Handler of 'exportDashboard' jobs, rendering a dashboard to SVG, PDF, or PNG.
 
-  svg = _getSvg(request, serial)
-  res, contentType = None, None
+  Args:
+    context: The jobs.JobContext; it stands in for the request when querying
+      data sources.
+    params: A dictionary with the serialized dashboard, `serial`, and the
+      format to export to, `exportType`.
+
+  Returns:
+    A dictionary with the `path` of the exported file.
+  """
+  exportType = params['exportType']
+  svg = _getSvg(context, params['serial'])
 
-  if   exportType == 'svg':
+  if exportType == 'svg':
     res = svg
-    contentType = "image/svg+xml"
   else:
     import cairosvg
     # pylint: disable = E1101
     # Pylint does not recognize svg2pdf/svg2png method in cairosvg
     if exportType == 'pdf':
       res = cairosvg.svg2pdf(svg)
-      contentType = "application/pdf"
-    elif exportType == 'png':
-      res = cairosvg.svg2png(svg)
-      contentType = "image/png"
     else:
-      raise ValueError("views.export.dashExport: Invalid export format, %s" % exportType)
+      res = cairosvg.svg2png(svg)
 
-  response = HttpResponse(res, content_type=contentType)
-  response['Content-Disposition'] = "attachment;filename=dashboard." + exportType
-  return response
+  path = context.filePath('dashboard.' + exportType)
+  with open(path, 'wb') as f:
+    f.write(res.encode('utf-8') if isinstance(res, unicode) else res)
+  return {'path': path}
 
 #### Helper methods for rendering
 
@@ -98,8 +125,8 @@ def _getSvg(request, serial):
   image.
 
   Args:
-    request: A Django request object; used for data source querying in the
-      build process.
+    request: A Django request object, or jobs.JobContext; used for data source
+      querying in the build process.
     serial: A raw dashboard builder serialized dictionary.
 
   Returns:
@@ -123,10 +150,15 @@ def _getSvg(request, serial):
 
 def _processJS(request, rawJS):
   """
-  Helper function to produce a scene tree for each abstract js spec.
+  Helper function to produce a scene tree for each abstract js spec. The items
+  are rendered concurrently, on up to EXPORT_RENDER_WORKERS threads, each
+  holding its conversation with the export service on a socket of its own (see
+  utils.renderService); data is queried as the service asks for it, so the
+  queries of different items run in parallel too.
 
   Args:
-    request: Django  request object; used to make data queries to plot charts.
+    request: Django request object, or jobs.JobContext; used to make data
+      queries to plot charts.
     rawJS: A list of Polychart2.js chart or numeral specifications.
 
   Returns:
@@ -134,61 +166,83 @@ def _processJS(request, rawJS):
     are in the form of a list of dictionaries. These dictionaries have keys
     that specify an SVG attribute and the value specifies the associated value.
   """
+  if not rawJS:
+    return []
+  query = _dataQuery(request)
+
+  def render(js):
+    try:
+      return converse(lambda socket: _renderItem(socket, query, js))
+    finally:
+      close_connection() # of the worker thread, should it have queried Django
+
+  workers = ThreadPool(min(len(rawJS), settings.EXPORT_RENDER_WORKERS))
+  try:
+    rendered = workers.map(render, rawJS)
+  finally:
+    workers.close()
+    workers.join()
+  return [scene for scenes in rendered for scene in scenes]
+
+def _renderItem(socket, query, js):
+  """
+  Helper holding the conversation rendering one item with the export service:
+  the spec is sent, then for each layer of a chart, or once for other items, the
+  service asks for data, which is queried and sent back, and answers with the
+  rendered scene.
+
+  Args:
+    socket: A renderService.RenderSocket.
+    query: A function of a data spec returning the data; see _dataQuery.
+    js: A Polychart2.js chart, numeral or pivot table specification.
+
+  Returns:
+    A list of the rendered scenes; see _getRendered.
+  """
+  itemType = js['itemType']
+  js['spec']['width']  = js['position']['width'] * GRID_SIZE
+  js['spec']['height'] = js['position']['height'] * GRID_SIZE
+  socket.send({ 'type': 'spec'
+              , 'spec': json.dumps(js['spec']) })
+
+  rounds   = len(js['spec']['layers']) if itemType == 'ChartItem' else 1
   rendered = []
-  for js in rawJS:
-    ws = websocket.create_connection("ws://localhost:%s/" % settings.EXPORT_SERVICE_PORT)
-    js['spec']['width']  = js['position']['width'] * GRID_SIZE
-    js['spec']['height'] = js['position']['height'] * GRID_SIZE
-    ws.send(urlencode({ 'type': 'spec'
-                      , 'spec': json.dumps(js['spec']) }))
-    if js['itemType'] == 'NumeralItem':
-      spec   = json.loads(unquote(ws.recv()))
-      result = _getData(request, spec)
-      ws.send(urlencode({ 'type':     'queryData'
-                        , 'numeral':  True
-                        , 'blob':     json.dumps(result) }))
-      renderedSpec    = ws.recv()
-      renderedNumeral = _getRendered('NumeralItem', renderedSpec, js)
-      rendered.append(renderedNumeral)
-    elif js['itemType'] == 'ChartItem':
-      for _ in js['spec']['layers']:
-        spec   = json.loads(unquote(ws.recv()))
-        result = _getData(request, spec)
-        ws.send(urlencode({ 'type':   'queryData'
-                          , 'layer':  spec['layer']
-                          , 'blob':   json.dumps(result)
-                          }))
-        renderedSpec  = ws.recv()
-        renderedChart = _getRendered('ChartItem', renderedSpec, js)
-        rendered.append(renderedChart)
-    elif js['itemType'] == 'PivotTableItem':
-      spec   = json.loads(unquote(ws.recv()))
-      result = _getData(request, spec)
-      ws.send(urlencode({ 'type':   'queryData'
-                        , 'table':  True
-                        , 'blob':   json.dumps(result) }))
-      renderedSpec  = ws.recv()
-      renderedChart = _getRendered('PivotTableItem', renderedSpec, js)
-      rendered.append(renderedChart)
-    ws.close()
+  for _ in range(rounds):
+    spec    = json.loads(unquote(socket.recv()))
+    message = { 'type': 'queryData'
+              , 'blob': json.dumps(query(spec)) }
+    if itemType == 'NumeralItem':
+      message['numeral'] = True
+    elif itemType == 'ChartItem':
+      message['layer'] = spec['layer']
+    elif itemType == 'PivotTableItem':
+      message['table'] = True
+    socket.send(message)
+    rendered.append(_getRendered(itemType, socket.recv(), js))
   return rendered
 
-def _getData(request, spec):
+def _dataQuery(request):
   """
-  Helper function to query for data.
+  Helper building the function querying for data, safe to call from several
+  threads. Connections are looked up once per data source.
 
   Args:
-    request: A Django request object; for querying tables.
-    spec: A data spec object. See 'abstract.DataSourceConnection.queryTable' for
-      more details.
+    request: A Django request object, or jobs.JobContext; for querying tables.
 
   Returns:
-    A dictionary with fields 'data' and 'meta' representing a Polychart2.js formatted
-    data object.
+    A function of a data spec object (see
+    'abstract.DataSourceConnection.queryTable'), returning a dictionary with
+    fields 'data' and 'meta' representing a Polychart2.js formatted data object.
   """
-  tableName, dsKey = getDsInfo(spec)[0]
-  connection       = getConnection(request, dsKey)
-  return connection.queryTable(tableName, spec, 1000)
+  lock        = Lock()
+  connections = {}
+  def query(spec):
+    tableName, dsKey = getDsInfo(spec)[0]
+    with lock:
+      if dsKey not in connections:
+        connections[dsKey] = getConnection(request, dsKey)
+    return connections[dsKey].queryTable(tableName, spec, 1000)
+  return query
 
 def _getRendered(itemType, renderedObj, dashSpec):
   """
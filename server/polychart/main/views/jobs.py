@@ -0,0 +1,22 @@
+"""
+Django handlers for background jobs; see polychart.main.utils.jobs.
+"""
+from django.views.decorators.http import require_GET
+
+from polychart.main.models     import Job
+from polychart.main.utils.jobs import getJob, jobStatus
+from polychart.utils           import jsonResponse
+
+@require_GET
+def jobPoll(request, key):
+  """
+  Handler giving the status of a job queued by the user, or session, of the
+  request; see jobs.jobStatus.
+  """
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  try:
+    job = getJob(request, key)
+  except Job.DoesNotExist:
+    return jsonResponse({'status': 'error', 'error': 'Unknown job: ' + key}, status=404)
+  return jsonResponse(jobStatus(job))
@@ -2,22 +2,23 @@
 Module to deal with uploading data.
 """
 import json
-import os
 
+from django.conf                    import settings
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http   import require_POST
+from django.views.decorators.http   import require_GET, require_POST
 
 from polychart.main.models          import LocalDataSource, PendingDataSource
-from polychart.main.utils.csvParser import parseForPolychart, parseForPreview
+from polychart.main.utils.csvParser import parseForPreview
+from polychart.main.utils.jobs      import enqueue, jobStatus
+from polychart.main.utils.rawUpload import ChunkError, RawUpload, rawPath
 from polychart.utils                import jsonResponse
 
 @require_POST
 @login_required
 def getKey(request):
   """
-  Provides a key to upload to. This structure will be useful if/when we enable
-  chunking of uploads. If data contains a key already, we're uploading a new
-  version of the dataset. This functionality is unused for the moment.
+  Provides a key to upload to. If data contains a key already, we're uploading
+  a new version of the dataset, or rows to append to it; see cleanCsv.
   """
   # pylint: disable = E1101
   # Pylint does not notice Django model attributes.
@@ -26,7 +27,7 @@ def getKey(request):
   pds  = PendingDataSource.objects.create(user = user, params_json = data)
   if 'key' in data:
     try:
-      lds = LocalDataSource.objects.get(user=user, datasource__key=data['key'])
+      lds = LocalDataSource.objects.get(datasource__user=user, datasource__key=data['key'])
       lds.pendingdatasource = pds
       lds.save()
     except LocalDataSource.DoesNotExist:
@@ -34,14 +35,24 @@ def getKey(request):
   pds.params_json['key'] = pds.key
   pds.save()
 
-  return jsonResponse({'key': pds.key})
+  return jsonResponse({ 'key':       pds.key
+                      , 'chunkSize': settings.UPLOAD_CHUNK_BYTES
+                      , 'maxSize':   settings.UPLOAD_MAX_BYTES
+                      })
 
 @require_POST
 @login_required
 def postFile(request, pdsKey, index='0'):
   """
-  Handler to upload data. Validates the key and index, and dumps the raw content
-  of the request to a file.
+  Handler to upload data, a chunk at a time. Validates the key and index, and
+  appends the content of the request to the raw file as it is read; see
+  utils.rawUpload. The query string may give:
+    offset: The offset of the chunk in the file; 0, i.e. the whole file, if
+      not given.
+    crc32: The CRC-32 of the chunk, in hexadecimal.
+
+  The response gives the offset to send the next chunk from, which is also
+  that to resume from if the chunk was rejected.
   """
   # pylint: disable = E1101
   # Pylint does not notice Django model attributes.
@@ -55,12 +66,34 @@ def postFile(request, pdsKey, index='0'):
   # trying to write to 'uploadedData/raw/../../foo'
   pds = PendingDataSource.objects.get(key=str(pdsKey), user=user)
 
-  if not os.path.exists('uploadedData/raw/'):
-    os.makedirs('uploadedData/raw/')
-  with open("uploadedData/raw/%s-%s" % (pds.key, index), 'wU') as f:
-    f.write(request.body)
+  try:
+    offset = int(request.GET.get('offset', 0))
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    crc32  = request.GET.get('crc32')
+    crc32  = int(crc32, 16) if crc32 else None
+  except ValueError:
+    return jsonResponse({'status': 'error', 'error': 'Invalid chunk parameters'})
 
-  return jsonResponse({'status': 'success'})
+  upload = RawUpload(pds.key, index, settings.UPLOAD_MAX_BYTES)
+  try:
+    offset = upload.append(request, offset, length, crc32)
+  except ChunkError as e:
+    return jsonResponse({'status': 'error', 'error': str(e), 'offset': e.offset})
+
+  return jsonResponse({'status': 'success', 'offset': offset})
+
+@require_GET
+@login_required
+def uploadStatus(request, pdsKey, index='0'):
+  """
+  Handler giving the number of bytes of a file uploaded so far, i.e. the
+  offset to resume uploading it from.
+  """
+  # pylint: disable = E1101
+  # Pylint does not notice Django model attributes.
+  pds = PendingDataSource.objects.get(key=str(pdsKey), user=request.user)
+
+  return jsonResponse({'status': 'success', 'offset': RawUpload(pds.key, index).size()})
 
 @require_POST
 @login_required
@@ -82,7 +115,7 @@ def previewCsv(request, key, index='0'):
 
   pds = PendingDataSource.objects.get(key=str(key), user=user)
 
-  with open("uploadedData/raw/%s-%s" % (pds.key, index), 'rU') as f:
+  with open(rawPath(pds.key, index), 'rU') as f:
     parsed = parseForPreview(f, data)
     return jsonResponse(parsed)
 
@@ -91,8 +124,14 @@ def previewCsv(request, key, index='0'):
 def cleanCsv(request, key):
   """
   Handler to clean uploaded CSV data. Unlike previewCsv, this function expects a
-  parsing config for all of the tables. It parses each in turn, and dumps the
-  whole list into the database in JSON format.
+  parsing config for all of the tables. The files are parsed in the background,
+  by a 'cleanCsv' job (see utils.csvJobs), and stored column-wise under
+  LOCAL_DATA_ROOT; the database only keeps track of where. This returns at
+  once, with the status of the job; poll it for its progress (see views.jobs).
+
+  If data has `mode` 'append', and the upload is for an existing data set (see
+  getKey), the rows of each file are instead appended to the table of the data
+  set with the same name, or else the same index.
   """
   # pylint: disable = E1101
   # Pylint does not notice Django model attributes.
@@ -103,12 +142,10 @@ def cleanCsv(request, key):
   pds = PendingDataSource.objects.get(key=str(key),user=user)
   (lds, _) = LocalDataSource.objects.get_or_create(pendingdatasource=pds)
 
-  lds.json = []
-
-  for index, format in enumerate(data['tables']):
-    with open("uploadedData/raw/%s-%s" % (pds.key, index), 'rU') as f:
-      lds.json.append(parseForPolychart(f, format))
-
-  lds.save()
+  if data.get('mode') == 'append' and lds.datasource is None:
+    return jsonResponse({'status': 'error', 'error': 'There is no data set to append to'})
 
-  return jsonResponse({'status': 'success'})
+  job = enqueue(request, 'cleanCsv', { 'key':    pds.key
+                                     , 'mode':   data.get('mode', 'replace')
+                                     , 'tables': data['tables'] })
+  return jsonResponse(jobStatus(job))
@@ -42,6 +42,21 @@ def jsonResponse(data, status=200):
                      , content_type = 'application/json'
                      , status = status)
 
+def jsonTextResponse(text, status=200):
+  """
+  Like jsonResponse, for data which has already been encoded as JSON.
+
+  Args:
+    text: A JSON string.
+    status: Optional status for the HttpResponse object.
+
+  Returns:
+    HttpResponse object with the JSON content type and the given text.
+  """
+  return HttpResponse( text
+                     , content_type = 'application/json'
+                     , status = status)
+
 def template(templateName):
   """
   Simple shortcut for indicating in a Django routing file that a template
@@ -2,6 +2,7 @@
 Module that defines the abstract interface for DataSourceConnection objects.
 This module also defines the `retry` decorator and a few error classes.
 """
+import json
 import traceback
 
 from base64    import urlsafe_b64encode
@@ -11,8 +12,13 @@ from hashlib   import sha256
 from os        import urandom
 from time      import time
 
+from polychartQuery.utils import canonicalize
+
 logger = getLogger(__name__)
 
+CACHE_KEY_VERSION = 3    # bump to invalidate cached results after format changes
+STREAM_BATCH_SIZE = 1000 # rows fetched and encoded at a time by streamTable
+
 class DsConnError(Exception):
   """
   Thrown to indicate that a data source connection experienced an error.
@@ -70,7 +76,7 @@ class DataSourceConnection(object):
     """
     raise NotImplementedError('data source connection did not implement getColumnMetadata')
 
-  def queryTable(self, tableName, querySpec, limit):
+  def queryTable(self, tableName, querySpec, limit, columnar=False):
     """
     Any querying action posed by the clientside code will pass its request to this
     method.
@@ -89,15 +95,73 @@ class DataSourceConnection(object):
           }
       limit: An integer specifying the maximum number of results to return. If
         not provided, 1000 is default.
+      columnar: Optional boolean; if set, the 'data' field of the result is a
+        dictionary of {columnName: [values...]} instead of a list of rows.
     """
     raise NotImplementedError('data source connection did not implement queryTable')
 
-  def generateCacheKey(self, querySql, params):
+  def queryTableJson(self, tableName, querySpec, limit, compat=True):
+    """
+    Like queryTable, but returns the JSON encoding of the (row-wise) result.
+    Connections which can encode results more efficiently than `json.dumps`
+    of the result of queryTable override this.
+
+    Args:
+      tableName, querySpec, limit: See queryTable.
+      compat: Optional boolean. If set, the output must match `json.dumps` of
+        the result of queryTable exactly; otherwise, connections may encode
+        values according to the column types of the query meta instead. See
+        encoder.ResultEncoder.
+
+    Returns:
+      A JSON string.
     """
-    Internal helper for caching.
+    return json.dumps(self.queryTable(tableName, querySpec, limit))
+
+  def streamTable(self, tableName, querySpec, limit, batchSize=STREAM_BATCH_SIZE,
+                  compat=True):
+    """
+    Streaming counterpart to queryTableJson, for large results. Connections able
+    to fetch results incrementally override this; by default, the result of
+    queryTableJson is returned all at once.
+
+    Args:
+      tableName, querySpec, limit, compat: See queryTableJson.
+      batchSize: Optional number of rows to fetch and encode at a time.
+
+    Returns:
+      An iterator of strings which, concatenated, are the result of
+      queryTableJson. Any query errors are raised when the first string is
+      requested.
+    """
+    yield self.queryTableJson(tableName, querySpec, limit, compat)
+
+  def ping(self):
+    """
+    Health check used by connection pools before reusing an idle connection.
+
+    Returns:
+      A boolean denoting whether the connection is still usable.
+    """
+    return getattr(self, 'opened', True)
+
+  def generateCacheKey(self, methodName, args):
+    """
+    Internal helper for caching. The key is a fingerprint of the method name and
+    the canonical form of its arguments (see utils.canonicalize), scoped by
+    `_cacheId`. Connections sharing a `_cacheId`, such as every connection to the
+    same data source, therefore share cache entries; callers must have checked
+    that the user may access the data source before using the cache.
+
+    Args:
+      methodName: Name of the connection method being cached.
+      args: The arguments passed to the method.
+
+    Returns:
+      A string usable as a cache key.
     """
-    parts = [self._cacheId, querySql, params]
-    hashedParts = sha256(repr(parts)).hexdigest()
+    parts = [CACHE_KEY_VERSION, self._cacheId, methodName, canonicalize(args)]
+    hashedParts = sha256(json.dumps(parts, sort_keys=True, separators=(',', ':'))).hexdigest()
     return __name__ + '::' + hashedParts
 
 #### Helper functions
@@ -2,24 +2,35 @@
 A Singleton-like module for managing datasource connections.
 
 Attribs:
-  _CONNECTION_POOL: A dictionary containing active datasource connections. The keys are the
-    a pair with first member session key and second member data source key; the
-    values are the datasource connection object.
+  _CONNECTION_POOLS: A PoolRegistry holding a pool of active datasource connections
+    per data source. The keys are pairs with first member the user ID and second
+    member the data source key, so that all sessions of a user share connections.
 
 Exported:
   runMethod: A function which dispatches datasource connection methods.
+  createDataSourceJob: Creates a data source, as a background job.
   getConnection: Find a connection with a given key.
+  closeConnections: Close all pooled connections to a data source.
   RedirectRequired: An exception that carries redirect information
 
 Private Methods:
   _saveConnection: Saves a connection in the data source pool.
+  _configureConnection: Sets up the slow query log of a new connection.
   _createDsArgs: Helper to change from client side data source arguments to backend ones.
 """
+import json
+
 from logging import getLogger
 
+from django.conf import settings
+
 from polychart.main.models   import DataSource, LocalDataSource, PendingDataSource
+from polychart.main.utils      import secureStorage
+from polychart.main.utils.jobs import JobError
 from polychartQuery.abstract import DsConnError
 from polychartQuery.oauth    import oauthRedirect
+from polychartQuery.pool     import PoolRegistry, PooledConnection
+from polychartQuery.slowQuery import SlowQueryLog
 
 #
 # Module Constants
@@ -40,8 +51,8 @@ def createDataSource(request, clientDsObj):
   Method to create a data source.
 
   Args:
-    request: Django request object; used for secure storage key, Django user object
-      and session key.
+    request: Django request object, or jobs.JobContext; used for secure storage
+      key, Django user object and session key.
     clientDsObj: A dictionary containing arguments for creating a data source connection.
       See `_createDsArgs` for more details.
 
@@ -57,7 +68,6 @@ def createDataSource(request, clientDsObj):
   """
   user             = request.user
   secureStorageKey = request.session['secureStorageKey']
-  sessionKey       = request.session.session_key
 
   dsArgs = _createDsArgs(clientDsObj, user)
   ds     = DataSource.create(secureStorageKey, dsArgs)
@@ -65,6 +75,7 @@ def createDataSource(request, clientDsObj):
   try: # Try opening connection before saving
     dsConn = ds.openConnection(request, secureStorageKey)
     ds.save()
+    _configureConnection(dsConn, ds)
 
     # See if there are any pending data sources, especially with local data
     if 'key' in clientDsObj:
@@ -82,7 +93,7 @@ def createDataSource(request, clientDsObj):
         pass
 
     # Cache connection for later
-    _saveConnection(sessionKey, ds.key, dsConn)
+    _saveConnection(user, ds.key, dsConn)
 
     return {
       'status': 'success'
@@ -106,35 +117,86 @@ def createDataSource(request, clientDsObj):
       }
     }
 
+def createDataSourceJob(context, params):
+  """
+  Handler of 'createDataSource' jobs (see polychart.main.utils.jobs), which
+  create data sources in the background, as connecting to them, e.g. through
+  an SSH tunnel, may take a while.
+
+  Args:
+    context: The jobs.JobContext, standing in for the request.
+    params: A dictionary with the 'cipher' of the JSON encoded clientDsObj (see
+      createDataSource), encrypted with the secure storage key of the session,
+      so that credentials are not stored in the clear in the job queue.
+
+  Returns:
+    A dictionary with the 'key' of the new data source, or, if the user must
+    first authorize access to it, the URL to 'redirect' to.
+
+  Raises:
+    JobError: Thrown when the data source could not be connected to.
+  """
+  secureStorageKey = context.session['secureStorageKey']
+  clientDsObj      = json.loads(secureStorage.decrypt(secureStorageKey, str(params['cipher'])))
+  try:
+    result = createDataSource(context, clientDsObj)
+  except RedirectRequired as red:
+    return {'redirect': red.url}
+  if result['status'] == 'error':
+    raise JobError(result['error'].get('message') or 'Unable to connect to the data source')
+  return {'key': result['key']}
+
 def getConnection(request, dsKey):
   """
-  Method to attempt to get a specifc connection from the connection pool.
+  Method to get a connection to a data source backed by the connection pool.
 
   Args:
-    request: Django request object; needed for the secure storage key and session
+    request: Django request object; needed for the user and the secure storage
       key.
     dsKey: The datasource key corresponding to desired datasource.
 
   Returns:
-    A data source connection object.
-  """
-  sessionKey = request.session.session_key
+    A data source connection object. Each method call on it runs on a pooled
+    connection which is checked out for the duration of the call.
 
-  dsConn = _CONNECTION_POOL.get((sessionKey, dsKey))
-
-  if dsConn and dsConn.opened:
-    return dsConn
-  elif dsConn: # Connection has died, remove from pool
-    del _CONNECTION_POOL[(sessionKey, dsKey)]
+  Raises:
+    DataSource.DoesNotExist: Thrown when the user has no such data source.
+  """
+  user = request.user
 
   # pylint: disable = E1101
   # For some reason, pylint does not recognize Django models as having 'objects' attribute
-  dataSource = DataSource.objects.get(user=request.user, key=dsKey)
-  dsConn = dataSource.openConnection(request, request.session['secureStorageKey'])
+  # Authorize up front, rather than only when a new connection is opened
+  dataSource       = DataSource.objects.get(user=user, key=dsKey)
+  secureStorageKey = request.session['secureStorageKey']
 
-  _saveConnection(sessionKey, dsKey, dsConn)
+  def openConnection():
+    conn = dataSource.openConnection(request, secureStorageKey)
+    _configureConnection(conn, dataSource)
+    return conn
+
+  # Results are cached by data source rather than by connection, so that they
+  # are shared between sessions, connections and worker processes. Uploaded
+  # data can be appended to, which changes its version, and so the cache keys.
+  cacheId = 'ds:' + str(dsKey)
+  if dataSource.type in LOCAL_DATA_SOURCES:
+    cacheId += ':' + LocalDataSource.objects.get(datasource=dataSource).version()
+
+  return PooledConnection( _CONNECTION_POOLS.get(_poolKey(user, dsKey))
+                         , openConnection
+                         , cacheId = cacheId
+                         , dsKey   = str(dsKey)
+                         , dsType  = dataSource.type )
+
+def closeConnections(user, dsKey):
+  """
+  Method to close all pooled connections to a data source, e.g. upon deletion.
 
-  return dsConn
+  Args:
+    user: A Django user object owning the data source.
+    dsKey: The datasource key corresponding to the data source.
+  """
+  _CONNECTION_POOLS.discard(_poolKey(user, dsKey))
 
 class RedirectRequired(Exception):
   """
@@ -151,23 +213,49 @@ class RedirectRequired(Exception):
 # Private Functions
 #
 
-_CONNECTION_POOL = {}
+_CONNECTION_POOLS = PoolRegistry( maxPools        = settings.DATA_SOURCE_POOL_MAX_POOLS
+                                 , maxSize         = settings.DATA_SOURCE_POOL_SIZE
+                                 , idleTimeout     = settings.DATA_SOURCE_POOL_IDLE_TIMEOUT
+                                 , checkoutTimeout = settings.DATA_SOURCE_POOL_CHECKOUT_TIMEOUT
+                                 )
+
+def _poolKey(user, dsKey):
+  """Helper to build the _CONNECTION_POOLS key for a user's data source."""
+  return (user.pk, str(dsKey))
 
-def _saveConnection(sessionKey, dsKey, connection):
+def _saveConnection(user, dsKey, connection):
   """
   Method to handle caching of data sources.
 
   Args:
-    sessionKey: A Django session key.
+    user: A Django user object owning the data source.
     dsKey: The datasource key corresponding to the data source.
     connection: An object representing the data source connection.
 
   Returns:
-    Void; simply stashes the connection in the _CONNECTION_POOL variable.
+    Void; simply adds the connection to the data source's pool in _CONNECTION_POOLS.
   """
-  _CONNECTION_POOL[(sessionKey, dsKey)] = connection
-
+  _CONNECTION_POOLS.get(_poolKey(user, dsKey)).add(connection)
 
+def _configureConnection(connection, dataSource):
+  """
+  Helper to give a newly opened connection a slow query log, if it supports
+  one. SLOW_QUERY_THRESHOLDS may be keyed by data source key or type, the former
+  taking precedence over the latter and over SLOW_QUERY_THRESHOLD; a threshold
+  of None turns slow query logging off.
+  """
+  if not hasattr(connection, 'slowQueryLog'):
+    return
+  thresholds = settings.SLOW_QUERY_THRESHOLDS
+  threshold  = settings.SLOW_QUERY_THRESHOLD
+  for key in (dataSource.type, dataSource.key):
+    if key in thresholds:
+      threshold = thresholds[key]
+  if threshold is not None:
+    connection.slowQueryLog = SlowQueryLog( threshold
+                                          , settings.SLOW_QUERY_EXPLAIN
+                                          , str(dataSource.key)
+                                          , dataSource.type )
 
 def _createDsArgs(clientDsObj, user):
   """
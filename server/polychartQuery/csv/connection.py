@@ -1,12 +1,172 @@
 """
-Module defining a dummy CSV connection.
+Module implementing connections to uploaded CSV data, stored column-wise on
+disk (see csv.storage) and queried in process.
 """
-from polychartQuery.abstract import DataSourceConnection
+from polychartQuery.abstract    import DataSourceConnection
+from polychartQuery.csv.expr    import Frame, exprToPython
+from polychartQuery.csv.query   import CsvQuery
+from polychartQuery.csv.storage import NULL_VALUE, openTables, tablesStamp
+from polychartQuery.expr        import getExprValidator
+
+METADATA_VALUES_LIMIT = 100 # distinct values listed for categorical columns
 
 class Conn(DataSourceConnection):
   """
-  Dummy class (for now)
+  Class representing a connection to a data set of uploaded tables.
+
+  Attribs:
+    path: The directory of the data set.
+    opened: Always True; there is nothing to disconnect from.
+    _tables: Ordered dictionary of table names to csv.storage.Tables.
+    _stamp: The csv.storage.tablesStamp of the data set when _tables was opened.
+
+  Public Methods:
+    listTables: Lists tables; see DataSourceConnection.listTables.
+    queryTable: Queries tables; see DataSourceConnection.queryTable.
+    getColumnMetadata: Metadata for columns; see DataSourceConnection.getColumnMetadata.
+
+  Private Methods:
+    _refresh: Reopens the tables if the data set changed, e.g. was appended to.
+    _getTable: Looks up a table by name.
+    _getStats: Returns the statistics of a stored column, if they apply.
+    _getColumns: Returns the columns of a table, keyed by full column name.
   """
-  def __init__(self, *args, **kwargs):
-    super(Conn, self).__init__(*args, **kwargs)
-    pass
+  def __init__(self, path=None, **kwargs):
+    super(Conn, self).__init__()
+    self.path    = path
+    self.opened  = True
+    self._tables = {}
+    self._stamp  = None
+    self._refresh()
+
+  def listTables(self):
+    self._refresh()
+    return [ {'name': name, 'meta': table.meta()}
+               for name, table in self._tables.iteritems() ]
+
+  def getColumnMetadata(self, tableName, columnExpr, dataType):
+    """
+    Returns the meta data for a given column. See
+    DataSourceConnection.getColumnMetadata for more information. For stored
+    columns, it comes from the statistics computed when they were written;
+    other expressions are evaluated over the table.
+
+    Raises:
+      ValueError: Thrown when the table or column is unknown.
+    """
+    table = self._getTable(tableName)
+    cols  = self._getColumns(table)
+    getExprValidator(cols.keys())(columnExpr)
+
+    stats = self._getStats(table, columnExpr['expr'], dataType)
+    if stats is not None:
+      if dataType == 'cat':
+        return {'values': stats['values'][:METADATA_VALUES_LIMIT]}
+      if stats['min'] is None:
+        return {'min': 0, 'max': 0}
+      return {'min': stats['min'], 'max': stats['max']}
+
+    isAggregate, fn = exprToPython(columnExpr['expr'])
+    if isAggregate:
+      raise ValueError( "csv.connection.Conn.getColumnMetadata"
+                      , "Aggregate expressions have no column metadata.")
+    values = fn(Frame(cols, table.numRows))
+    if dataType == 'cat':
+      seen = []
+      for value in values:
+        value = NULL_VALUE if value is None else value
+        if value not in seen:
+          seen.append(value)
+          if len(seen) >= METADATA_VALUES_LIMIT:
+            break
+      return {'values': seen}
+
+    values = [value for value in values if value is not None]
+    if not values:
+      return {'min': 0, 'max': 0}
+    return {'min': min(values), 'max': max(values)}
+
+  def queryTable(self, tableName, querySpec, limit, columnar=False):
+    """
+    Queries a table. See DataSourceConnection.queryTable for more information.
+
+    Raises:
+      ValueError: Thrown when the querySpec is not a dictionary, or the table
+        is unknown.
+    """
+    if not isinstance(querySpec, dict):
+      raise ValueError( "csv.connection.Conn.queryTable"
+                      , "Invalid parameter type: {0}".format(type(querySpec)))
+    table   = self._getTable(tableName)
+    columns = []
+    for colName, colType in table.columns:
+      fullName = "{0}.{1}".format(tableName, colName)
+      columns.append((fullName, colType))
+      if fullName in querySpec['meta']:
+        querySpec['meta'][fullName]['type'] = colType
+
+    def queryFunc(name):
+      queried = self._getTable(name)
+      return self._getColumns(queried), queried.numRows
+
+    query = CsvQuery(tableName, querySpec, limit, queryFunc, columns, columnar)
+    return query.getData()
+
+  ### Internal Methods
+
+  def _refresh(self):
+    """Reopens the tables if the data set changed, e.g. was appended to."""
+    if not self.path:
+      return
+    stamp = tablesStamp(self.path)
+    if stamp != self._stamp:
+      self._tables = openTables(self.path)
+      self._stamp  = stamp
+
+  def _getTable(self, tableName):
+    self._refresh()
+    table = self._tables.get(tableName)
+    if table is None:
+      raise ValueError( "csv.connection.Conn"
+                      , "Unknown table name: {table}".format(table=tableName))
+    return table
+
+  def _getStats(self, table, expr, dataType):
+    """
+    Returns:
+      The statistics of the column `expr` refers to, if it is a stored column
+      of type `dataType` with statistics, or else None.
+    """
+    tag, fields = expr
+    if tag != 'ident' or not fields['name'].startswith(table.name + '.'):
+      return None
+    name = fields['name'][len(table.name) + 1:]
+    if table.columnType(name) != dataType:
+      return None
+    stats = table.stats(name)
+    return stats if ('values' in stats or 'min' in stats) else None
+
+  def _getColumns(self, table):
+    """
+    Returns:
+      A dictionary of full column names, e.g. 'table.column', to the lists of
+      values of the columns; columns are only read once used.
+    """
+    return _LazyColumns(table)
+
+class _LazyColumns(dict):
+  """A dictionary of a table's full column names to values, loaded on access."""
+  def __init__(self, table):
+    super(_LazyColumns, self).__init__()
+    self._table  = table
+    self._prefix = table.name + '.'
+    self._names  = [self._prefix + name for name, _ in table.columns]
+
+  def keys(self):
+    return list(self._names)
+
+  def __missing__(self, fullName):
+    if not fullName.startswith(self._prefix):
+      raise KeyError(fullName)
+    values = self[fullName] = self._table.values(fullName[len(self._prefix):])
+    return values
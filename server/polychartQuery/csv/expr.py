@@ -0,0 +1,320 @@
+"""
+Evaluation of expression trees over stored CSV tables.
+
+Expressions are compiled, by `exprToPython`, into Python functions mirroring
+the SQL produced by sql.expr.ExprToSql: missing values (None) propagate like
+NULL, aggregates skip them, and bins map values to the start of their bin.
+
+Evaluation is a column at a time: a compiled expression is a pair
+(isAggregate, fn), where for scalar expressions fn takes a Frame and returns
+the list of the expression's values, one per row of the frame; for aggregate
+ones, fn takes a Frame and a list of groups, each a list of positions in the
+frame, and returns one value per group. The expression tree is thus walked once
+per query rather than once per row, and the per-row work is done by list
+comprehensions over whole columns.
+"""
+import math
+import operator
+
+from datetime  import datetime, timedelta
+from itertools import izip
+
+from polychartQuery.csv.values import toTimestamp
+from polychartQuery.expr       import ExprTreeVisitor, memoizeExpr
+from polychartQuery.utils      import isNumber
+
+EPOCH = datetime(1970, 1, 1)
+
+# Bin widths of dates as (unit, number of units), like the SQL dialects
+TIME_BUCKETS = { 'second':   ('second', 1)
+               , 'minute':   ('minute', 1)
+               , 'hour':     ('hour',   1)
+               , 'day':      ('day',    1)
+               , 'week':     ('week',   1)
+               , 'month':    ('month',  1)
+               , 'twoMonth': ('month',  2)
+               , 'quarter':  ('month',  3)
+               , 'sixMonth': ('month',  6)
+               , 'year':     ('year',   1)
+               , 'twoYear':  ('year',   2)
+               , 'fiveYear': ('year',   5)
+               , 'decade':   ('year',  10)
+               }
+
+class Frame(object):
+  """
+  The rows of a table an expression is evaluated over.
+
+  Attribs:
+    cols: A mapping of full column names to the lists of values of the table.
+    rows: A list of the indices of the rows in the frame, or None for all rows.
+    size: The number of rows in the frame.
+
+  Public Methods:
+    column: Returns the values of a column for the rows of the frame.
+    select: Returns the frame of a subset of the rows.
+  """
+  def __init__(self, cols, size, rows=None):
+    self.cols = cols
+    self.size = size
+    self.rows = rows
+    self._columns = {}
+
+  def __len__(self):
+    return self.size
+
+  def column(self, name):
+    """
+    Returns:
+      The list of values; it is shared, and must not be modified.
+    """
+    values = self._columns.get(name)
+    if values is None:
+      values = self.cols[name]
+      if self.rows is not None:
+        values = [values[i] for i in self.rows]
+      self._columns[name] = values
+    return values
+
+  def select(self, keep):
+    """
+    Args:
+      keep: A list of booleans, one per row of the frame.
+
+    Returns:
+      A Frame of the rows for which `keep` is true.
+    """
+    rows = xrange(self.size) if self.rows is None else self.rows
+    rows = [i for i, kept in izip(rows, keep) if kept]
+    return Frame(self.cols, len(rows), rows)
+
+class ExprToPython(ExprTreeVisitor):
+  """Compiles expression trees into (isAggregate, fn) pairs; see module doc."""
+  def __init__(self):
+    self.fns = {
+      'log':        _elementwise(math.log)
+      # string functions
+    , 'length':     _elementwise(len)
+    , 'upper':      _elementwise(lambda s: s.upper())
+    , 'lower':      _elementwise(lambda s: s.lower())
+    , 'parseNum':   _perValue(_parseNum)
+    , 'substr':     _elementwise(lambda s, start, length: s[int(start):int(start)+int(length)])
+    , 'indexOf':    _elementwise(lambda s, sub: s.find(sub))
+      # date functions
+    , 'year':       _dateField(lambda d: d.year)
+    , 'month':      _dateField(lambda d: d.month)
+    , 'dayOfMonth': _dateField(lambda d: d.day)
+    , 'dayOfYear':  _dateField(lambda d: d.timetuple().tm_yday)
+    , 'dayOfWeek':  _dateField(lambda d: (d.weekday() + 1) % 7 + 1) # 1 is Sunday
+    , 'week':       _dateField(lambda d: int(d.strftime('%U')))
+    , 'hour':       _dateField(lambda d: d.hour)
+    , 'minute':     _dateField(lambda d: d.minute)
+    , 'second':     _dateField(lambda d: d.second)
+      # for backend use only
+    , 'unix':       lambda values: values
+    }
+    self.aggregates = {
+      'count':  lambda values: sum(1 for v in values if v is not None)
+    , 'mean':   _nonEmpty(lambda values: sum(values) / float(len(values)))
+    , 'median': _nonEmpty(_median)
+    , 'max':    _nonEmpty(max)
+    , 'min':    _nonEmpty(min)
+    , 'sum':    _nonEmpty(sum)
+    , 'unique': lambda values: len(set(v for v in values if v is not None))
+    }
+    self.infixops = {
+      '+':  _elementwise(operator.add)
+    , '-':  _elementwise(operator.sub)
+    , '*':  _elementwise(operator.mul)
+    , '/':  _elementwise(_divide)
+    , '%':  _elementwise(_modulo)
+    , '>':  _elementwise(operator.gt)
+    , '<':  _elementwise(operator.lt)
+    , '>=': _elementwise(operator.ge)
+    , '<=': _elementwise(operator.le)
+    , '!=': _elementwise(operator.ne)
+    , '==': _elementwise(operator.eq)
+    , '++': _elementwise(lambda a, b: unicode(a) + unicode(b))
+    }
+
+  def ident(self, name):
+    return False, lambda frame: frame.column(name)
+
+  def const(self, type, value):
+    if type == 'num':
+      value = float(value)
+    fn = lambda frame: [value] * len(frame)
+    fn.constant = value
+    return False, fn
+
+  def infixop(self, opname, lhs, rhs):
+    if opname not in self.infixops:
+      raise Exception("Unknown polyjs operation %s" % opname)
+    return _apply(self.infixops[opname], [lhs, rhs])
+
+  def conditional(self, cond, conseq, altern):
+    def choose(conds, conseqs, alterns):
+      return [a if c else b for c, a, b in izip(conds, conseqs, alterns)]
+    return _apply(choose, [cond, conseq, altern])
+
+  def call(self, fname, args):
+    if fname in self.aggregates:
+      return self._aggregate(self.aggregates[fname], args[0])
+    if fname in self.fns:
+      return _apply(self.fns[fname], args)
+    if fname == 'bin':
+      return self.fn_bin(args)
+    raise Exception("Unknown polyjs function %s" % fname)
+
+  def fn_bin(self, args):
+    key, (_, bwFn) = args
+    bw = bwFn.constant
+    if isNumber(bw):
+      bw = float(bw)
+      def binNum(values):
+        return [None if v is None else round(v / bw) * bw for v in values]
+      return _apply(binNum, [key])
+    if bw not in TIME_BUCKETS:
+      raise Exception("Unknown bin width %s" % bw)
+    return _apply(_perValue(timeBucket(*TIME_BUCKETS[bw])), [key])
+
+  def _aggregate(self, aggFn, (isAggregate, fn)):
+    if isAggregate:
+      raise ValueError("csv.expr.ExprToPython", "Nested aggregates are not supported")
+    def aggregate(frame, groups):
+      values = fn(frame)
+      return [aggFn([values[pos] for pos in group]) for group in groups]
+    return True, aggregate
+
+@memoizeExpr('python')
+def exprToPython(expr):
+  return exprToPythonInstance.visit(expr)
+
+def evalGroups(node, frame, groups):
+  """
+  Evaluates a compiled expression for groups of rows of a frame: aggregates
+  over each group, and scalars for the first row of each, as MySQL does for
+  non-grouped columns.
+
+  Returns:
+    A list of values, one per group.
+  """
+  isAggregate, fn = node
+  if isAggregate:
+    return fn(frame, groups)
+  values = fn(frame)
+  return [values[group[0]] if group else None for group in groups]
+
+def timeBucket(unit, step=1):
+  """
+  Returns a function mapping a unix timestamp to the timestamp of the start of
+  its bucket. Buckets spanning several months are aligned to the start of the
+  year, and those spanning several years to multiples of `step`.
+  """
+  def bucket(timestamp):
+    date = EPOCH + timedelta(seconds=timestamp)
+    if unit == 'second':
+      date = date.replace(microsecond=0)
+    elif unit == 'minute':
+      date = date.replace(second=0, microsecond=0)
+    elif unit == 'hour':
+      date = date.replace(minute=0, second=0, microsecond=0)
+    elif unit == 'day':
+      date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'week': # weeks start on Sunday
+      date = date.replace(hour=0, minute=0, second=0, microsecond=0) \
+           - timedelta(days=(date.weekday() + 1) % 7)
+    elif unit == 'month':
+      date = datetime(date.year, date.month - (date.month - 1) % step, 1)
+    elif unit == 'year':
+      date = datetime(date.year - date.year % step, 1, 1)
+    return toTimestamp(date)
+  return bucket
+
+#### Helper functions
+
+def _apply(fn, args):
+  """
+  Combines compiled arguments with a function of their lists of values. If any
+  argument is an aggregate, so is the result; scalar arguments are then taken
+  from the first row of each group.
+  """
+  if not any(isAggregate for isAggregate, _ in args):
+    argFns = [argFn for _, argFn in args]
+    if len(argFns) == 1:
+      argFn, = argFns
+      return False, lambda frame: fn(argFn(frame))
+    return False, lambda frame: fn(*[argFn(frame) for argFn in argFns])
+  return True, lambda frame, groups: fn(*[evalGroups(arg, frame, groups) for arg in args])
+
+def _nullSafe(fn):
+  """Wraps a function so that it returns None if any argument is None."""
+  def safe(*args):
+    for arg in args:
+      if arg is None:
+        return None
+    try:
+      return fn(*args)
+    except (ValueError, TypeError, ArithmeticError):
+      return None
+  return safe
+
+def _elementwise(fn):
+  """
+  Lifts a function of values to lists of values, null-safely. The common case
+  runs as a single comprehension; should any value raise, the lists are
+  evaluated again a value at a time, failures becoming None.
+  """
+  def apply(*lists):
+    try:
+      if len(lists) == 1:
+        return [None if a is None else fn(a) for a in lists[0]]
+      if len(lists) == 2:
+        return [ None if a is None or b is None else fn(a, b)
+                   for a, b in izip(*lists) ]
+    except (ValueError, TypeError, ArithmeticError):
+      pass
+    return map(_nullSafe(fn), *lists)
+  return apply
+
+def _perValue(fn):
+  """
+  Lifts a costly function of values to lists of values, evaluating it once per
+  distinct value; e.g. dates, which repeat a lot, and are costly to bucket.
+  """
+  fn = _nullSafe(fn)
+  def apply(values):
+    results = {value: fn(value) for value in set(values)}
+    return [results[value] for value in values]
+  return apply
+
+def _nonEmpty(fn):
+  """Wraps an aggregate function to skip missing values, like SQL does."""
+  def aggregate(values):
+    values = [v for v in values if v is not None]
+    return fn(values) if values else None
+  return aggregate
+
+def _dateField(fn):
+  return _perValue(lambda timestamp: fn(EPOCH + timedelta(seconds=timestamp)))
+
+def _divide(a, b):
+  return a / float(b) if b else None
+
+def _modulo(a, b):
+  return math.fmod(a, b) if b else None
+
+def _parseNum(value):
+  if isinstance(value, (int, long, float)):
+    return value
+  return float(value)
+
+def _median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+# Created last, as the compiler's tables use the helpers above
+exprToPythonInstance = ExprToPython()
@@ -0,0 +1,148 @@
+"""
+Implementation of querying stored CSV tables for Polychart Dashboard Builder.
+"""
+from polychartQuery.csv.expr import Frame, evalGroups, exprToPython
+from polychartQuery.query    import DbbQuery
+
+FILTER_OPS = [ ('ge', lambda v, x: v >= x)
+             , ('gt', lambda v, x: v > x)
+             , ('le', lambda v, x: v <= x)
+             , ('lt', lambda v, x: v < x)
+             , ('eq', lambda v, x: v == x)
+             ]
+
+class CsvQuery(DbbQuery):
+  """
+  A query over a stored CSV table, evaluated in process. Expressions are
+  compiled by csv.expr.exprToPython, and the query runs like its SQL
+  counterpart would: rows are filtered, grouped, aggregated, sorted and limited.
+  Each step works on whole columns; see csv.expr.
+
+  The queryFunc is called with the table name, and returns a mapping of full
+  column names (i.e. 'table.column') to lists of values, and the number of rows.
+
+  Private Methods:
+    _combinePieces: Gathers the compiled pieces of the query into a plan.
+    _executeQuery: Runs a plan against the table's columns.
+    _formatResult: Formats the resulting rows; see DbbQuery._formatResult.
+  """
+  def _translate(self, expr):
+    return exprToPython(expr)
+
+  def _combinePieces(self, queryFields, joins, groups, filters):
+    if joins:
+      raise ValueError( "csv.query.CsvQuery._combinePieces"
+                      , "Joins are not supported for uploaded data.")
+    predicates = []
+    for obj in filters:
+      if obj['name'] not in self.jsSpec['meta']:
+        raise ValueError( "csv.query.CsvQuery._combinePieces"
+                        , "No meta info for {field}.".format(field=obj['name']))
+      predicates.append((obj['translated'], _filterPredicate(obj)))
+    return { 'select':     queryFields
+           , 'groups':     groups
+           , 'predicates': predicates
+           , 'sort':       self.sort.items()
+           }
+
+  def _executeQuery(self, plan):
+    cols, numRows = self.queryFunc(self.tableName)
+
+    frame = Frame(cols, numRows)
+    for (_, fn), predicate in plan['predicates']:
+      frame = frame.select(predicate(fn(frame)))
+
+    groups = plan['groups']
+    if groups:
+      groups = _groupPositions([fn(frame) for _, fn in groups])
+    elif any(isAggregate for isAggregate, _ in plan['select']):
+      groups = [range(len(frame))]
+    else:
+      groups = None
+
+    if groups is None: # one result row per row
+      columns  = [fn(frame) for _, fn in plan['select']]
+      sortKeys = [fn(frame) for (_, fn), _ in plan['sort']]
+    else:
+      columns  = [evalGroups(node, frame, groups) for node in plan['select']]
+      sortKeys = [evalGroups(node, frame, groups) for node, _ in plan['sort']]
+
+    # Stable sorts, applied from the least significant key; missing values first
+    order = range(len(columns[0]) if columns else 0)
+    for keys, (_, asc) in reversed(zip(sortKeys, plan['sort'])):
+      order.sort(key=lambda i: (keys[i] is not None, keys[i]), reverse=not asc)
+
+    if self.limit:
+      order = order[:self.limit]
+    return [[column[i] for column in columns] for i in order]
+
+  def _formatResult(self, result):
+    meta = self.jsSpec['meta']
+    if self.columnar:
+      data = {}
+      for i, name in enumerate(self.selectOrder):
+        data[str(name)] = [_formatValue(meta[name]['type'], row[i]) for row in result]
+      return {'data': data, 'meta': meta}
+
+    rows = []
+    for row in result:
+      rows.append({ str(name): _formatValue(meta[name]['type'], row[i])
+                      for i, name in enumerate(self.selectOrder) })
+    return {'data': rows, 'meta': meta}
+
+#### Helper functions
+
+def _filterPredicate(obj):
+  """
+  Builds a function of a list of values returning a list of booleans, telling
+  whether the filter `obj` keeps each value. As in SQL, comparisons with
+  missing values fail; `notnull` is as in SqlQuery._combinePieces.
+  """
+  checks = []
+  if 'in' in obj:
+    allowed = set(obj['in'])
+    checks.append(lambda v: v in allowed)
+  for op, compare in FILTER_OPS:
+    if op in obj:
+      checks.append(lambda v, compare=compare, x=obj[op]: compare(v, x))
+
+  def matches(values):
+    keep = [v is not None for v in values]
+    for check in checks:
+      keep = [kept and check(v) for kept, v in zip(keep, values)]
+    return keep
+
+  if 'notnull' not in obj or obj['notnull']: # missing values never match anyway
+    return matches
+  if not checks:
+    return lambda values: [True] * len(values)
+  return lambda values: [v is None or kept for kept, v in zip(matches(values), values)]
+
+def _groupPositions(keyColumns):
+  """
+  Args:
+    keyColumns: The lists of values of the grouping expressions.
+
+  Returns:
+    A list of groups, in order of first appearance, each being the list of
+    positions of its rows.
+  """
+  keys   = keyColumns[0] if len(keyColumns) == 1 else zip(*keyColumns)
+  groups = {}
+  order  = []
+  for pos, key in enumerate(keys):
+    group = groups.get(key)
+    if group is None:
+      group = groups[key] = []
+      order.append(group)
+    group.append(pos)
+  return order
+
+def _formatValue(colType, value):
+  """Formats a value of the result; like SQL sources, NULL numbers become 0."""
+  if colType in ('num', 'date'):
+    if value is None:
+      return 0
+    if isinstance(value, float) and value.is_integer():
+      return int(value)
+  return value
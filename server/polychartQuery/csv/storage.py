@@ -0,0 +1,547 @@
+"""
+Columnar on-disk storage of uploaded tables.
+
+Each table is stored in its own directory, holding:
+  table.json: The manifest: the table name, number of rows and, per column, its
+    name, type ('num', 'date' or 'cat'), date format if any, and statistics:
+    the number of missing values, an estimate of the number of distinct
+    values, min and max for numeric and date columns, and the first values
+    (in order of appearance) of categorical ones.
+  <i>.values: The values of the i-th column as a flat binary array in native
+    byte order. Numeric and date columns hold doubles (dates as unix
+    timestamps), NaN marking missing values. Categorical columns are dictionary
+    encoded: they hold 32-bit indices into the column's string pool, -1 marking
+    missing values.
+  <i>.pool: The string pool of a categorical column, as a JSON list.
+  <i>.sketch: The sketch the distinct estimate of a numeric or date column is
+    computed from: the smallest hashes of its values, as doubles.
+
+The manifest is written last, so a directory without one holds no table. A data
+set of several tables is a directory of table directories, e.g. as written by
+csvParser.ingestCsv for an upload.
+
+Rows are appended to a table by writing past the end of its column files, and
+then a new manifest: readers only read as many values as the manifest they
+opened says there are, so they see the table either before or after.
+
+Exported:
+  TableWriter: Builds a table, a row at a time, and writes it out.
+  TableAppender: Appends rows to a stored table.
+  Table: Reads a stored table.
+  openTables: Opens all tables of a data set.
+  tablesStamp: Returns a value which changes whenever a data set does.
+  tableLock: Serializes appends to a table.
+  writeTable: Stores a table given as a dictionary of columns.
+"""
+import fcntl
+import heapq
+import json
+import os
+
+from array       import array
+from collections import OrderedDict
+from contextlib  import contextmanager
+from itertools   import izip
+
+from polychartQuery.csv.values import dateParser, parseNum
+
+MANIFEST_NAME      = 'table.json'
+LOCK_NAME          = 'table.lock'
+STORAGE_VERSION    = 1
+FLOAT_TYPECODE     = 'd'
+CODE_TYPECODE      = 'i'
+MISSING_CODE       = -1
+STATS_VALUES_LIMIT = 100  # first values of categorical columns kept in stats
+SKETCH_SIZE        = 1024 # hashes kept to estimate distinct counts
+READ_CHUNK_ITEMS   = 65536 # values of a column file read at a time
+NULL_VALUE         = "Null" # stands for missing values in listed values
+
+class TableWriter(object):
+  """
+  Builds a table a row at a time, keeping each column in a compact typed array,
+  and writes it out on `close`.
+
+  Attribs:
+    path: The directory to write the table to.
+    name: The name of the table.
+    columns: A list of (column name, type) pairs.
+    formats: A list of the date format of each column, or None.
+    fill: The text short rows are padded with; None for missing values.
+    numRows: The number of rows appended so far.
+
+  Public Methods:
+    addColumn: Adds a column, filled for the rows appended so far.
+    append: Appends a row of text values.
+    close: Writes the table out.
+  """
+  def __init__(self, path, name, columns, fill=None):
+    self.path     = path
+    self.name     = name
+    self.columns  = []
+    self.formats  = []
+    self.fill     = fill
+    self.numRows  = 0
+    self._columns = []
+    self._base    = None # the Table appended to, if any
+    for colName, colType in columns:
+      self.addColumn(colName, colType)
+
+  def addColumn(self, name, colType, format=None):
+    """
+    Args:
+      name: The name of the column.
+      colType: The type of the column; unknown types are categorical.
+      format: Optional strptime format of the values of a date column.
+    """
+    if colType not in COLUMN_BUILDERS:
+      colType = 'cat'
+    column = COLUMN_BUILDERS[colType](format) if colType == 'date' else COLUMN_BUILDERS[colType]()
+    column.extend(self.fill, self.numRows)
+    self.columns.append((name, colType))
+    self.formats.append(format if colType == 'date' else None)
+    self._columns.append(column)
+
+  def append(self, row):
+    """
+    Args:
+      row: A sequence of unicode strings, one per column; short rows are padded
+        with `fill`, and extra values are ignored.
+    """
+    for column, text in izip(self._columns, row):
+      column.append(text)
+    for column in self._columns[len(row):]:
+      column.append(self.fill)
+    self.numRows += 1
+
+  def close(self):
+    """Writes the column files, then the manifest."""
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+    base    = self._base
+    columns = []
+    for i, column in enumerate(self._columns):
+      name, colType = self.columns[i]
+      prefix = os.path.join(self.path, str(i))
+      if base is None:
+        stats = column.write(prefix)
+      else:
+        stats = column.write(prefix, base.numRows, base.stats(name))
+      columns.append({ 'name':   name
+                     , 'type':   colType
+                     , 'format': self.formats[i]
+                     , 'stats':  stats
+                     })
+    manifest = { 'version': STORAGE_VERSION
+               , 'name':    self.name
+               , 'numRows': self.numRows + (base.numRows if base else 0)
+               , 'columns': columns
+               }
+    _writeJson(os.path.join(self.path, MANIFEST_NAME), manifest)
+
+class TableAppender(TableWriter):
+  """
+  Appends rows to a stored table, keeping its columns and their types; see
+  TableWriter. Statistics of the table are updated with those of the new rows.
+
+  Attribs:
+    table: The Table appended to.
+  """
+  def __init__(self, table, fill=None):
+    super(TableAppender, self).__init__(table.path, table.name, [], fill)
+    self.table = table
+    for name, colType in table.columns:
+      super(TableAppender, self).addColumn(name, colType, table.format(name))
+      if colType == 'cat':
+        self._columns[-1].seed(table.pool(name), table.stats(name))
+    self._base = table
+
+  def addColumn(self, name, colType, format=None):
+    raise ValueError( "csv.storage.TableAppender"
+                    , "Rows to append to table {0} have more columns than it".format(self.name))
+
+class Table(object):
+  """
+  A stored table. Columns are read from disk when first used, and kept as lists
+  of values; their raw arrays are only read a chunk at a time, and not kept.
+
+  Attribs:
+    path: The directory of the table.
+    name: The name of the table.
+    numRows: The number of rows.
+    columns: A list of (column name, type) pairs.
+
+  Public Methods:
+    meta: Returns the column types in the form of query meta.
+    columnType: Returns the type of a column.
+    format: Returns the date format of a column.
+    stats: Returns the statistics of a column.
+    values: Returns the values of a column.
+    codes: Returns the dictionary codes and string pool of a categorical column.
+    pool: Returns the string pool of a categorical column.
+  """
+  def __init__(self, path):
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+      manifest = json.load(f)
+    self.path     = path
+    self.name     = manifest['name']
+    self.numRows  = manifest['numRows']
+    self.columns  = [(col['name'], col['type']) for col in manifest['columns']]
+    self._formats = [col.get('format') for col in manifest['columns']]
+    self._stats   = [col.get('stats') or {} for col in manifest['columns']]
+    self._index   = {name: i for i, (name, _) in enumerate(self.columns)}
+    self._values  = {}
+    self._pools   = {}
+
+  def meta(self):
+    return OrderedDict((name, {'type': colType}) for name, colType in self.columns)
+
+  def columnType(self, name):
+    return self.columns[self._column(name)][1]
+
+  def format(self, name):
+    return self._formats[self._column(name)]
+
+  def stats(self, name):
+    """
+    Returns:
+      A dictionary of the statistics of a column computed when it was written:
+      `nulls` and `distinct`, and `min` and `max` (None if there are no values)
+      for numeric and date columns, or `values` for categorical ones; NULL_VALUE
+      stands for missing values there.
+    """
+    return self._stats[self._column(name)]
+
+  def values(self, name):
+    """
+    Returns:
+      A list of the values of a column: floats for numeric and date columns,
+      unicode strings for categorical ones, and None for missing values.
+    """
+    values = self._values.get(name)
+    if values is None:
+      if self.columnType(name) == 'cat':
+        pool   = self.pool(name) + [None] # so that MISSING_CODE (-1) maps to None
+        values = [pool[code] for chunk in self._chunks(name) for code in chunk]
+      else:
+        values = [None if v != v else v for chunk in self._chunks(name) for v in chunk]
+      self._values[name] = values
+    return values
+
+  def codes(self, name):
+    """
+    Returns:
+      A pair of the array of dictionary codes of a categorical column, read
+      anew on each call, and its string pool.
+    """
+    codes = array(CODE_TYPECODE)
+    for chunk in self._chunks(name):
+      codes.extend(chunk)
+    return codes, self.pool(name)
+
+  def pool(self, name):
+    """Returns the string pool of a categorical column."""
+    if name not in self._pools:
+      index = self._column(name)
+      with open(os.path.join(self.path, '{0}.pool'.format(index))) as f:
+        self._pools[name] = json.load(f)
+    return self._pools[name]
+
+  def _column(self, name):
+    index = self._index.get(name)
+    if index is None:
+      raise ValueError( "csv.storage.Table"
+                      , "Unknown column {0} in table {1}".format(name, self.name))
+    return index
+
+  def _chunks(self, name):
+    """
+    Helper reading the raw array of a column, READ_CHUNK_ITEMS values at a
+    time, so that it is never held in memory besides the values built from it.
+    """
+    index     = self._column(name)
+    typecode  = CODE_TYPECODE if self.columnType(name) == 'cat' else FLOAT_TYPECODE
+    remaining = self.numRows
+    with open(os.path.join(self.path, '{0}.values'.format(index)), 'rb') as f:
+      while remaining > 0:
+        chunk = array(typecode)
+        chunk.fromfile(f, min(remaining, READ_CHUNK_ITEMS))
+        remaining -= len(chunk)
+        yield chunk
+
+def openTables(path):
+  """
+  Args:
+    path: The directory of a data set.
+
+  Returns:
+    An ordered dictionary of table names to Tables, ordered as the table
+    directories, which are named by index.
+  """
+  tables = OrderedDict()
+  if not os.path.isdir(path):
+    return tables
+  for entry in sorted(os.listdir(path), key=_indexKey):
+    tablePath = os.path.join(path, entry)
+    if os.path.isfile(os.path.join(tablePath, MANIFEST_NAME)):
+      table = Table(tablePath)
+      tables[table.name] = table
+  return tables
+
+def tablesStamp(path):
+  """
+  Args:
+    path: The directory of a data set.
+
+  Returns:
+    A value which changes whenever a table of the data set is written or
+    appended to, as its manifest is then replaced.
+  """
+  if not os.path.isdir(path):
+    return ()
+  stamp = []
+  for entry in sorted(os.listdir(path)):
+    try:
+      stat = os.stat(os.path.join(path, entry, MANIFEST_NAME))
+    except OSError:
+      continue
+    stamp.append((entry, stat.st_ino, stat.st_mtime, stat.st_size))
+  return tuple(stamp)
+
+@contextmanager
+def tableLock(path):
+  """
+  Holds an exclusive lock on a table, across processes, e.g. while appending to
+  it; the table should be opened once the lock is held.
+  """
+  with open(os.path.join(path, LOCK_NAME), 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+def writeTable(path, name, meta, data):
+  """
+  Stores a table given column-wise, e.g. in the format uploaded data used to be
+  kept in, {'name': ..., 'meta': {col: {'type': ...}}, 'data': {col: [...]}}.
+
+  Args:
+    path: The directory to write the table to.
+    name: The name of the table.
+    meta: A dictionary of column names to {'type': ...}.
+    data: A dictionary of column names to lists of values.
+  """
+  names  = [colName for colName in data]
+  writer = TableWriter(path, name, [(colName, meta.get(colName, {}).get('type', 'cat'))
+                                      for colName in names])
+  for row in zip(*[data[colName] for colName in names]):
+    writer.append([None if v is None else unicode(v) for v in row])
+  writer.close()
+
+#### Column builders
+
+class NumColumn(object):
+  """Builds a numeric column."""
+  def __init__(self):
+    self.values = array(FLOAT_TYPECODE)
+    self.parse  = parseNum
+
+  def append(self, text):
+    value = self.parse(text)
+    self.values.append(NAN if value is None else value)
+
+  def extend(self, text, count):
+    value = self.parse(text)
+    self.values.extend(array(FLOAT_TYPECODE, [NAN if value is None else value]) * count)
+
+  def write(self, prefix, baseRows=0, baseStats=None):
+    """
+    Writes the column, after the first `baseRows` values of the stored column
+    if appending to it, and returns its statistics, combined with `baseStats`.
+    """
+    _writeArray(prefix + '.values', self.values, baseRows)
+    present = [v for v in self.values if v == v]
+    sketch  = distinctSketch(present)
+    stats   = { 'nulls': len(self.values) - len(present)
+              , 'min':   min(present) if present else None
+              , 'max':   max(present) if present else None
+              }
+    if baseRows:
+      sketch = mergeSketches([_readArray(prefix + '.sketch', FLOAT_TYPECODE), sketch])
+      stats  = _mergeStats(baseStats, stats)
+    _writeArray(prefix + '.sketch', array(FLOAT_TYPECODE, sketch))
+    if stats is not None:
+      stats['distinct'] = estimateDistinct(sketch)
+    return stats
+
+class DateColumn(NumColumn):
+  """Builds a date column, of unix timestamps."""
+  def __init__(self, format=None):
+    super(DateColumn, self).__init__()
+    self.parse = dateParser(format)
+
+class CatColumn(object):
+  """Builds a dictionary encoded categorical column."""
+  def __init__(self):
+    self.codes = array(CODE_TYPECODE)
+    self.pool  = []
+    self.nulls = 0
+    self._lookup = {}
+    self._nullAt = None # the position of missing values in order of appearance
+
+  def append(self, text):
+    if text is None:
+      self.codes.append(MISSING_CODE)
+      self.nulls += 1
+      if self._nullAt is None:
+        self._nullAt = len(self.pool)
+      return
+    code = self._lookup.get(text)
+    if code is None:
+      code = self._lookup[text] = len(self.pool)
+      self.pool.append(text)
+    self.codes.append(code)
+
+  def extend(self, text, count):
+    if count:
+      self.append(text)
+      self.codes.extend(self.codes[-1:] * (count - 1))
+      if text is None:
+        self.nulls += count - 1
+
+  def seed(self, pool, stats):
+    """
+    Continues the dictionary of a stored column, so that appended values have
+    the same codes.
+
+    Args:
+      pool: The string pool of the stored column.
+      stats: The statistics of the stored column.
+    """
+    self.pool    = list(pool)
+    self._lookup = {text: code for code, text in enumerate(self.pool)}
+    values = stats.get('values', [])
+    if NULL_VALUE in values:
+      self._nullAt = values.index(NULL_VALUE)
+    elif stats.get('nulls'):
+      self._nullAt = STATS_VALUES_LIMIT # missing values, listed past the limit
+
+  def write(self, prefix, baseRows=0, baseStats=None):
+    """
+    Writes the column, after the first `baseRows` values of the stored column
+    if appending to it, and returns its statistics, combined with `baseStats`.
+    """
+    _writeArray(prefix + '.values', self.codes, baseRows)
+    _writeJson(prefix + '.pool', self.pool)
+    nulls = self.nulls
+    if baseRows:
+      if 'nulls' not in baseStats:
+        return None
+      nulls += baseStats['nulls']
+    values = self.pool[:STATS_VALUES_LIMIT]
+    if self._nullAt is not None and self._nullAt < STATS_VALUES_LIMIT:
+      values.insert(self._nullAt, NULL_VALUE)
+    return { 'nulls':    nulls
+           , 'distinct': len(self.pool) + (1 if nulls else 0)
+           , 'values':   values[:STATS_VALUES_LIMIT]
+           }
+
+COLUMN_BUILDERS = { 'num':  NumColumn
+                  , 'date': DateColumn
+                  , 'cat':  CatColumn
+                  }
+
+NAN = float('nan')
+
+#### Distinct count estimation
+
+def distinctSketch(values, size=SKETCH_SIZE):
+  """
+  Args:
+    values: An iterable of hashable values.
+    size: The number of hashes to keep.
+
+  Returns:
+    The `size` smallest distinct hashes of the values, mapped to [0, 1), in
+    increasing order; the "k minimum values" sketch of the values. Sketches of
+    parts of a column can be merged with mergeSketches.
+  """
+  heap = [] # negated, so that the largest kept hash is on top
+  kept = set()
+  for value in values:
+    h = _unitHash(value)
+    if h in kept:
+      continue
+    if len(heap) < size:
+      heapq.heappush(heap, -h)
+      kept.add(h)
+    elif h < -heap[0]:
+      kept.discard(-heapq.heappushpop(heap, -h))
+      kept.add(h)
+  return sorted(-h for h in heap)
+
+def mergeSketches(sketches, size=SKETCH_SIZE):
+  """Returns the sketch of the union of the values of several sketches."""
+  return sorted(set(h for sketch in sketches for h in sketch))[:size]
+
+def estimateDistinct(sketch, size=SKETCH_SIZE):
+  """
+  Returns:
+    The estimated number of distinct values a sketch was computed from; exact
+    if there were fewer than `size`.
+  """
+  if len(sketch) < size:
+    return len(sketch)
+  return int(round((size - 1) / sketch[-1]))
+
+#### Helper functions
+
+def _writeArray(path, values, offset=0):
+  """
+  Writes an array to a file, after its first `offset` items; anything past
+  them, e.g. left by an append which did not complete, is overwritten.
+  """
+  if not offset:
+    with open(path, 'wb') as f:
+      values.tofile(f)
+    return
+  with open(path, 'r+b') as f:
+    f.truncate(offset * values.itemsize)
+    f.seek(0, os.SEEK_END)
+    values.tofile(f)
+
+def _readArray(path, typecode):
+  """Reads a whole file into an array; empty if there is no file."""
+  values = array(typecode)
+  if os.path.isfile(path):
+    with open(path, 'rb') as f:
+      values.fromstring(f.read())
+  return values
+
+def _mergeStats(stored, appended):
+  """
+  Combines the statistics of a numeric or date column with those of rows
+  appended to it; None if the stored column has none.
+  """
+  if not stored or 'nulls' not in stored:
+    return None
+  present = [stats for stats in (stored, appended) if stats['min'] is not None]
+  return { 'nulls': stored['nulls'] + appended['nulls']
+         , 'min':   min(stats['min'] for stats in present) if present else None
+         , 'max':   max(stats['max'] for stats in present) if present else None
+         }
+
+def _writeJson(path, obj):
+  """Writes a JSON file, atomically replacing any previous version."""
+  tmpPath = path + '.tmp'
+  with open(tmpPath, 'w') as f:
+    json.dump(obj, f)
+  os.rename(tmpPath, path)
+
+def _unitHash(value):
+  """Hashes a value to [0, 1), spreading the hashes of nearby numbers apart."""
+  return ((hash(value) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) / 18446744073709551616.0
+
+def _indexKey(entry):
+  """Sorts table directories by index, then name."""
+  return (0, int(entry)) if entry.isdigit() else (1, entry)
@@ -0,0 +1,142 @@
+"""
+Parsing of the text values of uploaded CSV files into typed values.
+
+Numbers are stored as floats and dates as unix timestamps (seconds, UTC), like
+SQL data sources send them to the client; values which do not parse are
+missing, represented by None.
+
+Exported:
+  parseNum: Parses the text of a numeric value.
+  parseDate: Parses the text of a date value into a unix timestamp.
+  dateParser: Returns a parser of dates in a given format.
+  inferType: Infers the type of a column from a sample of its values.
+"""
+import calendar
+import re
+
+from datetime import datetime
+from dateutil import parser as dateutilParser
+
+# Characters commonly used to format numbers, e.g. "$1,234.50" or "12%"
+NUM_NOISE = re.compile(u'[,$\u20ac\u00a3%\\s]')
+
+# Common formats, tried before falling back to dateutil's much slower parser
+DATE_FORMATS = [ '%Y-%m-%d'
+               , '%Y-%m-%d %H:%M:%S'
+               , '%Y-%m-%dT%H:%M:%S'
+               , '%Y-%m-%d %H:%M'
+               , '%Y/%m/%d'
+               , '%m/%d/%Y'
+               , '%m/%d/%Y %H:%M:%S'
+               , '%m/%d/%Y %H:%M'
+               , '%d-%b-%Y'
+               , '%b %d, %Y'
+               ]
+
+EPOCH = datetime(1970, 1, 1)
+
+# Share of the non-empty values in a sample which must parse for a column to
+# be inferred numeric or a date, allowing for the odd footnote or typo
+INFER_THRESHOLD = 0.95
+
+def parseNum(text):
+  """
+  Args:
+    text: A string.
+
+  Returns:
+    The value as a float, or None if it is not a number.
+  """
+  try:
+    return float(text)
+  except (TypeError, ValueError):
+    pass
+  if not text:
+    return None
+  try:
+    return float(NUM_NOISE.sub('', text))
+  except ValueError:
+    return None
+
+def parseDate(text, formats=DATE_FORMATS):
+  """
+  Args:
+    text: A string; either a date or a unix timestamp.
+    formats: Optional list of strptime formats to try first.
+
+  Returns:
+    The value as a unix timestamp, or None if it is not a date. Times without
+    a time zone are taken to be UTC.
+  """
+  if not text:
+    return None
+  text = text.strip()
+  for format in formats:
+    try:
+      return toTimestamp(datetime.strptime(text, format))
+    except ValueError:
+      pass
+  try:
+    return float(text)
+  except ValueError:
+    pass
+  try:
+    return toTimestamp(dateutilParser.parse(text, default=EPOCH))
+  except (ValueError, OverflowError, TypeError):
+    return None
+
+def toTimestamp(value):
+  """Converts a datetime, naive ones being in UTC, to a unix timestamp."""
+  seconds = calendar.timegm(value.utctimetuple())
+  return float(seconds) + value.microsecond / 1e6
+
+def dateParser(format=None):
+  """
+  Args:
+    format: A strptime format, e.g. as detected by inferType, or None.
+
+  Returns:
+    A function parsing text like parseDate, trying `format` first.
+  """
+  if format is None:
+    return parseDate
+  formats = [format] + [other for other in DATE_FORMATS if other != format]
+  return lambda text: parseDate(text, formats)
+
+def inferType(sample):
+  """
+  Args:
+    sample: A list of the text values of a column.
+
+  Returns:
+    A pair of the type of the column, 'num', 'date' or 'cat', and for dates,
+    the strptime format most values are in, or None if they are in several.
+  """
+  values = [value.strip() for value in sample if value and value.strip()]
+  if not values:
+    return 'cat', None
+  enough = INFER_THRESHOLD * len(values)
+
+  if _countParsed(parseNum, values) >= enough:
+    return 'num', None
+  for format in DATE_FORMATS:
+    if _countParsed(lambda text: datetime.strptime(text, format), values, ValueError) >= enough:
+      return 'date', format
+  # Only now try the slower formats; plain numbers are not dates
+  notNum = lambda text: parseDate(text, []) if parseNum(text) is None else None
+  if _countParsed(notNum, values) >= enough:
+    return 'date', None
+  return 'cat', None
+
+#### Helper functions
+
+def _countParsed(parse, values, errors=()):
+  """Counts the values `parse` returns something other than None for."""
+  count = 0
+  for value in values:
+    try:
+      if parse(value) is not None:
+        count += 1
+    except errors:
+      pass
+  return count
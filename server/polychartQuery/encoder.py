@@ -0,0 +1,206 @@
+"""
+Single-pass JSON encoding of row-wise query results.
+
+Query results used to be formatted into row dictionaries of strings, rebuilt by
+`utils.saneEncode` (which trial parses every value) and then serialized with
+`json.dumps`. A `ResultEncoder` instead writes JSON text straight from the
+DB-API row tuples, choosing an encoding function per column once, up front.
+
+Two modes are supported:
+  compat: Output matches `json.dumps(saneEncode(...))` of the old row format
+    byte for byte, including the order of keys. Integer and float values skip
+    trial parsing; other values still go through `tryParse`, as e.g. numeric
+    looking strings have always been sent as numbers.
+  typed: Values are coerced according to the column type in the query meta
+    (see sql.query.COLUMN_COERCERS), so strings stay strings, and keys appear
+    in the order of the select.
+
+Exported:
+  ResultEncoder: Encodes the rows of a query as JSON.
+"""
+import json
+
+from decimal import Decimal
+from time    import time
+
+from polychartQuery.timing import record
+from polychartQuery.utils  import saneEncode, tryParse
+
+INFINITY = float('inf')
+
+_dumps = json.JSONEncoder().encode # shared, default-configured encoder
+
+class ResultEncoder(object):
+  """
+  Encodes raw rows of a query as the JSON of {"data": [rows...], "meta": meta}.
+
+  Attribs:
+    names: Column names, in the order of the values in each row.
+    meta: The query meta, mapping column names to {"type": ...}.
+    compat: Whether to match the output of saneEncode and json.dumps exactly.
+
+  Public Methods:
+    encode: Encodes all rows of a result into a JSON document.
+    encodeChunks: Encodes batches of rows into parts of a JSON document.
+    encodeRows: Encodes rows into a comma separated list of JSON objects.
+  """
+  def __init__(self, names, meta, compat=True):
+    self.names  = names
+    self.meta   = meta
+    self.compat = compat
+    self._fields = self._compileFields()
+
+  def encode(self, rows):
+    """
+    Args:
+      rows: A sequence of row tuples.
+
+    Returns:
+      A JSON string.
+    """
+    return ''.join(self.encodeChunks([rows]))
+
+  def encodeChunks(self, batches):
+    """
+    Generator encoding batches of rows as they come. Nothing is yielded before
+    the first batch is read, so that errors reading it reach the first caller.
+    Time spent encoding is recorded as the 'encode' phase.
+
+    Args:
+      batches: An iterable of sequences of row tuples.
+
+    Returns:
+      A generator of strings which, concatenated, form a JSON document.
+    """
+    head, tail = self._frame()
+    sep = head
+    for rows in batches:
+      if rows:
+        startTime = time()
+        chunk = sep + self.encodeRows(rows)
+        record('encode', time() - startTime)
+        yield chunk
+        sep = ', '
+    yield (head if sep is head else '') + tail
+
+  def encodeRows(self, rows):
+    """
+    Args:
+      rows: A sequence of row tuples.
+
+    Returns:
+      The JSON objects for the rows, separated by ', '.
+    """
+    fields = self._fields
+    return ', '.join(
+      '{' + ', '.join(key + encodeValue(row[i]) for key, i, encodeValue in fields) + '}'
+        for row in rows)
+
+  def _compileFields(self):
+    """
+    Helper to determine, once per result, the order of keys in each row object
+    and the function encoding each column.
+
+    Returns:
+      A list of (encoded key followed by ': ', row index, value encoder).
+    """
+    if not self.compat:
+      return [ (_dumps(name) + ': ', i, TYPED_ENCODERS.get(self._type(name), _typedCat))
+               for i, name in enumerate(self.names) ]
+
+    # Rebuild the dictionaries of the old format to iterate over keys in the
+    # same order; later duplicate names win, as they did there.
+    positions = {}
+    for i, name in enumerate(self.names):
+      positions[name] = i
+    encoded = {}
+    for name in positions:
+      encoded[str(name)] = name
+    fields = []
+    for key, name in encoded.iteritems():
+      isNum = self._type(name) in ('num', 'date')
+      fields.append((_dumps(key) + ': ', positions[name],
+                     _compatNum if isNum else _compatValue))
+    return fields
+
+  def _frame(self):
+    """Helper returning the JSON text around the rows."""
+    meta = self.meta
+    if self.compat:
+      meta = saneEncode(meta)
+      keys = {str(key): None for key in {'data': None, 'meta': None}}.keys()
+    else:
+      keys = ['data', 'meta']
+    if keys[0] == 'data':
+      return '{"data": [', '], "meta": ' + _dumps(meta) + '}'
+    return '{"meta": ' + _dumps(meta) + ', "data": [', ']}'
+
+  def _type(self, name):
+    return self.meta[name]['type']
+
+#### Value encoders
+
+def _encodeFloat(value):
+  """Encodes a float as json.dumps does."""
+  if value != value:
+    return 'NaN'
+  if value == INFINITY:
+    return 'Infinity'
+  if value == -INFINITY:
+    return '-Infinity'
+  return repr(value)
+
+def _compatValue(value):
+  """Encodes a value as str() followed by saneEncode did."""
+  valueType = type(value)
+  if valueType is int or valueType is long:
+    return str(value)
+  if valueType is float:
+    return _encodeFloat(float(str(value))) # str() rounds to 12 digits
+  return _dumps(tryParse(str(value)))
+
+def _compatNum(value):
+  """Like _compatValue, for numeric and date columns, where NULL became 0."""
+  if value is None:
+    return '0'
+  return _compatValue(value)
+
+def _typedNum(value):
+  valueType = type(value)
+  if valueType is int or valueType is long:
+    return str(value)
+  if value is None:
+    return '0'
+  try:
+    return _encodeFloat(float(value))
+  except (TypeError, ValueError): # e.g. a string in a column typed by the client
+    return _typedCat(value)
+
+def _typedDate(value):
+  valueType = type(value)
+  if valueType is int or valueType is long:
+    return str(value)
+  if value is None:
+    return '0'
+  if valueType is float or isinstance(value, Decimal):
+    return _encodeFloat(float(value))
+  return _typedCat(value) # e.g. datetime objects
+
+def _typedCat(value):
+  if value is None:
+    return 'null'
+  valueType = type(value)
+  if valueType is str:
+    return _dumps(value.decode('utf-8', 'ignore'))
+  if valueType is unicode:
+    return _dumps(value)
+  if valueType is int or valueType is long:
+    return str(value)
+  if valueType is float or isinstance(value, Decimal):
+    return _encodeFloat(float(value))
+  return _dumps(unicode(value))
+
+TYPED_ENCODERS = { 'num':  _typedNum
+                 , 'date': _typedDate
+                 , 'cat':  _typedCat
+                 }
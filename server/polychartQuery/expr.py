@@ -1,6 +1,11 @@
 """
 Abstract expression related helper functions
 """
+from collections import OrderedDict
+from functools   import wraps
+from threading   import Lock
+
+EXPR_CACHE_SIZE = 4096 # translated or validated expressions kept in memory
 
 class ExprTreeVisitor(object):
   """
@@ -25,6 +30,87 @@ class ExprTreeVisitor(object):
     args = [self.visit(arg) for arg in fields['args']]
     return self.call(fields['fname'], args)
 
+#### Compiled expression memoization
+
+def compileExpr(ast):
+  """
+  Compiles an expression tree into a hashable canonical form, such that equal
+  trees (regardless of dictionary key order, str or unicode strings) compile to
+  equal values. Numbers keep their type, as e.g. 1 and 1.0 translate differently.
+
+  Args:
+    ast: A PolyJS expression tree, e.g. ['ident', {'name': 'a'}]
+
+  Returns:
+    Nested tuples representing the tree.
+  """
+  if isinstance(ast, dict):
+    return tuple(sorted((key, compileExpr(val)) for key, val in ast.iteritems()))
+  if isinstance(ast, (list, tuple)):
+    return tuple(compileExpr(item) for item in ast)
+  if isinstance(ast, (bool, int, long, float)):
+    return (type(ast), ast)
+  return ast
+
+class ExprCache(object):
+  """
+  A bounded, thread-safe LRU mapping of keys containing compiled expressions to
+  the results of translating or validating them.
+
+  Public Methods:
+    get: Returns the value for a key, or `default`.
+    put: Stores the value for a key, evicting the least recently used one.
+    clear: Empties the cache.
+  """
+  def __init__(self, maxSize=EXPR_CACHE_SIZE):
+    self.maxSize = maxSize
+    self._items  = OrderedDict() # least recently used first
+    self._lock   = Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key not in self._items:
+        return default
+      value = self._items.pop(key)
+      self._items[key] = value
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = value
+      while len(self._items) > self.maxSize:
+        self._items.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+_EXPR_CACHE = ExprCache()
+_MISSING    = object()
+
+def memoizeExpr(dialect):
+  """
+  Decorator memoizing a function of a single expression tree, such as a
+  translator, on the pair (dialect, compiled expression). Exceptions are not
+  cached.
+
+  Args:
+    dialect: A name distinguishing this function's results from those of other
+      memoized functions, e.g. 'mysql'.
+  """
+  def decorator(fn):
+    @wraps(fn)
+    def memoized(expr):
+      key    = (dialect, compileExpr(expr))
+      result = _EXPR_CACHE.get(key, _MISSING)
+      if result is _MISSING:
+        result = fn(expr)
+        _EXPR_CACHE.put(key, result)
+      return result
+    return memoized
+  return decorator
+
 def exprCallFnc(fname, args):
   return ['call', {'fname': fname, 'args': args}]
 
@@ -55,9 +141,15 @@ def getExprValidator(columns):
     Function that throws a ValueError when encountering bad input
   """
   v = Validator(columns)
+  columnsKey = frozenset(columns)
   def validate(obj):
     expr = obj['expr']
     name = obj['name']
-    if not v.visit(expr):
+    key = ('validate', columnsKey, compileExpr(expr))
+    valid = _EXPR_CACHE.get(key)
+    if valid is None:
+      valid = bool(v.visit(expr))
+      _EXPR_CACHE.put(key, valid)
+    if not valid:
       raise ValueError("Unknown data column %s" % name)
   return validate
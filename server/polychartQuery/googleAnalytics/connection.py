@@ -145,7 +145,7 @@ class GAConn(DataSourceConnection):
                       , "Unable to run because not ready.")
 
   @retry(2)
-  def queryTable(self, tableName, querySpec, limit):
+  def queryTable(self, tableName, querySpec, limit, columnar=False):
     """
     Queries Google Analytics Reporting API and returns the result. See
     DataSourceConnection.queryTable for more information.
@@ -161,7 +161,8 @@ class GAConn(DataSourceConnection):
                      , queryFunc = self._queryFunc
                      , startDate = self.startDate
                      , endDate   = self.endDate
-                     , gaId      = self.gaId )
+                     , gaId      = self.gaId
+                     , columnar  = columnar )
       return query.getData()
     else:
       raise ValueError("googleAnalytics.connection.queryTable: Unable to run because not ready.")
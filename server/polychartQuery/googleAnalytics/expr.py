@@ -1,4 +1,4 @@
-from polychartQuery.expr import ExprTreeVisitor
+from polychartQuery.expr import ExprTreeVisitor, memoizeExpr
 
 QUOTE = "'" # note: double quote does not work in postgres!
 def escape(str): return str # TODO: implement
@@ -48,6 +48,7 @@ class ExprToGA(ExprTreeVisitor):
       return key
 
 exprToGAInstance = ExprToGA()
+@memoizeExpr('ga')
 def exprToGA(expr):
   str = exprToGAInstance.visit(expr)
   if str == 'COUNT(1)':
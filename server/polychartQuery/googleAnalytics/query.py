@@ -6,7 +6,7 @@ import re
 
 from polychartQuery.query                  import DbbQuery
 from polychartQuery.googleAnalytics.params import GAParams
-from polychartQuery.utils                  import listDictWithPair
+from polychartQuery.utils                  import listDictWithPair, rowsToColumns
 from polychartQuery.googleAnalytics.expr   import exprToGA
 
 class GAQuery(DbbQuery):
@@ -46,11 +46,12 @@ class GAQuery(DbbQuery):
     return exprToGA(expr)
 
   def __init__(self, tableName, jsSpec,
-               limit=1000, queryFunc=None, startDate=None, endDate=None, gaId=None):
+               limit=1000, queryFunc=None, startDate=None, endDate=None, gaId=None,
+               columnar=False):
     self.startDate = startDate
     self.endDate   = endDate
     self.gaId      = gaId
-    DbbQuery.__init__(self, tableName, jsSpec, limit, queryFunc)
+    DbbQuery.__init__(self, tableName, jsSpec, limit, queryFunc, columnar=columnar)
 
   def _combinePieces(self, queryFields, joins, groups, filters):
     """
@@ -194,7 +195,8 @@ class GAQuery(DbbQuery):
     try:
       rows = result['rows']
     except KeyError: # Empty result
-      return {'data': [], 'meta': self.jsSpec['meta']}
+      data = {} if self.columnar else []
+      return {'data': data, 'meta': self.jsSpec['meta']}
 
     gaNames = [col['name'][3:] for col in result['columnHeaders']]
     headerNames = []
@@ -219,6 +221,9 @@ class GAQuery(DbbQuery):
       if 'sort' in val:
         self.jsSpec['meta']['sorted'] = True
 
+    if self.columnar:
+      data = rowsToColumns(data, headerNames)
+
     return {'data': data, 'meta': self.jsSpec['meta']}
 
   def _validateQuery(self, query):
@@ -0,0 +1,331 @@
+"""
+Thread-safe pooling of data source connections.
+
+A `PoolRegistry` holds one `DataSourcePool` per pool key (for example, a pair of
+user and data source key). Each pool hands out its connections exclusively: a
+connection is used by a single thread between checkout and checkin. Pools are
+bounded in size, close connections which sit idle for too long, and health
+check connections that have not been used recently before handing them out.
+The registry evicts the least recently used pool once it holds too many.
+
+Exported:
+  DataSourcePool: A bounded pool of connections to one data source.
+  PoolRegistry: A bounded, LRU-evicted collection of DataSourcePools.
+  PooledConnection: A DataSourceConnection that runs each call on a connection
+    checked out of a DataSourcePool.
+"""
+from collections import OrderedDict
+from contextlib  import contextmanager
+from logging     import getLogger
+from threading   import Condition, Lock
+from time        import time
+
+from polychartQuery.abstract import ( DataSourceConnection
+                                    , DsConnError
+                                    , STREAM_BATCH_SIZE
+                                    , randomCode )
+from polychartQuery.timing   import phase
+
+logger = getLogger(__name__)
+
+#
+# Module Constants
+#
+
+POOL_MAX_SIZE          = 4   # connections per data source
+POOL_IDLE_TIMEOUT      = 300 # seconds before an idle connection is closed
+POOL_PING_AFTER        = 30  # seconds idle before a connection is health checked
+POOL_CHECKOUT_TIMEOUT  = 30  # seconds to wait for a connection to free up
+REGISTRY_MAX_POOLS     = 200 # data sources with open connections
+REGISTRY_REAP_INTERVAL = 60  # seconds between sweeps for idle connections
+
+class DataSourcePool(object):
+  """
+  A bounded pool of connections to a single data source.
+
+  Attribs:
+    cacheId: ID shared by all connections of this pool, to be used for caching.
+    maxSize: Maximum number of connections, idle or checked out.
+    idleTimeout: Seconds after which an idle connection is closed.
+    pingAfter: Seconds of idleness after which a connection is health checked
+      with `ping` before being checked out.
+    checkoutTimeout: Seconds to wait for a connection when the pool is full.
+    lastUsed: Timestamp of the last checkout.
+
+  Public Methods:
+    connection: Context manager checking a connection out and back in.
+    checkout: Takes a connection out of the pool, opening one if needed.
+    checkin: Returns a connection to the pool.
+    add: Adds an already open connection to the pool.
+    reap: Closes connections that have been idle for too long.
+    close: Closes all connections and stops accepting new ones.
+  """
+  def __init__(self, maxSize=POOL_MAX_SIZE, idleTimeout=POOL_IDLE_TIMEOUT,
+               pingAfter=POOL_PING_AFTER, checkoutTimeout=POOL_CHECKOUT_TIMEOUT):
+    self.cacheId         = randomCode()
+    self.maxSize         = maxSize
+    self.idleTimeout     = idleTimeout
+    self.pingAfter       = pingAfter
+    self.checkoutTimeout = checkoutTimeout
+    self.lastUsed        = time()
+
+    self._idle   = [] # (connection, checkin time) pairs, most recent last
+    self._size   = 0  # idle, checked out and opening connections
+    self._closed = False
+    self._cond   = Condition(Lock())
+
+  @property
+  def size(self):
+    return self._size
+
+  @contextmanager
+  def connection(self, factory):
+    """
+    Context manager to check out a connection for the duration of a block.
+
+    Args:
+      factory: A function of no arguments opening a new connection.
+    """
+    with phase('checkout'):
+      conn = self.checkout(factory)
+    try:
+      yield conn
+    finally:
+      self.checkin(conn)
+
+  def checkout(self, factory):
+    """
+    Takes a connection out of the pool. Recently used connections are preferred;
+    connections idle for more than `pingAfter` seconds are health checked first.
+    If no connection is idle and the pool is not full, a new one is opened.
+
+    Args:
+      factory: A function of no arguments opening a new connection.
+
+    Returns:
+      A data source connection, for the exclusive use of the caller until it
+      is checked back in.
+
+    Raises:
+      DsConnError: Thrown when no connection frees up within checkoutTimeout.
+    """
+    deadline = time() + self.checkoutTimeout
+    while True:
+      conn, checkinTime = None, None
+      with self._cond:
+        while True:
+          self.lastUsed = time()
+          if self._idle:
+            conn, checkinTime = self._idle.pop()
+            break
+          if self._size < self.maxSize:
+            self._size += 1
+            break
+          remaining = deadline - time()
+          if remaining <= 0:
+            raise DsConnError('Timed out waiting for a data source connection')
+          self._cond.wait(remaining)
+
+      if conn is None:
+        try:
+          return factory()
+        except Exception:
+          self._release()
+          raise
+
+      if time() - checkinTime <= self.pingAfter or _ping(conn):
+        return conn
+      logger.info('Discarding unhealthy pooled connection.')
+      self._discard(conn)
+
+  def checkin(self, conn):
+    """Returns a checked out connection to the pool, or discards it if closed."""
+    if not getattr(conn, 'opened', True):
+      self._discard(conn)
+      return
+    with self._cond:
+      if not self._closed:
+        self._idle.append((conn, time()))
+        self._cond.notify()
+        return
+    self._discard(conn)
+
+  def add(self, conn):
+    """Adds an open connection to the pool; it is closed if the pool is full."""
+    with self._cond:
+      if not self._closed and self._size < self.maxSize:
+        self._size += 1
+        self._idle.append((conn, time()))
+        self._cond.notify()
+        return
+    _close(conn)
+
+  def reap(self):
+    """Closes connections that have been idle for longer than idleTimeout."""
+    expired = []
+    with self._cond:
+      cutoff = time() - self.idleTimeout
+      while self._idle and self._idle[0][1] < cutoff:
+        expired.append(self._idle.pop(0)[0])
+    for conn in expired:
+      self._discard(conn)
+
+  def close(self):
+    """Closes idle connections; checked out ones are closed upon checkin."""
+    with self._cond:
+      self._closed = True
+      idle, self._idle = self._idle, []
+    for conn, _ in idle:
+      self._discard(conn)
+
+  def _discard(self, conn):
+    """Internal helper to close a connection and free up its slot."""
+    _close(conn)
+    self._release()
+
+  def _release(self):
+    """Internal helper to free up a slot in the pool."""
+    with self._cond:
+      self._size -= 1
+      self._cond.notify()
+
+class PoolRegistry(object):
+  """
+  A collection of DataSourcePools, one per key. When more than maxPools pools
+  exist, the least recently used one is closed. Idle connections of all pools
+  are reaped at most once every reapInterval seconds.
+
+  Public Methods:
+    get: Returns the pool for a key, creating it if needed.
+    discard: Closes and forgets the pool for a key.
+  """
+  def __init__(self, maxPools=REGISTRY_MAX_POOLS, reapInterval=REGISTRY_REAP_INTERVAL,
+               **poolArgs):
+    self.maxPools     = maxPools
+    self.reapInterval = reapInterval
+    self._poolArgs    = poolArgs
+    self._pools       = OrderedDict() # least recently used first
+    self._lastReap    = time()
+    self._lock        = Lock()
+
+  def get(self, key):
+    """
+    Args:
+      key: A hashable key identifying the data source.
+
+    Returns:
+      The DataSourcePool for the key.
+    """
+    evicted, toReap = [], []
+    with self._lock:
+      pool = self._pools.pop(key, None)
+      if pool is None:
+        pool = DataSourcePool(**self._poolArgs)
+      self._pools[key] = pool
+
+      while len(self._pools) > self.maxPools:
+        evicted.append(self._pools.popitem(last=False)[1])
+
+      if time() - self._lastReap > self.reapInterval:
+        self._lastReap = time()
+        toReap = self._pools.items()
+
+    for old in evicted:
+      old.close()
+    for otherKey, other in toReap:
+      other.reap()
+      if other.size == 0 and other is not pool:
+        self._forget(otherKey, other)
+    return pool
+
+  def discard(self, key):
+    """Closes the pool for a key, if there is one."""
+    with self._lock:
+      pool = self._pools.pop(key, None)
+    if pool is not None:
+      pool.close()
+
+  def _forget(self, key, pool):
+    """Internal helper to drop an empty pool unless it was reused meanwhile."""
+    with self._lock:
+      if self._pools.get(key) is pool and pool.size == 0:
+        del self._pools[key]
+
+class PooledConnection(DataSourceConnection):
+  """
+  A DataSourceConnection which runs each method on a connection checked out of
+  a DataSourcePool, so that concurrent requests never share a driver connection.
+
+  Attribs:
+    opened: Always True; dead connections are replaced by the pool.
+    dsKey: Optional key of the data source, for callers' bookkeeping.
+    dsType: Optional type of the data source, e.g. 'mysql'.
+  """
+  def __init__(self, pool, factory, cacheId=None, dsKey=None, dsType=None):
+    """
+    Args:
+      pool: The DataSourcePool to check connections out of.
+      factory: A function of no arguments opening a new connection.
+      cacheId: Optional ID scoping cache keys, such as the data source key;
+        defaults to the pool's cacheId.
+      dsKey: Optional key of the data source.
+      dsType: Optional type of the data source.
+    """
+    super(PooledConnection, self).__init__()
+    self._cacheId = cacheId or pool.cacheId
+    self._pool    = pool
+    self._factory = factory
+    self.opened   = True
+    self.dsKey    = dsKey
+    self.dsType   = dsType
+
+  def listTables(self):
+    return self._run('listTables')
+
+  def getColumnMetadata(self, tableName, columnExpr, dataType):
+    return self._run('getColumnMetadata', tableName, columnExpr, dataType)
+
+  def queryTable(self, tableName, querySpec, limit, columnar=False):
+    return self._run('queryTable', tableName, querySpec, limit, columnar)
+
+  def queryTableJson(self, tableName, querySpec, limit, compat=True):
+    return self._run('queryTableJson', tableName, querySpec, limit, compat)
+
+  def streamTable(self, tableName, querySpec, limit, batchSize=STREAM_BATCH_SIZE,
+                  compat=True):
+    """
+    The connection stays checked out until the stream is exhausted or closed,
+    and the underlying stream is closed before the connection is checked in.
+    """
+    with self._pool.connection(self._factory) as conn:
+      chunks = conn.streamTable(tableName, querySpec, limit, batchSize, compat)
+      try:
+        for chunk in chunks:
+          yield chunk
+      finally:
+        chunks.close()
+
+  def _run(self, methodName, *args):
+    """Internal helper to call a method on a checked out connection."""
+    with self._pool.connection(self._factory) as conn:
+      return getattr(conn, methodName)(*args)
+
+#### Helper functions
+
+def _ping(conn):
+  """Health checks a connection, treating errors as failure."""
+  try:
+    return conn.ping()
+  except Exception:
+    logger.exception('Error while health checking pooled connection.')
+    return False
+
+def _close(conn):
+  """Closes a connection if it can be closed, logging any errors."""
+  close = getattr(conn, 'close', None)
+  if close is None:
+    return
+  try:
+    close()
+  except Exception:
+    logger.exception('Error while closing pooled connection.')
@@ -4,6 +4,7 @@ Module defining the form of a data source query.
 from logging import getLogger
 from polychartQuery.utils import isNumber, unbracket
 from polychartQuery.expr import getExprValidator
+from polychartQuery.timing import phase
 
 logger = getLogger(__name__)
 
@@ -50,6 +51,10 @@ class DbbQuery(object):
     sort: A dictionary with keys being column names to be sorted and value of parameters.
     limit: An integer corresponding on the limit of a result. Default is 1000.
     queryFunc: A function to be called to execute the actual query.
+    columnTypes: A dictionary mapping column names to their data source types,
+      e.g. 'timestamp with time zone'; empty if columns were not provided.
+    columnar: A boolean; if set, results are returned column-wise as
+      {columnName: [values...]} rather than as a list of row dictionaries.
     query: A query object for a particular data source.
 
   Public Methods:
@@ -68,9 +73,11 @@ class DbbQuery(object):
       This is to be implemented in all concrete instances.
   """
 
-  def __init__(self, tableName, jsSpec, limit=1000, queryFunc=None, columns=None):
+  def __init__(self, tableName, jsSpec, limit=1000, queryFunc=None, columns=None,
+               columnar=False):
     self.jsSpec = jsSpec
     self.tableName = tableName
+    self.columnar = columnar
 
     for filts in jsSpec['filter']: # check this
       if 'dateOptions' in filts:
@@ -88,10 +95,13 @@ class DbbQuery(object):
       except:
         pass
     self.queryFunc = queryFunc
+    self.columnTypes = dict(columns or [])
 
-    self._validate(columns)
+    with phase('validate'):
+      self._validate(columns)
 
-    self.query = self._buildQuery()
+    with phase('translate'):
+      self.query = self._buildQuery()
 
   # Abstract Methods
   #   To be implemented by concrete instances.
@@ -165,7 +175,8 @@ class DbbQuery(object):
     Public method to get formatted data.
     """
     rawResult = self._executeQuery(self.query)
-    result = self._formatResult(rawResult)
+    with phase('format'):
+      result = self._formatResult(rawResult)
     return result
 
   def _validate(self, columns=None):
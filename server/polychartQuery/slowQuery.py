@@ -0,0 +1,166 @@
+"""
+Recording of slow data source queries.
+
+Connections with a SlowQueryLog (see SqlConn.slowQueryLog) report every query
+they run to it. Queries taking at least the log's threshold are written, one
+JSON object per line, to the SLOW_QUERY_LOGGER logger, with:
+  time: Unix timestamp at which the query finished.
+  seconds: Time spent executing the query and fetching its rows.
+  rows: Number of rows fetched.
+  fingerprint: A short hash identifying the normalized query.
+  sql: The normalized query; literals are replaced by '?' and lists of them by
+    '(...)', so that queries differing only in their values look the same.
+  params: The types of the parameters, rather than their values.
+  dsKey, dsType: The data source, if known.
+  origin: What the query was run for, e.g. {"dashboard": ..., "chart": ...},
+    as set with `queryOrigin`.
+  plan: Optionally, the rows of EXPLAIN for the query.
+
+Exported:
+  SlowQueryLog: Writes out queries slower than a threshold.
+  queryOrigin: Context manager setting the origin of queries run in a block.
+  fingerprint: Normalizes a query.
+  redactParams: Replaces query parameters by their types.
+"""
+import hashlib
+import json
+import re
+import threading
+
+from contextlib import contextmanager
+from logging    import getLogger
+from time       import time
+
+SLOW_QUERY_THRESHOLD = 1.0 # seconds
+SLOW_QUERY_LOGGER    = 'polychartQuery.slowQuery.entries'
+
+logger   = getLogger(__name__)
+entryLog = getLogger(SLOW_QUERY_LOGGER)
+
+_STRING  = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER  = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.I)
+_PARAM   = re.compile(r'%s|%\(\w+\)s')
+_LIST    = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE   = re.compile(r'\s+')
+
+class SlowQueryLog(object):
+  """
+  Writes out queries slower than a threshold.
+
+  Attribs:
+    threshold: Seconds from which a query is considered slow.
+    explain: Whether to run EXPLAIN for slow queries and record the plan.
+    dsKey: Optional key of the data source.
+    dsType: Optional type of the data source, e.g. 'mysql'.
+
+  Public Methods:
+    observe: Records a query if it was slow.
+  """
+  def __init__(self, threshold=SLOW_QUERY_THRESHOLD, explain=False, dsKey=None,
+               dsType=None):
+    self.threshold = threshold
+    self.explain   = explain
+    self.dsKey     = dsKey
+    self.dsType    = dsType
+
+  def observe(self, querySql, params, seconds, rowCount, explainFunc=None,
+              origin=None):
+    """
+    Args:
+      querySql: The query, with placeholders for its parameters.
+      params: The parameters of the query.
+      seconds: Time the query took.
+      rowCount: Number of rows the query returned.
+      explainFunc: Optional function of (querySql, params) returning the rows of
+        the query plan; called only if `explain` is set and the query was slow.
+      origin: Optional origin of the query, if not the current one.
+
+    Returns:
+      The entry written out, or None if the query was not slow.
+    """
+    if seconds < self.threshold:
+      return None
+    sql   = fingerprint(querySql)
+    if isinstance(sql, unicode):
+      sql = sql.encode('utf-8')
+    entry = { 'time':        time()
+            , 'seconds':     round(seconds, 6)
+            , 'rows':        rowCount
+            , 'fingerprint': hashlib.md5(sql).hexdigest()[:12]
+            , 'sql':         sql
+            , 'params':      redactParams(params)
+            , 'dsKey':       self.dsKey
+            , 'dsType':      self.dsType
+            , 'origin':      origin if origin is not None else currentOrigin()
+            , 'plan':        None
+            }
+    if self.explain and explainFunc is not None:
+      try:
+        entry['plan'] = [[_planValue(v) for v in row] for row in explainFunc(querySql, params)]
+      except Exception:
+        logger.exception('Could not EXPLAIN slow query')
+    entryLog.warning(json.dumps(entry))
+    return entry
+
+#
+# Query origins
+#
+
+_local = threading.local()
+
+@contextmanager
+def queryOrigin(**origin):
+  """
+  Context manager setting the origin of the queries run by the current thread
+  within a block, e.g.
+
+    with queryOrigin(dashboard='abc', chart=2):
+      connection.queryTable(...)
+  """
+  previous = getattr(_local, 'origin', None)
+  _local.origin = origin
+  try:
+    yield origin
+  finally:
+    _local.origin = previous
+
+def currentOrigin():
+  """Returns the origin set by the innermost `queryOrigin`, or None."""
+  return getattr(_local, 'origin', None)
+
+#
+# Normalization
+#
+
+def fingerprint(querySql):
+  """
+  Args:
+    querySql: A query string.
+
+  Returns:
+    The query with string and number literals and parameter placeholders
+    replaced by '?', lists of those collapsed to '(...)', and whitespace
+    collapsed to single spaces.
+  """
+  sql = _STRING.sub('?', querySql)
+  sql = _PARAM.sub('?', sql)
+  sql = _NUMBER.sub('?', sql)
+  sql = _LIST.sub('(...)', sql)
+  return _SPACE.sub(' ', sql).strip()
+
+def redactParams(params):
+  """
+  Returns:
+    A list of the type names of the parameters, e.g. ['str', 'int'], or None.
+  """
+  if params is None:
+    return None
+  if isinstance(params, dict):
+    return {key: type(value).__name__ for key, value in params.iteritems()}
+  return [type(value).__name__ for value in params]
+
+def _planValue(value):
+  """Helper making a value of an EXPLAIN row serializable."""
+  if value is None or isinstance(value, (int, long, float, basestring)):
+    return value
+  return str(value)
@@ -1,9 +1,11 @@
 """
 Module implementing connection to a SQL-like database.
 """
-from logging import getLogger
-from sys     import exc_info
-from time    import time
+from collections import OrderedDict
+from logging     import getLogger
+from sys         import exc_info
+from time        import time
+from uuid        import uuid4
 
 import os
 
@@ -14,15 +16,22 @@ from polychartQuery.sql.query import ( SqlQuery
 from polychartQuery.abstract  import ( DataSourceConnection
                                      , DsConnError
                                      , DsConnClosedError
+                                     , STREAM_BATCH_SIZE
                                      , retry )
 from polychartQuery.utils     import ( saneEncode
                                      , getNewTempFilePath
                                      , listDictWithPair )
 from polychartQuery.sql.expr import exprToMySql, exprToPostgres
+from polychartQuery.encoder  import ResultEncoder
+from polychartQuery.slowQuery import currentOrigin
+from polychartQuery.timing   import phase, record
 from polychartQuery.expr import exprCallFnc, getExprValidator
 
 logger = getLogger(__name__)
 
+SCHEMA_CACHE_TIMEOUT = 300 # seconds before the schema catalog is reloaded
+SCHEMA_MISS_INTERVAL = 10  # minimum age (seconds) before a lookup miss reloads it
+
 class SqlConn(DataSourceConnection):
   """
   Class representing data source connections for SQL-like databases.
@@ -32,22 +41,46 @@ class SqlConn(DataSourceConnection):
     dbName: The database name to use.
     opened: Flag denoting whether or not the database connection is active.
     queryType: Class object denoting the query implementation to use.
+    slowQueryLog: Optional polychartQuery.slowQuery.SlowQueryLog which every
+      query run is reported to.
     _cacheId: ID unique to this connection to be used for caching.
+    _schema: Catalog of tables in the database, loaded lazily by _getSchema. An
+      ordered dictionary of the form
+        { tableName: { schema:  "public"
+                     , columns: [(columnName, dataType, polyType), ...] }
+        , ... }
+    _schemaLoadedAt: Timestamp at which _schema was last loaded.
 
   Public Methods:
     listTables: Lists tables; see DataSourceConnection.listTables.
     queryTable: Queries tables; see DataSourceConnection.queryTable.
+    queryTableJson: Queries tables into JSON; see DataSourceConnection.queryTableJson.
+    streamTable: Queries tables incrementally; see DataSourceConnection.streamTable.
     getColumnMetadata: Metadata for columns; see DataSourceConnection.geteColumnMetadata.
+    invalidateSchema: Discards the schema catalog so it is reloaded on next use.
+    ping: Health check; see DataSourceConnection.ping.
+    close: Closes the database connection and any SSH tunnel.
 
   Private Methods:
     _connect: Method to help with connecting to the data base adapter.
+    _prepareQuery: Helper to validate a table query and build its query object.
+    _streamQuery: Helper to run a query on a server-side cursor, in batches.
+    _explain: Helper returning the query plan of a query.
+    _getSchema: Helper returning the schema catalog, reloading it when stale.
+    _getTable: Helper to look up a table in the schema catalog.
     _getAllColumns: Helper to query for all columns in the database.
-    _getColumnsInTable: Helper to query for all columns in a table.
-    _getColumn: Helper to query information about a given column.
+    _getColumnsInTable: Helper to look up all columns in a table.
+    _getColumn: Helper to look up information about a given column.
+    _getTableSchema: Helper to look up the schema a table belongs to.
   """
   def __init__(self,  **kwargs):
     super(SqlConn, self).__init__()
-    self.opened = False
+    self.opened   = False
+    self._sshProc = None
+    self.slowQueryLog = None
+
+    self._schema         = None
+    self._schemaLoadedAt = 0
 
     sslCert = kwargs.get('db_ssl_cert')
     if sslCert is not None:
@@ -75,19 +108,17 @@ class SqlConn(DataSourceConnection):
     Lists tables for general SQL data sources. See
     DataSourceConnection.listTables for more information.
     """
-    cur_result = self._getAllColumns()
-    result     = []
+    result = []
+
+    for tableName, table in self._getSchema().iteritems():
+      meta = {}
+      for columnName, dataType, polyType in table['columns']:
+        meta[columnName] = { 'type': polyType }
 
-    for tableName, columnName, dataType in cur_result:
-      table = listDictWithPair(result, 'name', tableName)
-      if table is None:
-        table = { 'name': tableName, 'meta': {} }
-        result.append(table)
-      polyType                  = getType(dataType)
-      table['meta'][columnName] = { 'type': polyType }
+        if polyType == 'date' and dataType in ['day', 'month', 'year']:
+          meta[columnName]['timerange'] = dataType
 
-      if polyType == 'date' and dataType in ['day', 'month', 'year']:
-        table['meta'][columnName]['timerange'] = dataType
+      result.append({ 'name': tableName, 'meta': meta })
 
     return result
 
@@ -145,11 +176,60 @@ class SqlConn(DataSourceConnection):
     return result
 
   @retry(2)
-  def queryTable(self, tableName, querySpec, limit):
+  def queryTable(self, tableName, querySpec, limit, columnar=False):
     """
     Queries the SQL database and returns the result. See
     DataSourceConnection.queryTable for more information.
 
+    Raises:
+      ValueError: Thrown when the querySpec is not a dictionary.
+    """
+    query  = self._prepareQuery(tableName, querySpec, limit, columnar)
+    result = query.getData()
+    if columnar: # values are already typed per column
+      return result
+    with phase('encode'):
+      return saneEncode(result)
+
+  @retry(2)
+  def queryTableJson(self, tableName, querySpec, limit, compat=True):
+    """
+    Queries the SQL database and encodes the result straight from the fetched
+    rows. See DataSourceConnection.queryTableJson for more information.
+
+    Raises:
+      ValueError: Thrown when the querySpec is not a dictionary.
+    """
+    query   = self._prepareQuery(tableName, querySpec, limit)
+    encoder = ResultEncoder(query.selectOrder, query.jsSpec['meta'], compat)
+    querySql, params = query.query
+    return encoder.encode(self._query(querySql, params))
+
+  def streamTable(self, tableName, querySpec, limit, batchSize=STREAM_BATCH_SIZE,
+                  compat=True):
+    """
+    Queries the SQL database through a server-side cursor, encoding rows batch
+    by batch, so that memory use does not grow with the size of the result. The
+    query runs when the first chunk is requested. See
+    DataSourceConnection.streamTable for more information.
+
+    Raises:
+      ValueError: Thrown when the querySpec is not a dictionary.
+    """
+    query   = self._prepareQuery(tableName, querySpec, limit)
+    encoder = ResultEncoder(query.selectOrder, query.jsSpec['meta'], compat)
+    querySql, params = query.query
+    return encoder.encodeChunks(self._streamQuery(querySql, params, batchSize))
+
+  ### Internal Methods
+
+  def _prepareQuery(self, tableName, querySpec, limit, columnar=False):
+    """
+    Internal helper validating a query and building its query object.
+
+    Returns:
+      An instance of self.queryType.
+
     Raises:
       ValueError: Thrown when the querySpec is not a dictionary.
     """
@@ -165,10 +245,13 @@ class SqlConn(DataSourceConnection):
     if len(tableNames) == 0 and tableName:
       tableNames = [tableName]
 
-    columns = []
+    columns  = []
+    polyType = {}
     for table in tableNames:
-      for col in self._getColumnsInTable(table):
-        columns += [("{0}.{1}".format(table, col[0]), col[1])]
+      for colName, colType, colPolyType in self._getColumnsInTable(table):
+        fullName = "{0}.{1}".format(table, colName)
+        columns += [(fullName, colType)]
+        polyType[fullName] = colPolyType
     if not columns:
       raise ValueError( "sql.connSql.SqlConn.queryTable"
                       , "Unknown table name: {table}".format(table=tableName))
@@ -185,14 +268,10 @@ class SqlConn(DataSourceConnection):
          colName == transKey:
         if name not in querySpec['meta']:
           querySpec['meta'][name] = {}
-        querySpec['meta'][name]['type'] = getType(colType)
-
-    # Perform table query using translator
-    query  = self.queryType(tableName, querySpec, limit, self._query, columns)
-    result = query.getData()
-    return saneEncode(result)
+        querySpec['meta'][name]['type'] = polyType[colName]
 
-  ### Internal Methods
+    # Build table query using translator
+    return self.queryType(tableName, querySpec, limit, self._query, columns, columnar)
 
   def _query(self, querySql, params=None):
     """
@@ -214,11 +293,16 @@ class SqlConn(DataSourceConnection):
       startTime = time()
 
       cur = self.db.cursor()
-      cur.execute(querySql, [params])
-      result = cur.fetchall()
+      with phase('execute'):
+        cur.execute(querySql, params)
+      with phase('fetch'):
+        result = cur.fetchall()
       cur.close()
 
-      logger.info('SQL data source query took {0}s'.format(time()-startTime))
+      queryTime = time() - startTime
+      logger.info('SQL data source query took {0}s'.format(queryTime))
+      if self.slowQueryLog is not None:
+        self.slowQueryLog.observe(querySql, params, queryTime, len(result), self._explain)
 
       return result
     except Exception as err:
@@ -240,6 +324,97 @@ class SqlConn(DataSourceConnection):
       self.close()
       raise
 
+  def _streamQuery(self, querySql, params=None, batchSize=STREAM_BATCH_SIZE):
+    """
+    Internal streaming counterpart to _query. Rows are fetched in batches from a
+    server-side cursor, so the result set is never held in memory at once. The
+    connection must not be used otherwise until the generator is exhausted or
+    closed. As in _query, the connection is closed if the query fails, as the
+    server may still be sending rows of the aborted result.
+
+    Args:
+      querySql: A string corresponding to the SQL query to be made.
+      params: A tuple of arguments to be interpolated into the SQL query.
+      batchSize: The number of rows to fetch at a time.
+
+    Returns:
+      A generator of tuples of at most `batchSize` row tuples.
+
+    Raises:
+      DsConnClosedError: Thrown when the MySQL server has gone away.
+    """
+    import MySQLdb
+
+    startTime = time()
+    queryTime = 0 # excluding time spent by the consumer between batches
+    numRows   = 0
+    origin    = currentOrigin() # the generator may finish in another context
+    failed    = False
+    cur       = self._streamCursor()
+    try:
+      with phase('execute'):
+        cur.execute(querySql, params)
+      queryTime = time() - startTime
+      while True:
+        fetchStart = time()
+        rows = cur.fetchmany(batchSize)
+        record('fetch', time() - fetchStart)
+        queryTime += time() - fetchStart
+        if not rows:
+          break
+        numRows += len(rows)
+        yield rows
+      logger.info('SQL data source query streamed {0} rows in {1}s'.format(
+        numRows, time()-startTime))
+    except Exception as err:
+      failed = True
+      try:
+        cur.close()
+      except Exception:
+        pass
+
+      if isinstance(err, MySQLdb.OperationalError):
+        # 'MySQL server has gone away'
+        if err.args[0] == 2006:
+          self.close()
+          raise DsConnClosedError(exc_info())
+
+      logger.info("Problematic query: {0}".format(querySql))
+      logger.info("Parameters: {0}".format(params))
+
+      # The result may be partly unread, so reset the connection
+      self.close()
+      raise
+    finally:
+      if not failed: # exhausted, or closed early by the consumer
+        self._endStream(cur)
+
+    if self.slowQueryLog is not None:
+      self.slowQueryLog.observe(querySql, params, queryTime, numRows, self._explain, origin)
+
+  def _explain(self, querySql, params=None):
+    """
+    Internal helper running EXPLAIN for a query, for the slow query log.
+
+    Returns:
+      The rows of the query plan.
+    """
+    cur = self.db.cursor()
+    try:
+      cur.execute('EXPLAIN ' + querySql, params)
+      return cur.fetchall()
+    finally:
+      cur.close()
+
+  def _streamCursor(self):
+    """Internal helper opening an unbuffered, server-side cursor."""
+    import MySQLdb.cursors
+    return self.db.cursor(MySQLdb.cursors.SSCursor)
+
+  def _endStream(self, cur):
+    """Internal helper closing a cursor of _streamCursor once streaming is over."""
+    cur.close()
+
   def _connect(self, db_username, db_password, db_name, connection_type,
       db_host = None, db_port = None, db_ssl_cert_path = None,
       db_unix_socket = None, ssh_host = None, ssh_port = None,
@@ -262,12 +437,13 @@ class SqlConn(DataSourceConnection):
       if db_ssl_cert_path:
         connArgs['ssl'] = { 'ca': db_ssl_cert_path }
     elif connection_type == 'ssh':
+      unixSocket, self._sshProc = createSshUnixSocket( db_unix_socket
+                                                     , ssh_username
+                                                     , ssh_host
+                                                     , ssh_port
+                                                     , ssh_key )
       connArgs.update({ 'host':        'localhost'
-                      , 'unix_socket': createSshUnixSocket( db_unix_socket
-                                                          , ssh_username
-                                                          , ssh_host
-                                                          , ssh_port
-                                                          , ssh_key )})
+                      , 'unix_socket': unixSocket })
     else:
       raise ValueError( "sql.connection.SqlConn._connect"
                       , "No connection method for data source" )
@@ -278,53 +454,104 @@ class SqlConn(DataSourceConnection):
     except MySQLdb.OperationalError as err:
       raise DsConnError('OperationalError: {msg}'.format(msg = err.args[1]))
 
+  def ping(self):
+    """Runs a trivial query to check that the database connection is alive."""
+    if not self.opened:
+      return False
+    try:
+      self._query('SELECT 1')
+      return True
+    except Exception:
+      return False
+
   def close(self):
-    """Helper to close database if it is open."""
+    """Helper to close database if it is open, and stop the SSH tunnel if any."""
     if self.opened:
       self.opened = False
       self.db.close()
+    if self._sshProc is not None:
+      try:
+        self._sshProc.kill()
+      except OSError:
+        pass # already exited
+      self._sshProc = None
 
   def __del__(self):
     """Internal method to ensure connection closed upon garbage collection."""
     self.close()
 
+  ### Schema catalog
+
+  def invalidateSchema(self):
+    """Discards the schema catalog; it is reloaded the next time it is needed."""
+    self._schema = None
+
+  def _getSchema(self):
+    """
+    Helper to get the schema catalog, loading it with a single query to
+    information_schema if it has not been loaded or is older than
+    SCHEMA_CACHE_TIMEOUT.
+    """
+    if self._schema is None or time() - self._schemaLoadedAt > SCHEMA_CACHE_TIMEOUT:
+      schema = OrderedDict()
+      with phase('schema'):
+        allColumns = self._getAllColumns()
+      for tableSchema, tableName, columnName, dataType in allColumns:
+        table = schema.get(tableName)
+        if table is None:
+          table = schema[tableName] = { 'schema': tableSchema, 'columns': [] }
+        elif table['schema'] != tableSchema:
+          continue # Same table name in another schema; keep the first one
+        table['columns'].append((columnName, dataType, getType(dataType)))
+
+      self._schema         = schema
+      self._schemaLoadedAt = time()
+    return self._schema
+
+  def _getTable(self, tableName):
+    """
+    Helper to look up a table in the schema catalog. A miss reloads the catalog
+    (at most once every SCHEMA_MISS_INTERVAL seconds) in case the table is new.
+
+    Returns:
+      The catalog entry for the table, or None if there is no such table.
+    """
+    table = self._getSchema().get(tableName)
+    if table is None and time() - self._schemaLoadedAt > SCHEMA_MISS_INTERVAL:
+      self.invalidateSchema()
+      table = self._getSchema().get(tableName)
+    return table
+
   ### Convenience methods for common queries
 
   def _getAllColumns(self):
     """Helper to get columns and data types of a database."""
     return self._query(
       '''
-      SELECT table_name, column_name, data_type
+      SELECT table_schema, table_name, column_name, data_type
       FROM information_schema.columns
       WHERE table_schema=%s
+      ORDER BY table_name, ordinal_position
       ''',
-      self.dbName
+      (self.dbName,)
     )
 
   def _getColumnsInTable(self, tableName):
-    """Helper to get columns and data types of a table."""
-    return self._query(
-      '''
-      SELECT column_name, data_type
-      FROM information_schema.columns
-      WHERE table_schema=%s
-      AND table_name=%s
-      ''',
-      (self.dbName, tableName)
-    )
+    """
+    Helper to get columns of a table from the schema catalog, as a list of
+    (columnName, dataType, polyType) tuples.
+    """
+    table = self._getTable(tableName)
+    return table['columns'] if table else []
 
   def _getColumn(self, tableName, columnName):
-    """Helper to get a specific column."""
-    return self._query(
-      '''
-      SELECT column_name, data_type
-      FROM information_schema.columns
-      WHERE table_schema=%s
-      AND table_name=%s
-      AND column_name=%s
-      ''',
-      (self.dbName, tableName, columnName)
-    )
+    """Helper to get a specific column from the schema catalog."""
+    return [col for col in self._getColumnsInTable(tableName) if col[0] == columnName]
+
+  def _getTableSchema(self, tableName):
+    """Helper to get the table schema a particular table is in."""
+    table = self._getTable(tableName)
+    return table['schema'] if table else None
 
   #
   # Abstract Methods
@@ -372,10 +599,9 @@ class PostgreSqlConn(SqlConn):
   def _translate(self, expr):
     return exprToPostgres(expr)
 
-  @retry(2)
-  def queryTable(self, tableName, querySpec, limit):
+  def _prepareQuery(self, tableName, querySpec, limit, columnar=False):
     """
-    Queries the SQL database and returns the result. Overrides SqlConn.queryTable
+    Builds the query object for a table query. Overrides SqlConn._prepareQuery
     due to differences in how PostgreSQL handles schemas.
 
     Raises:
@@ -386,24 +612,50 @@ class PostgreSqlConn(SqlConn):
                       , "Invalid parameter type: {0}".format(type(querySpec)))
 
     # IMPORTANT: This prevents SQL injections by validating table name
-    columns = [("{0}.{1}".format(tableName, col[0]), col[1])
-                  for col in self._getColumnsInTable(tableName)]
+    tableColumns = [("{0}.{1}".format(tableName, colName), colType, colPolyType)
+                      for colName, colType, colPolyType in self._getColumnsInTable(tableName)]
+    columns      = [(colName, colType) for colName, colType, _ in tableColumns]
     if not columns:
       raise ValueError( "sql.connSql.PostgreSQL.queryTable"
                       , "Unknown table name: {0}".format(tableName))
 
     schema = self._getTableSchema(tableName)
-    if schema != [] and schema[0][0] != 'public':
-      tableName = schema[0][0] + '.' + tableName
+    if schema is not None and schema != 'public':
+      tableName = schema + '.' + tableName
 
     if 'meta' not in querySpec or querySpec['meta'] == {}:
-      meta = {colName: {'type': getType(colType)} for colName, colType in columns}
+      meta = {colName: {'type': colPolyType} for colName, _, colPolyType in tableColumns}
       querySpec['meta'] = meta
 
-    query  = self.queryType(tableName, querySpec, limit, self._query, columns)
-    result = query.getData()
-    return saneEncode(result)
+    return self.queryType(tableName, querySpec, limit, self._query, columns, columnar)
 
+  def _streamCursor(self):
+    """
+    Overrides SqlConn._streamCursor; psycopg2 uses named cursors for server-side
+    cursors. These only live within a transaction, so autocommit is turned off
+    until _endStream; a cursor held over commits instead (WITH HOLD) would have
+    Postgres materialize the whole result at the first commit.
+    """
+    self.db.autocommit = False
+    return self.db.cursor(name='stream_' + uuid4().hex)
+
+  def _endStream(self, cur):
+    """
+    Overrides SqlConn._endStream, ending the transaction of the cursor and
+    turning autocommit back on. Should that fail, the transaction is rolled back
+    and the connection closed, as in _streamQuery.
+    """
+    try:
+      cur.close()
+      self.db.commit()
+    except Exception:
+      try:
+        self.db.rollback()
+      except Exception:
+        pass
+      self.close()
+      raise
+    self.db.autocommit = True
 
   def _connect(self, db_host, db_port, db_username, db_password, db_name, **kwargs):
     """
@@ -441,48 +693,16 @@ class PostgreSqlConn(SqlConn):
   ### Convenience functions for common queries
 
   def _getAllColumns(self):
-    """Helper to get all columns in a given table schema."""
-    return self._query(
-      '''
-      SELECT table_name, column_name, data_type
-      FROM information_schema.columns
-      WHERE table_schema<>'information_schema'
-      AND table_schema<>'pg_catalog'
-      '''
-    )
-
-  def _getColumnsInTable(self, tableName):
-    """Helper to get all columns in a table."""
+    """
+    Helper to get all columns in all user schemas. Tables in the 'public' schema
+    are listed first so that they win when a table name occurs in several schemas.
+    """
     return self._query(
       '''
-      SELECT column_name, data_type
+      SELECT table_schema, table_name, column_name, data_type
       FROM information_schema.columns
       WHERE table_schema<>'information_schema'
       AND table_schema<>'pg_catalog'
-      AND table_name=%s
-      ''',
-      (tableName,)
-    )
-
-  def _getColumn(self, tableName, columnName):
-    """Helper to get a specific column."""
-    return self._query(
+      ORDER BY table_schema<>'public', table_schema, table_name, ordinal_position
       '''
-      SELECT column_name, data_type
-      FROM information_schema.columns
-      WHERE table_name=%s
-      AND column_name=%s
-      ''',
-      (tableName, columnName)
-    )
-
-  def _getTableSchema(self, tableName):
-    """Helper to get the table schema a particlar table is in."""
-    return self._query(
-      '''
-      SELECT distinct table_schema
-      FROM information_schema.columns
-      WHERE table_name=%s
-      ''',
-      (tableName,)
     )
@@ -1,4 +1,4 @@
-from polychartQuery.expr import ExprTreeVisitor
+from polychartQuery.expr import ExprTreeVisitor, memoizeExpr
 from polychartQuery.utils import isNumber
 
 # GENERAL SHARED FUNCTIONS
@@ -102,6 +102,7 @@ class ExprToMySql(ExprToSql):
 
 exprToMySqlInstance = ExprToMySql()
 
+@memoizeExpr('mysql')
 def exprToMySql(expr):
   str = exprToMySqlInstance.visit(expr)
   if str == 'COUNT(1)':
@@ -131,21 +132,51 @@ class ExprToPostgres(ExprToSql):
     , 'unix':   'EXTRACT(EPOCH FROM {0})'
     })
     self.binfns.update({
-      'second':   'EXTRACT(EPOCH FROM {0})'
-    , 'minute':   'EXTRACT(EPOCH FROM DATE_TRUNC(MINUTE, {0}))'
-    , 'hour':     'EXTRACT(EPOCH FROM DATE_TRUNC(HOUR, {0}))'
-    , 'day':      'EXTRACT(EPOCH FROM DATE_TRUNC(DAY, {0}))'
-    , 'week':     'EXTRACT(EPOCH FROM DATE_TRUNC(WEEK, {0}))'
-    , 'month':    'EXTRACT(EPOCH FROM DATE_TRUNC(MONTH, {0}))'
-    , 'twoMonth': "EXTRACT(EPOCH FROM DATE_TRUNC(MONTH, {0}-(DATE_PART(MONTH,{0})::int%2||'MONTHS')::interval))"
-    , 'quarter':  'EXTRACT(EPOCH FROM DATE_TRUNC(QUARTER, {0}))'
-    , 'twoMonth': "EXTRACT(EPOCH FROM DATE_TRUNC(MONTH, {0}-(DATE_PART(MONTH,{0})::int%6||'MONTHS')::interval))"
-    , 'year':     'EXTRACT(EPOCH FROM DATE_TRUNC(YEAR, {0}))'
-    , 'twoYear':  "EXTRACT(EPOCH FROM DATE_TRUNC(YEAR, {0}-(DATE_PART(YEAR,{0})::int%2||'YEARS')::interval))"
-    , 'fiveYear':  "EXTRACT(EPOCH FROM DATE_TRUNC(YEAR, {0}-(DATE_PART(YEAR,{0})::int%5||'YEARS')::interval))"
-    , 'decade':    'EXTRACT(EPOCH FROM DATE_TRUNC(DECADE, {0}))'
+      name: postgresTimeBucket(unit, step)
+        for name, (unit, step) in POSTGRES_TIME_BUCKETS.iteritems()
     })
+
+# Bin widths of the Postgres dialect as (DATE_TRUNC field, number of fields).
+POSTGRES_TIME_BUCKETS = {
+  'second':   ('second',  1)
+, 'minute':   ('minute',  1)
+, 'hour':     ('hour',    1)
+, 'day':      ('day',     1)
+, 'week':     ('week',    1)
+, 'month':    ('month',   1)
+, 'twoMonth': ('month',   2)
+, 'quarter':  ('quarter', 1)
+, 'sixMonth': ('month',   6)
+, 'year':     ('year',    1)
+, 'twoYear':  ('year',    2)
+, 'fiveYear': ('year',    5)
+, 'decade':   ('decade',  1)
+}
+
+def postgresTimeBucket(unit, step=1):
+  """
+  Builds a Postgres expression template mapping a timestamp `{0}` to the unix
+  time of the start of its bucket, so that binning and aggregation happen in the
+  database. Buckets spanning several units are aligned to the start of the year
+  (for months) or to multiples of `step` (for years), like the MySQL dialect.
+  Note that `%` is avoided, as it clashes with DB-API parameter placeholders.
+
+  Args:
+    unit: A DATE_TRUNC field, e.g. 'month'.
+    step: The number of units per bucket.
+
+  Returns:
+    A template string to be formatted with the column expression.
+  """
+  bucket = "DATE_TRUNC('{unit}', {{0}})".format(unit=unit)
+  if step > 1:
+    offset = ' - 1' if unit == 'month' else '' # months are numbered from 1
+    bucket += " - MOD(EXTRACT({unit} FROM {{0}})::int{offset}, {step}) * INTERVAL '1 {unit}'" \
+              .format(unit=unit.upper(), offset=offset, step=step)
+  return 'EXTRACT(EPOCH FROM {bucket})'.format(bucket=bucket)
+
 exprToPostgresInstance = ExprToPostgres()
+@memoizeExpr('postgres')
 def exprToPostgres(expr):
   str = exprToPostgresInstance.visit(expr)
   if str == 'COUNT(1)':
@@ -1,6 +1,7 @@
 """
 Implementation of SQL querying for Polychart Dashboard Builder
 """
+from decimal import Decimal
 from time import sleep
 from subprocess import Popen
 
@@ -14,7 +15,22 @@ from polychartQuery.utils import getNewTempFilePath, listDictWithPair
 import polychartQuery.validate as validate # filepath, linuxUsername, hostname
 from polychartQuery.expr import exprCallFnc
 
+# Placeholders converting a unix timestamp to a literal comparable to a column
+# of the given type. UNIX_TIMESTAMP and FROM_UNIXTIME both use the session time
+# zone; EXTRACT(EPOCH ...) treats PostgreSQL timestamps without time zone as UTC.
+SQL_TIMESTAMP_LITERALS  = { 'datetime':  'FROM_UNIXTIME(%s)'
+                          , 'timestamp': 'FROM_UNIXTIME(%s)'
+                          , 'date':      'FROM_UNIXTIME(%s)'
+                          }
+PSQL_TIMESTAMP_LITERALS = { 'timestamp with time zone':    'TO_TIMESTAMP(%s)'
+                          , 'timestamp without time zone': "(TO_TIMESTAMP(%s) AT TIME ZONE 'UTC')"
+                          , 'timestamp':                   "(TO_TIMESTAMP(%s) AT TIME ZONE 'UTC')"
+                          , 'date':                        "(TO_TIMESTAMP(%s) AT TIME ZONE 'UTC')"
+                          }
+
 class SqlQuery(DbbQuery):
+  timestampLiterals = SQL_TIMESTAMP_LITERALS
+
   def _translate(self, expr):
     return exprToMySql(expr)
 
@@ -51,16 +67,14 @@ class SqlQuery(DbbQuery):
       if not metaKey in self.jsSpec['meta']:
         raise ValueError( "dataSources.sql.query._combinePieces"
                         , "No meta info for {field}.".format(field=metaKey))
+      field, placeholder = obj['translated'], '%s'
       if self.jsSpec['meta'][metaKey]['type'] == 'date':
-        # redo the translation?
-        expr = obj['expr']['expr']
-        obj['translated'] = self._translate(exprCallFnc('unix', [expr]))
+        field, placeholder = self._dateFilter(obj['expr']['expr'])
 
-      field = obj['translated']
       querytmp = ''
       if 'in' in obj:
         val = obj['in']
-        querytmp += field + ' IN (' + ','.join('%s' for i in val) + ') '
+        querytmp += field + ' IN (' + ','.join(placeholder for i in val) + ') '
         params += val
       for op in ['ge', 'le', 'lt', 'gt', 'eq']:
         if op in obj:
@@ -70,11 +84,11 @@ class SqlQuery(DbbQuery):
             'gt' : '>',
             'le' : '<=',
             'lt' : '<',
-            'eq' : '=='
+            'eq' : '='
           }
           if querytmp != '':
             querytmp += ' AND '
-          querytmp += field + _infixop[op] + ' %s '
+          querytmp += field + _infixop[op] + ' ' + placeholder + ' '
           params.append(val)
       if 'notnull' in obj:
         if obj['notnull']:
@@ -108,12 +122,37 @@ class SqlQuery(DbbQuery):
 
     return (query, params)
 
+  def _dateFilter(self, expr):
+    """
+    Helper to compare a date expression against the unix timestamps sent by
+    the client. Plain columns of a type listed in `timestampLiterals` are
+    compared as is, against the timestamps converted to literals, so that the
+    filter is sargable (i.e. range scans can use an index on the column).
+    Other expressions are converted to unix time instead.
+
+    Args:
+      expr: The column expression being filtered.
+
+    Returns:
+      A pair of the SQL expression to filter on and the placeholder for its
+      values, e.g. ('tbl.col', 'FROM_UNIXTIME(%s)').
+    """
+    tag, fields = expr
+    if tag == 'ident':
+      placeholder = self.timestampLiterals.get(self.columnTypes.get(fields['name']))
+      if placeholder is not None:
+        return self._translate(expr), placeholder
+    return self._translate(exprCallFnc('unix', [expr])), '%s'
+
   def _executeQuery(self, args):
     query, params = args
     result = self.queryFunc(query, params)
     return result
 
   def _formatResult(self, result):
+    if self.columnar:
+      return self._formatColumns(result)
+
     results = []
     for row in result:
       tmp = {}
@@ -127,8 +166,31 @@ class SqlQuery(DbbQuery):
 
     return {'data': results, 'meta': self.jsSpec['meta'] }
 
+  def _formatColumns(self, result):
+    """
+    Columnar counterpart to _formatResult. The type of each column is looked up
+    once, and values are converted straight from the DB-API row tuples rather
+    than round-tripping through strings and `tryParse`.
+
+    Args:
+      result: A sequence of row tuples, ordered as in self.selectOrder.
+
+    Returns:
+      A dictionary with fields 'data' and 'meta', where 'data' maps column names
+      to lists of values.
+    """
+    meta = self.jsSpec['meta']
+    data = {}
+    for i, name in enumerate(self.selectOrder):
+      coerce = COLUMN_COERCERS.get(meta[name]['type'], coerceCat)
+      data[str(name)] = [coerce(row[i]) for row in result]
+
+    return {'data': data, 'meta': meta}
+
 
 class PostgreSqlQuery(SqlQuery):
+  timestampLiterals = PSQL_TIMESTAMP_LITERALS
+
   def _translate(self, expr):
     return exprToPostgres(expr)
 
@@ -139,8 +201,48 @@ def getType(t):
          PSQL_TYPE_MAP.get(t.split(' ')[0]) or \
          'cat'
 
+def coerceNum(value):
+  """Convert a DB-API numeric value to a JSON number; NULL becomes 0."""
+  if value is None:
+    return 0
+  if isinstance(value, (int, long, float)):
+    return value
+  return float(value) # e.g. decimal.Decimal
+
+def coerceDate(value):
+  """Convert a DB-API date value; timestamps are kept, date objects stringified."""
+  if value is None:
+    return 0
+  if isinstance(value, (int, long, float)):
+    return value
+  if isinstance(value, Decimal):
+    return float(value)
+  return str(value)
+
+def coerceCat(value):
+  """Convert a DB-API categorical value to a JSON-safe value."""
+  if value is None or isinstance(value, (int, long, float, unicode)):
+    return value
+  if isinstance(value, str):
+    return value.decode('utf-8', 'ignore')
+  if isinstance(value, Decimal):
+    return float(value)
+  return unicode(value)
+
+COLUMN_COERCERS = { 'num':  coerceNum
+                  , 'date': coerceDate
+                  , 'cat':  coerceCat
+                  }
+
 # Blocking: do not run on main thread
 def createSshUnixSocket(remoteUnixSocketPath, username, host, port, sshKey):
+  """
+  Starts a socat process forwarding a local unix socket to a remote one over SSH.
+
+  Returns:
+    A pair of the local unix socket path and the socat Popen object; the caller
+    should kill the process once the socket is no longer needed.
+  """
   if not validate.filepath(remoteUnixSocketPath):
     raise ValueError( "sql.query.createSshUnixSocket"
                     , "File path not permitted: '{path}'".format(path=remoteUnixSocketPath))
@@ -182,7 +284,7 @@ def createSshUnixSocket(remoteUnixSocketPath, username, host, port, sshKey):
   # Racy...
   sleep(0.3)
 
-  return localUnixSocketPath
+  return localUnixSocketPath, proc
 
 ### SQL and PostGreSQL type maps
 # see http://kimbriggs.com/computers/computer-notes/mysql-notes/mysql-data-types-50.file
@@ -0,0 +1,5 @@
+"""
+Tests of polychartQuery which need no data source to run. From `/server/`:
+
+  python -m unittest discover -t . -s polychartQuery/tests -p "test*.py"
+"""
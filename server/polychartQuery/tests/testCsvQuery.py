@@ -0,0 +1,145 @@
+"""
+Tests of querying uploaded CSV data: a small table is stored in a temporary
+directory by csv.storage.writeTable, and queried through csv.connection.Conn,
+which runs CsvQuery on its columns.
+"""
+import shutil
+import tempfile
+import unittest
+
+from os.path import join
+
+from polychartQuery.csv.connection import Conn
+from polychartQuery.csv.storage    import writeTable
+from polychartQuery.expr           import exprCallFnc
+
+META = {'region': {'type': 'cat'}, 'amount': {'type': 'num'}, 'day': {'type': 'date'}}
+DATA = { 'region': ['east',       'west',       'east',       None,         'west', 'north']
+       , 'amount': [10,           5,            None,         7,            2.5,    1]
+       , 'day':    ['2014-01-05', '2014-01-20', '2014-02-03', '2014-03-01', None,   '2014-01-31']
+       }
+
+JAN, FEB, MAR = 1388534400, 1391212800, 1393632000
+
+def ident(name):
+  return ['ident', {'name': 'sales.' + name}]
+
+def call(fname, *args):
+  return exprCallFnc(fname, list(args))
+
+def monthBin(name):
+  return call('bin', ident(name), ['const', {'type': 'cat', 'value': 'month'}])
+
+def querySpec(select, groups=(), filters=(), sort=(), limit=None):
+  """
+  Helper building a query spec.
+
+  Args:
+    select: A list of (name, expr, type) of the selected columns.
+    groups: A list of grouping expressions.
+    filters: A list of (expr, filter) pairs, e.g. (ident('amount'), {'ge': 5}).
+    sort: A list of (expr, asc) pairs.
+    limit: The limit of the query, if any.
+  """
+  spec = { 'select': [{'name': name, 'expr': expr} for name, expr, _ in select]
+         , 'meta':   {name: {'type': colType} for name, _, colType in select}
+         , 'stats':  {'stats': [], 'groups': [{'name': 'group', 'expr': expr} for expr in groups]}
+         , 'filter': [dict(filt, expr={'name': 'filter', 'expr': expr}) for expr, filt in filters]
+         , 'sort':   [{'sort': {'name': 'sort', 'expr': expr}, 'asc': asc} for expr, asc in sort]
+         }
+  for colName, colMeta in META.iteritems(): # as the client sends for filtered columns
+    spec['meta'].setdefault('sales.' + colName, dict(colMeta))
+  if limit is not None:
+    spec['limit'] = limit
+  return spec
+
+class CsvQueryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    writeTable(join(self.path, '0'), 'sales', META, DATA)
+    self.conn = Conn(path=self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def query(self, *args, **kwargs):
+    """Helper running a query, returning its columns as {name: [values...]}."""
+    return self.conn.queryTable('sales', querySpec(*args, **kwargs), 1000, columnar=True)['data']
+
+  def testSelect(self):
+    data = self.query([ ('sales.region', ident('region'), 'cat')
+                      , ('sales.amount', ident('amount'), 'num') ])
+    self.assertEqual(data['sales.region'], DATA['region'])
+    self.assertEqual(data['sales.amount'], [10, 5, 0, 7, 2.5, 1]) # NULL numbers become 0
+
+  def testFilters(self):
+    amount = ('sales.amount', ident('amount'), 'num')
+    self.assertEqual(self.query([amount], filters=[(ident('amount'), {'ge': 5})])['sales.amount'], [10, 5, 7])
+    self.assertEqual(self.query([amount], filters=[(ident('amount'), {'gt': 5})])['sales.amount'], [10, 7])
+    self.assertEqual(self.query([amount], filters=[(ident('amount'), {'le': 5, 'gt': 1})])['sales.amount'], [5, 2.5])
+    self.assertEqual(self.query([amount], filters=[(ident('amount'), {'eq': 7})])['sales.amount'], [7])
+
+    region = ('sales.region', ident('region'), 'cat')
+    data = self.query([region], filters=[(ident('region'), {'in': ['west', 'north']})])
+    self.assertEqual(data['sales.region'], ['west', 'west', 'north'])
+
+  def testFilterNotNull(self):
+    amount  = ('sales.amount', ident('amount'), 'num')
+    nulls   = self.query([amount], filters=[(ident('amount'), {'ge': 5, 'notnull': False})])
+    notNull = self.query([amount], filters=[(ident('amount'), {'notnull': True})])
+    self.assertEqual(nulls['sales.amount'], [10, 5, 0, 7])
+    self.assertEqual(notNull['sales.amount'], [10, 5, 7, 2.5, 1])
+
+  def testFilterDates(self):
+    region = ('sales.region', ident('region'), 'cat')
+    data = self.query([region], filters=[(ident('day'), {'ge': FEB, 'lt': MAR})])
+    self.assertEqual(data['sales.region'], ['east'])
+
+  def testGroups(self):
+    data = self.query( [ ('sales.region', ident('region'), 'cat')
+                       , ('sum([sales.amount])', call('sum', ident('amount')), 'num')
+                       , ('count([sales.amount])', call('count', ident('amount')), 'num') ]
+                     , groups=[ident('region')] )
+    self.assertEqual(data['sales.region'], ['east', 'west', None, 'north'])
+    self.assertEqual(data['sum([sales.amount])'], [10, 7.5, 7, 1])
+    self.assertEqual(data['count([sales.amount])'], [1, 2, 1, 1])
+
+  def testAggregateWithoutGroups(self):
+    data = self.query( [('sum([sales.amount])', call('sum', ident('amount')), 'num')]
+                     , filters=[(ident('amount'), {'ge': 5})] )
+    self.assertEqual(data['sum([sales.amount])'], [22])
+
+  def testMonthBins(self):
+    name = 'bin([sales.day],month)'
+    data = self.query( [ (name, monthBin('day'), 'date')
+                       , ('count([sales.amount])', call('count', ident('amount')), 'num') ]
+                     , groups=[monthBin('day')], sort=[(monthBin('day'), True)] )
+    self.assertEqual(data[name], [0, JAN, FEB, MAR]) # the missing date first, as 0
+    self.assertEqual(data['count([sales.amount])'], [1, 3, 0, 1])
+
+  def testSortMissingValues(self):
+    region = ('sales.region', ident('region'), 'cat')
+    ascending  = self.query([region], sort=[(ident('region'), True)])
+    descending = self.query([region], sort=[(ident('region'), False)])
+    self.assertEqual(ascending['sales.region'], [None, 'east', 'east', 'north', 'west', 'west'])
+    self.assertEqual(descending['sales.region'], ['west', 'west', 'north', 'east', 'east', None])
+
+  def testSortIsStable(self):
+    select = [('sales.region', ident('region'), 'cat'), ('sales.amount', ident('amount'), 'num')]
+    data = self.query(select, sort=[(ident('region'), True)])
+    self.assertEqual(data['sales.amount'], [7, 10, 0, 1, 5, 2.5]) # ties keep their order
+
+  def testLimit(self):
+    amount = ('sales.amount', ident('amount'), 'num')
+    data = self.query([amount], sort=[(ident('amount'), False)], limit=2)
+    self.assertEqual(data['sales.amount'], [10, 7])
+    data = self.conn.queryTable('sales', querySpec([amount]), 3, columnar=True)['data']
+    self.assertEqual(data['sales.amount'], [10, 5, 0])
+
+  def testRows(self):
+    spec = querySpec([('sales.region', ident('region'), 'cat')], limit=1)
+    self.assertEqual(self.conn.queryTable('sales', spec, 1000)['data'], [{'sales.region': 'east'}])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,89 @@
+"""
+Tests of filtering on dates in each SQL dialect: plain date columns are compared
+as is, against the client's unix timestamps converted to literals, so that the
+filters can use an index on the column.
+"""
+import unittest
+
+from polychartQuery.expr      import exprCallFnc
+from polychartQuery.sql.query import SqlQuery, PostgreSqlQuery
+
+COLUMN = ['ident', {'name': 'ts'}]
+
+def dateQuery(cls, columnType, filter):
+  """Helper building a query of `ts` of the given type, filtered by `filter`."""
+  filter = dict(filter, expr={'name': '[ts]', 'expr': COLUMN})
+  spec = { 'select': [{'name': '[ts]', 'expr': COLUMN}]
+         , 'meta':   {'ts': {'type': 'date'}}
+         , 'stats':  {'stats': [], 'groups': []}
+         , 'filter': [filter]
+         }
+  return cls('tbl', spec, columns=[('ts', columnType)])
+
+def whereClause(query):
+  sql, params = query.query
+  return sql.partition(' FROM tbl ')[2].partition('LIMIT')[0], params
+
+class MySqlDateFilterTest(unittest.TestCase):
+
+  def testTimestampColumns(self):
+    for columnType in ['datetime', 'timestamp', 'date']:
+      query = dateQuery(SqlQuery, columnType, {'ge': 0})
+      self.assertEqual(query._dateFilter(COLUMN), ('ts', 'FROM_UNIXTIME(%s)'), columnType)
+
+  def testOtherColumns(self):
+    query = dateQuery(SqlQuery, 'int', {'ge': 0})
+    self.assertEqual(query._dateFilter(COLUMN), ('UNIX_TIMESTAMP(ts)', '%s'))
+
+  def testExpressions(self):
+    expr  = exprCallFnc('bin', [COLUMN, ['const', {'type': 'cat', 'value': 'day'}]])
+    query = dateQuery(SqlQuery, 'datetime', {'ge': 0})
+    field, placeholder = query._dateFilter(expr)
+    self.assertTrue(field.startswith('UNIX_TIMESTAMP('))
+    self.assertEqual(placeholder, '%s')
+
+  def testOperators(self):
+    where, params = whereClause(dateQuery(SqlQuery, 'datetime', {'ge': 0, 'lt': 60}))
+    self.assertEqual(where, 'WHERE ts>= FROM_UNIXTIME(%s)  AND ts< FROM_UNIXTIME(%s)  ')
+    self.assertEqual(params, [0, 60])
+
+  def testEquals(self):
+    where, params = whereClause(dateQuery(SqlQuery, 'datetime', {'eq': 60}))
+    self.assertEqual(where, 'WHERE ts= FROM_UNIXTIME(%s)  ')
+    self.assertEqual(params, [60])
+
+  def testIn(self):
+    where, params = whereClause(dateQuery(SqlQuery, 'date', {'in': [0, 60]}))
+    self.assertEqual(where, 'WHERE ts IN (FROM_UNIXTIME(%s),FROM_UNIXTIME(%s))  ')
+    self.assertEqual(params, [0, 60])
+
+class PostgresDateFilterTest(unittest.TestCase):
+
+  def testTimestampColumns(self):
+    query = dateQuery(PostgreSqlQuery, 'timestamp with time zone', {'ge': 0})
+    self.assertEqual(query._dateFilter(COLUMN), ('ts', 'TO_TIMESTAMP(%s)'))
+    for columnType in ['timestamp without time zone', 'timestamp', 'date']:
+      query = dateQuery(PostgreSqlQuery, columnType, {'ge': 0})
+      self.assertEqual( query._dateFilter(COLUMN)
+                      , ('ts', "(TO_TIMESTAMP(%s) AT TIME ZONE 'UTC')"), columnType )
+
+  def testOtherColumns(self):
+    query = dateQuery(PostgreSqlQuery, 'integer', {'ge': 0})
+    self.assertEqual(query._dateFilter(COLUMN), ('EXTRACT(EPOCH FROM ts)', '%s'))
+
+  def testOperators(self):
+    where, params = whereClause(dateQuery(PostgreSqlQuery, 'timestamp with time zone', {'gt': 0, 'le': 60}))
+    self.assertEqual(where, 'WHERE ts<= TO_TIMESTAMP(%s)  AND ts> TO_TIMESTAMP(%s)  ')
+    self.assertEqual(params, [60, 0])
+
+  def testEquals(self):
+    where, params = whereClause(dateQuery(PostgreSqlQuery, 'timestamp with time zone', {'eq': 60}))
+    self.assertEqual(where, 'WHERE ts= TO_TIMESTAMP(%s)  ')
+    self.assertEqual(params, [60])
+
+  def testNotNull(self):
+    where, _ = whereClause(dateQuery(PostgreSqlQuery, 'timestamp with time zone', {'ge': 0, 'notnull': True}))
+    self.assertEqual(where, 'WHERE ( ts>= TO_TIMESTAMP(%s)  ) AND ts IS NOT NULL ')
+
+if __name__ == '__main__':
+  unittest.main()
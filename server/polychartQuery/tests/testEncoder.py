@@ -0,0 +1,81 @@
+"""
+Tests that the compat mode of ResultEncoder writes exactly what formatting rows
+with SqlQuery._formatResult, then `json.dumps(saneEncode(...))`, used to.
+"""
+import json
+import unittest
+
+from datetime import date, datetime
+from decimal  import Decimal
+
+from polychartQuery.encoder   import ResultEncoder
+from polychartQuery.sql.query import SqlQuery
+from polychartQuery.utils     import saneEncode
+
+INF = float('inf')
+
+# Values of each type of column, as DB-API drivers return them
+VALUES = { 'num':  [ None, 0, -3, 2**70, 1.5, -0.0, 0.1 + 0.2, 1e-7, 123456789.123456789
+                   , INF, -INF, float('nan'), Decimal('1.10'), Decimal('-0'), Decimal('1E+3'), True ]
+         , 'date': [ None, 0, 1388534400, 1388534400.5, Decimal('1388534400.25')
+                   , datetime(2014, 1, 2, 3, 4, 5), datetime(2014, 1, 2, 3, 4, 5, 600), date(2014, 1, 2) ]
+         , 'cat':  [ None, '', 'abc', u'abc', 'he said "hi"\n\t\\', 'caf\xc3\xa9', '\xe2\x82\xac5'
+                   , '007', '1e3', ' 12 ', '-0', '0x1f', 'nan', 'Infinity', 'true', 'null', '1,000'
+                   , '2014-01-02', 'Jan 2, 2014', 42, 4.25, Decimal('2.50'), datetime(2014, 1, 2) ]
+         }
+
+def legacyEncode(names, meta, rows):
+  """Helper encoding rows as queryTableJson did before ResultEncoder."""
+  query = SqlQuery.__new__(SqlQuery)
+  query.columnar    = False
+  query.selectOrder = names
+  query.jsSpec      = {'meta': meta}
+  return json.dumps(saneEncode(query._formatResult(rows)))
+
+def columnRows(columnType):
+  """Helper building rows of one column of the given type, plus a count."""
+  return [(value, i) for i, value in enumerate(VALUES[columnType])]
+
+class CompatEncoderTest(unittest.TestCase):
+
+  def assertCompat(self, names, meta, rows):
+    encoder = ResultEncoder(names, meta, compat=True)
+    self.assertEqual(encoder.encode(rows), legacyEncode(names, meta, rows))
+
+  def testColumnTypes(self):
+    for columnType in VALUES:
+      meta = {'value': {'type': columnType}, 'count(*)': {'type': 'num'}}
+      for row in columnRows(columnType): # one at a time, to tell which fails
+        self.assertCompat(['value', 'count(*)'], meta, [row])
+      self.assertCompat(['value', 'count(*)'], meta, columnRows(columnType))
+
+  def testEmpty(self):
+    self.assertCompat(['a'], {'a': {'type': 'num'}}, [])
+
+  def testKeyOrder(self):
+    names = ['t.col{0}'.format(i) for i in range(40)] + [u'sum(t.x)', 'bin(t.d,"month")']
+    types = ['num', 'date', 'cat']
+    meta  = {name: {'type': types[i % 3]} for i, name in enumerate(names)}
+    rows  = [tuple(VALUES[types[i % 3]][(i + j) % len(VALUES[types[i % 3]])]
+                     for i in range(len(names))) for j in range(5)]
+    self.assertCompat(names, meta, rows)
+
+  def testDuplicateNames(self):
+    meta = {'a': {'type': 'cat'}, 'b': {'type': 'num'}}
+    self.assertCompat(['a', 'b', 'a'], meta, [('first', 1, 'last'), (None, None, 3)])
+
+  def testMeta(self):
+    meta = { u'a': {'type': u'num', 'tableName': u'caf\xe9', 'dsKey': 'k'}
+           , 'b': {'type': 'date', 'bw': 'month', 'range': [0, 1e10]} }
+    self.assertCompat(['a', 'b'], meta, [(1, 2)])
+
+  def testChunks(self):
+    meta    = {'value': {'type': 'cat'}, 'count(*)': {'type': 'num'}}
+    rows    = columnRows('cat')
+    encoder = ResultEncoder(['value', 'count(*)'], meta, compat=True)
+    batches = [rows[:3], [], rows[3:10], rows[10:]]
+    self.assertEqual(''.join(encoder.encodeChunks(batches)), encoder.encode(rows))
+    self.assertEqual(''.join(encoder.encodeChunks([])), encoder.encode([]))
+
+if __name__ == '__main__':
+  unittest.main()
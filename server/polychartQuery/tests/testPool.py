@@ -0,0 +1,209 @@
+"""
+Tests of pooling data source connections (see polychartQuery.pool), with fake
+connections.
+"""
+import threading
+import unittest
+
+from polychartQuery.abstract import DsConnError
+from polychartQuery.pool     import DataSourcePool, PoolRegistry, PooledConnection
+
+WAIT_SECONDS = 5
+
+class FakeConn(object):
+  """A connection recording whether it was closed, and streaming fixed chunks."""
+  def __init__(self):
+    self.opened  = True
+    self.healthy = True
+    self.pings   = 0
+    self.closed  = False
+    self.streams = []
+
+  def ping(self):
+    self.pings += 1
+    if self.healthy is None:
+      raise IOError('connection reset')
+    return self.healthy
+
+  def close(self):
+    self.closed = True
+
+  def streamTable(self, tableName, querySpec, limit, batchSize, compat):
+    stream = {'closed': False}
+    self.streams.append(stream)
+    try:
+      for chunk in ['[', '{}', ']']:
+        yield chunk
+    finally:
+      stream['closed'] = True
+
+class Factory(object):
+  """A connection factory, keeping the connections it opened."""
+  def __init__(self, error=None):
+    self.opened = []
+    self.error  = error
+
+  def __call__(self):
+    if self.error is not None:
+      raise self.error
+    conn = FakeConn()
+    self.opened.append(conn)
+    return conn
+
+class DataSourcePoolTest(unittest.TestCase):
+
+  def testReuse(self):
+    pool, factory = DataSourcePool(), Factory()
+    conn = pool.checkout(factory)
+    pool.checkin(conn)
+    self.assertIs(pool.checkout(factory), conn)
+    self.assertEqual((len(factory.opened), pool.size, conn.pings), (1, 1, 0))
+
+  def testBoundedCheckout(self):
+    pool, factory = DataSourcePool(maxSize=2, checkoutTimeout=0.05), Factory()
+    first = pool.checkout(factory)
+    pool.checkout(factory)
+    self.assertRaises(DsConnError, pool.checkout, factory)
+    self.assertEqual((len(factory.opened), pool.size), (2, 2))
+
+    pool.checkin(first)
+    self.assertIs(pool.checkout(factory), first)
+
+  def testWaitForCheckin(self):
+    pool, factory = DataSourcePool(maxSize=1, checkoutTimeout=WAIT_SECONDS), Factory()
+    conn    = pool.checkout(factory)
+    results = []
+    waiter  = threading.Thread(target=lambda: results.append(pool.checkout(factory)))
+    waiter.start()
+    pool.checkin(conn)
+    waiter.join(WAIT_SECONDS)
+    self.assertEqual(results, [conn])
+    self.assertEqual(len(factory.opened), 1)
+
+  def testUnhealthyConnection(self):
+    pool, factory = DataSourcePool(pingAfter=-1), Factory() # always health checked
+    conn = pool.checkout(factory)
+    pool.checkin(conn)
+    self.assertIs(pool.checkout(factory), conn)
+
+    pool.checkin(conn)
+    conn.healthy = False
+    fresh = pool.checkout(factory)
+    self.assertIsNot(fresh, conn)
+    self.assertTrue(conn.closed)
+    self.assertEqual((conn.pings, pool.size), (2, 1))
+
+  def testPingError(self):
+    pool, factory = DataSourcePool(pingAfter=-1), Factory()
+    conn = pool.checkout(factory)
+    pool.checkin(conn)
+    conn.healthy = None
+    self.assertIsNot(pool.checkout(factory), conn)
+    self.assertTrue(conn.closed)
+    self.assertEqual(pool.size, 1)
+
+  def testFactoryError(self):
+    pool = DataSourcePool(maxSize=1, checkoutTimeout=0.05)
+    for _ in range(3): # would time out if the slot were not released
+      self.assertRaises(IOError, pool.checkout, Factory(IOError('refused')))
+      self.assertEqual(pool.size, 0)
+    self.assertIsInstance(pool.checkout(Factory()), FakeConn)
+
+  def testClosedConnection(self):
+    pool, factory = DataSourcePool(maxSize=1), Factory()
+    conn = pool.checkout(factory)
+    conn.opened = False
+    pool.checkin(conn)
+    self.assertEqual(pool.size, 0)
+    self.assertIsNot(pool.checkout(factory), conn)
+
+  def testReap(self):
+    pool, factory = DataSourcePool(idleTimeout=-1), Factory()
+    conn = pool.checkout(factory)
+    busy = pool.checkout(factory)
+    pool.checkin(conn)
+    pool.reap()
+    self.assertTrue(conn.closed)
+    self.assertFalse(busy.closed)
+    self.assertEqual(pool.size, 1)
+
+  def testClose(self):
+    pool, factory = DataSourcePool(), Factory()
+    idle = pool.checkout(factory)
+    busy = pool.checkout(factory)
+    pool.checkin(idle)
+    pool.close()
+    self.assertTrue(idle.closed)
+    self.assertFalse(busy.closed)
+    pool.checkin(busy)
+    self.assertTrue(busy.closed)
+    self.assertEqual(pool.size, 0)
+
+class PoolRegistryTest(unittest.TestCase):
+
+  def testSamePool(self):
+    registry = PoolRegistry()
+    self.assertIs(registry.get('a'), registry.get('a'))
+    self.assertIsNot(registry.get('a'), registry.get('b'))
+
+  def testLruEviction(self):
+    registry, factory = PoolRegistry(maxPools=2), Factory()
+    poolA, poolB = registry.get('a'), registry.get('b')
+    conn = poolB.checkout(factory)
+    poolB.checkin(conn)
+
+    registry.get('a') # now more recently used than b
+    registry.get('c')
+    self.assertTrue(conn.closed)
+    self.assertIs(registry.get('a'), poolA)
+    self.assertIsNot(registry.get('b'), poolB)
+
+  def testReapForgetsEmptyPools(self):
+    registry, factory = PoolRegistry(reapInterval=-1, idleTimeout=-1), Factory()
+    pool = registry.get('a')
+    conn = pool.checkout(factory)
+    pool.checkin(conn)
+    registry.get('b')
+    self.assertTrue(conn.closed)
+    self.assertIsNot(registry.get('a'), pool)
+
+  def testDiscard(self):
+    registry, factory = PoolRegistry(), Factory()
+    pool = registry.get('a')
+    pool.checkin(pool.checkout(factory))
+    registry.discard('a')
+    self.assertTrue(factory.opened[0].closed)
+    self.assertIsNot(registry.get('a'), pool)
+
+class PooledConnectionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pool    = DataSourcePool(maxSize=1, checkoutTimeout=0.05)
+    self.factory = Factory()
+    self.conn    = PooledConnection(self.pool, self.factory)
+
+  def assertCheckedOut(self):
+    self.assertRaises(DsConnError, self.pool.checkout, self.factory)
+
+  def assertCheckedIn(self):
+    self.pool.checkin(self.pool.checkout(self.factory))
+    self.assertEqual(len(self.factory.opened), 1)
+
+  def testStreamTable(self):
+    chunks = self.conn.streamTable('t', {}, 10)
+    self.assertEqual(next(chunks), '[')
+    self.assertCheckedOut()
+    self.assertEqual(list(chunks), ['{}', ']'])
+    self.assertTrue(self.factory.opened[0].streams[0]['closed'])
+    self.assertCheckedIn()
+
+  def testStreamTableClosed(self):
+    chunks = self.conn.streamTable('t', {}, 10)
+    next(chunks)
+    self.assertCheckedOut()
+    chunks.close() # e.g. the client went away
+    self.assertTrue(self.factory.opened[0].streams[0]['closed'])
+    self.assertCheckedIn()
+
+if __name__ == '__main__':
+  unittest.main()
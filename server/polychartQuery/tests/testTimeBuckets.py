@@ -0,0 +1,68 @@
+"""
+Tests of binning dates in the Postgres dialect: every bin width of
+POSTGRES_TIME_BUCKETS is translated by exprToPostgres, and built into a query by
+PostgreSqlQuery, and the generated SQL is checked as a string.
+"""
+import unittest
+
+from polychartQuery.expr      import exprCallFnc
+from polychartQuery.sql.expr  import POSTGRES_TIME_BUCKETS, exprToPostgres
+from polychartQuery.sql.query import PostgreSqlQuery
+
+COLUMN  = ['ident', {'name': 'ts'}]
+COLUMNS = [('ts', 'timestamp with time zone'), ('value', 'integer')]
+
+def binExpr(width):
+  return exprCallFnc('bin', [COLUMN, ['const', {'type': 'cat', 'value': width}]])
+
+def binSpec(width):
+  """Helper building a query spec binning `ts` by `width`, filtered on `ts`."""
+  name  = 'bin([ts],%s)' % width
+  count = exprCallFnc('count', [['ident', {'name': 'value'}]])
+  return { 'select': [ {'name': name, 'expr': binExpr(width)}
+                     , {'name': 'count([value])', 'expr': count} ]
+         , 'meta':   { name:             {'type': 'date'}
+                     , 'count([value])': {'type': 'num'}
+                     , 'ts':             {'type': 'date'} }
+         , 'stats':  { 'stats':  [{'name': 'count', 'args': [['ident', {'name': 'value'}]]}]
+                     , 'groups': [{'name': name, 'expr': binExpr(width)}] }
+         , 'filter': [{'expr': {'name': '[ts]', 'expr': COLUMN}, 'ge': 0, 'lt': 86400}]
+         }
+
+class TimeBucketTest(unittest.TestCase):
+
+  def testExprToPostgres(self):
+    for width, (unit, step) in POSTGRES_TIME_BUCKETS.iteritems():
+      sql = exprToPostgres(binExpr(width))
+      self.assertTrue(sql.startswith('EXTRACT(EPOCH FROM '), width)
+      self.assertIn("DATE_TRUNC('%s', ts)" % unit, sql, width)
+      self.assertNotIn('%', sql, width)
+      if step > 1:
+        self.assertIn('MOD(EXTRACT(%s FROM ts)::int' % unit.upper(), sql, width)
+        self.assertIn(', %d) * INTERVAL \'1 %s\'' % (step, unit.upper()), sql, width)
+      else:
+        self.assertNotIn('MOD(', sql, width)
+
+  def testMonthsAlignToYear(self):
+    self.assertIn('MOD(EXTRACT(MONTH FROM ts)::int - 1, 2)', exprToPostgres(binExpr('twoMonth')))
+    self.assertIn('MOD(EXTRACT(YEAR FROM ts)::int, 5)', exprToPostgres(binExpr('fiveYear')))
+
+  def testPostgreSqlQuery(self):
+    for width in POSTGRES_TIME_BUCKETS:
+      query, params = PostgreSqlQuery('tbl', binSpec(width), columns=COLUMNS).query
+      bucket = exprToPostgres(binExpr(width))
+      select, _, rest = query.partition(' FROM tbl ')
+      where, _, group = rest.partition('GROUP BY ')
+
+      self.assertIn(bucket, select, width)
+      self.assertTrue(group.startswith(bucket + ' '), width)
+      # filtered on the raw column, not on its unix time
+      self.assertRegexpMatches(where, r'^WHERE ts>= TO_TIMESTAMP\(%s\) +AND ts< TO_TIMESTAMP\(%s\)')
+      self.assertNotIn('EPOCH', where, width)
+      self.assertEqual(params, [0, 86400], width)
+
+  def testUnknownWidth(self):
+    self.assertRaises(KeyError, exprToPostgres, binExpr('fortnight'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,153 @@
+"""
+Per-phase timing of data source requests.
+
+Code on the query path wraps its phases (connection checkout, validation,
+translation, execution, fetching, formatting, encoding and caching) in `phase`.
+Each duration is recorded in two places:
+  * the RequestTimer of the current thread, if one was started with
+    `requestTimer`, which is used for e.g. the Server-Timing header; and
+  * the process-wide histogram registry REGISTRY, which can be exported in the
+    Prometheus text format for scraping.
+
+Exported:
+  phase: Context manager timing a phase of the current request.
+  requestTimer: Context manager collecting the phases of a request.
+  HistogramRegistry: Thread-safe collection of duration histograms.
+  REGISTRY: The HistogramRegistry all phases are recorded in.
+"""
+import threading
+
+from collections import OrderedDict
+from contextlib  import contextmanager
+from time        import time
+
+# Upper bounds (seconds) of histogram buckets, as for Prometheus
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class RequestTimer(object):
+  """
+  Collects the total duration of each phase of a single request.
+
+  Attribs:
+    startTime: Timestamp at which the request started.
+    phases: Ordered dictionary of phase names to total seconds.
+
+  Public Methods:
+    add: Adds time spent in a phase.
+    elapsed: Seconds since the request started.
+    serverTiming: Formats the phases as a Server-Timing header value.
+  """
+  def __init__(self):
+    self.startTime = time()
+    self.phases    = OrderedDict()
+
+  def add(self, name, seconds):
+    self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+  def elapsed(self):
+    return time() - self.startTime
+
+  def serverTiming(self):
+    """
+    Returns:
+      A string like 'checkout;dur=0.1, execute;dur=25.3, total;dur=30.2', with
+      durations in milliseconds.
+    """
+    parts = ['{0};dur={1:.1f}'.format(name, seconds * 1000)
+               for name, seconds in self.phases.iteritems()]
+    parts.append('total;dur={0:.1f}'.format(self.elapsed() * 1000))
+    return ', '.join(parts)
+
+class HistogramRegistry(object):
+  """
+  A thread-safe collection of histograms of durations, keyed by name.
+
+  Public Methods:
+    observe: Records a duration.
+    snapshot: Returns a copy of all histograms.
+    prometheus: Formats all histograms in the Prometheus text format.
+  """
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets     = tuple(buckets)
+    self._histograms = {} # name -> [bucket counts..., +Inf count, sum]
+    self._lock       = threading.Lock()
+
+  def observe(self, name, seconds):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = [0] * (len(self.buckets) + 1) + [0.0]
+      for i, bound in enumerate(self.buckets):
+        if seconds <= bound:
+          histogram[i] += 1
+      histogram[-2] += 1
+      histogram[-1] += seconds
+
+  def snapshot(self):
+    """
+    Returns:
+      A dictionary of names to dictionaries with keys 'buckets' (pairs of upper
+      bound and cumulative count, the last bound being '+Inf'), 'count' and 'sum'.
+    """
+    with self._lock:
+      histograms = {name: list(h) for name, h in self._histograms.iteritems()}
+    return { name: { 'buckets': zip(self.buckets + ('+Inf',), h[:-1])
+                   , 'count':   h[-2]
+                   , 'sum':     h[-1] }
+               for name, h in histograms.iteritems() }
+
+  def prometheus(self, metric, label):
+    """
+    Formats all histograms as a single Prometheus histogram metric.
+
+    Args:
+      metric: The metric name, e.g. 'polychart_phase_seconds'.
+      label: The label distinguishing histograms, e.g. 'phase'.
+
+    Returns:
+      A string in the Prometheus text exposition format.
+    """
+    lines = ['# TYPE {0} histogram'.format(metric)]
+    for name, histogram in sorted(self.snapshot().iteritems()):
+      for bound, count in histogram['buckets']:
+        lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}'.format(
+          metric, label, name, bound, count))
+      lines.append('{0}_count{{{1}="{2}"}} {3}'.format(metric, label, name, histogram['count']))
+      lines.append('{0}_sum{{{1}="{2}"}} {3!r}'.format(metric, label, name, histogram['sum']))
+    return '\n'.join(lines) + '\n'
+
+REGISTRY = HistogramRegistry()
+
+_local = threading.local()
+
+@contextmanager
+def requestTimer():
+  """
+  Context manager starting a RequestTimer for the current thread, which phases
+  timed within the block are added to.
+  """
+  previous = getattr(_local, 'timer', None)
+  timer = _local.timer = RequestTimer()
+  try:
+    yield timer
+  finally:
+    _local.timer = previous
+
+@contextmanager
+def phase(name):
+  """
+  Context manager timing a phase, e.g. `with phase('execute'): ...`. The time
+  is recorded even if the block raises.
+  """
+  startTime = time()
+  try:
+    yield
+  finally:
+    record(name, time() - startTime)
+
+def record(name, seconds):
+  """Records time spent in a phase that was measured by the caller."""
+  REGISTRY.observe(name, seconds)
+  timer = getattr(_local, 'timer', None)
+  if timer is not None:
+    timer.add(name, seconds)
@@ -16,6 +16,41 @@ def listDictWithPair(dictList, key, value):
       return d
   return None
 
+# rowsToColumns : [Dict] -> [Key] -> Dict
+# Transpose a list of row dictionaries into {key: [values...]}; missing cells are None.
+def rowsToColumns(rows, keys):
+  return {key: [row.get(key) for row in rows] for key in keys}
+
+#### Query fingerprinting
+
+# Spec fields which only matter to the client, and never change query results
+UI_ONLY_FIELDS = frozenset(['dateOptions'])
+
+def canonicalize(obj):
+  """
+  Produces a canonical form of a query specification (or any JSON-like value),
+  so that equivalent queries have equal, JSON serializable representations.
+  Strings are decoded to unicode, tuples become lists and fields listed in
+  UI_ONLY_FIELDS are dropped. Dictionary key order is left to the serializer,
+  e.g. `json.dumps(..., sort_keys=True)`.
+
+  Args:
+    obj: The value to canonicalize.
+
+  Returns:
+    The canonical form of `obj`.
+  """
+  if isinstance(obj, dict):
+    return {canonicalize(key): canonicalize(val)
+              for key, val in obj.iteritems() if key not in UI_ONLY_FIELDS}
+  elif isinstance(obj, (list, tuple)):
+    return [canonicalize(item) for item in obj]
+  elif isinstance(obj, str):
+    return obj.decode('utf-8', 'replace')
+  elif obj is None or isinstance(obj, (unicode, bool, int, long, float)):
+    return obj
+  return repr(obj)
+
 #### File path tools
 if not os.path.exists('tmp'):
   os.mkdir('tmp')